@@ -0,0 +1,484 @@
+"""
+    Non-blocking client for filemand.
+
+    AsyncFilemandClient keeps many requests in flight at once, spread
+    over a pool of connections to the server. A call sends its request
+    and returns a Pending result at once. The responses are read by
+    poll(), which an event loop calls when one of the sockets from
+    fileno_list() is readable (or writable, while there is output
+    queued). wait(), or Pending.result(), polls until a result is in.
+
+        client = AsyncFilemandClient(host, port, connections=4)
+        handle = client.get_file("PATIENT").result()
+        rows = [client.get(handle, rowid) for rowid in rowids]
+        client.wait(*rows)
+
+    The frames are those of FilemandClient, so this works against the
+    usual FilemandServer. The client is not thread safe; it belongs to
+    the thread running the event loop.
+"""
+
+import errno
+import select
+import socket
+import logging
+import time
+
+from shared import FilemanError
+from clientserver import FilemandClient, CODECS, FETCH_SIZE, _FRAME
+
+logger = logging.getLogger(__file__)
+
+# Bytes read from a socket per recv.
+RECV_BYTES = 65536
+
+class Pending:
+    """
+        The result of a request which may not have arrived yet.
+        Callbacks added with add_done_callback are called with the
+        Pending once it is done. An exception raised by a callback is
+        logged, it does not stop the other callbacks or the poll.
+    """
+    done = False
+    _value = None
+    _error = None
+
+    def __init__(self, client):
+        self.client = client
+        self._callbacks = []
+
+    def set_result(self, value):
+        self._value = value
+        self._done()
+
+    def set_exception(self, error):
+        self._error = error
+        self._done()
+
+    def _done(self):
+        self.done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            logger.exception("Callback %s on a Pending result failed", callback)
+
+    def add_done_callback(self, callback):
+        if self.done:
+            self._call(callback)
+        else:
+            self._callbacks.append(callback)
+
+    def result(self, timeout=None):
+        """
+            The response, waiting for it if need be. Raises the error
+            from the server.
+        """
+        if not self.done:
+            self.client.wait(self, timeout=timeout)
+            if not self.done:
+                raise FilemanError("No response from the server after %s seconds" % timeout)
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def then(self, fn):
+        """
+            A Pending for fn(result). If fn returns a Pending, the
+            new Pending follows it.
+        """
+        rv = Pending(self.client)
+        def done(pending):
+            if pending._error is not None:
+                rv.set_exception(pending._error)
+                return
+            try:
+                value = fn(pending._value)
+            except Exception, e:
+                rv.set_exception(e)
+                return
+            if isinstance(value, Pending):
+                value.add_done_callback(rv._follow)
+            else:
+                rv.set_result(value)
+        self.add_done_callback(done)
+        return rv
+
+    def _follow(self, pending):
+        if pending._error is not None:
+            self.set_exception(pending._error)
+        else:
+            self.set_result(pending._value)
+
+class _Connection:
+    """
+        One socket to the server, with the requests sent on it
+        which are waiting for their responses.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.socket = client.socket
+        self.socket.setblocking(0)
+        self.codec = client.codec
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.pending = {}
+        # file spec -> server handle, or the Pending get_file
+        self.handles = {}
+        self.closed = False
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def send(self, request_id, handle, data, pending):
+        if handle == None:
+            handle = ""
+        else:
+            handle = str(handle)
+        if data == None:
+            payload = ""
+        else:
+            payload = CODECS[self.codec][0](data)
+        header = '%s:%s:' % (request_id, handle)
+        self.client._seq = seq = (self.client._seq + 1) & 0xffffffff
+        self.outbuf += _FRAME.pack(len(header) + len(payload), seq)
+        self.outbuf += header
+        self.outbuf += payload
+        self.pending[seq] = pending
+        self.flush()
+
+    def flush(self):
+        """
+            Write as much of the queued output as the socket takes.
+        """
+        while self.outbuf:
+            try:
+                sent = self.socket.send(self.outbuf)
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            del self.outbuf[:sent]
+
+    def read(self):
+        """
+            Read what has arrived, and complete the requests whose
+            responses are whole. Each frame is removed from the buffer
+            before its request is completed, and a frame which can not
+            be decoded fails its request.
+        """
+        while 1:
+            try:
+                data = self.socket.recv(RECV_BYTES)
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                raise FilemanError("Error, Server terminated the conversation")
+            self.inbuf += data
+            if len(data) < RECV_BYTES:
+                break
+
+        while len(self.inbuf) >= _FRAME.size:
+            length, seq = _FRAME.unpack_from(buffer(self.inbuf, 0, _FRAME.size))
+            end = _FRAME.size + length
+            if len(self.inbuf) < end:
+                break
+            pending = self.pending.pop(seq, None)
+            value, error = None, None
+            if pending is not None and length:
+                try:
+                    value = CODECS[self.codec][1](buffer(self.inbuf, _FRAME.size, length))
+                except FilemanError, e:
+                    error = e
+                except Exception, e:
+                    logger.exception("Response to request %s could not be decoded", seq)
+                    error = FilemanError("Invalid response from the server: %s" % e)
+            del self.inbuf[:end]
+            if pending is None:
+                logger.warning("Response to unknown request %s", seq)
+            elif error is not None:
+                pending.set_exception(error)
+            else:
+                pending.set_result(value)
+
+    def close(self, error=None):
+        if self.closed:
+            return
+        self.closed = True
+        self.client._disconnect()
+        pending, self.pending = self.pending, {}
+        for result in pending.values():
+            result.set_exception(error or FilemanError("The connection to the server was closed"))
+
+class AsyncCursor:
+    """
+        The rows of a query or traversal held open on the server.
+        fetch() returns a Pending for the next page of rows, [] once
+        the rows are exhausted. Iterating over the cursor waits for
+        each page in turn.
+    """
+
+    def __init__(self, client, connection, cursor, fieldnames, convert, asdict, fetch_size):
+        self.client = client
+        self.connection = connection
+        self.cursor = cursor
+        self.fieldnames = fieldnames
+        self.convert = convert
+        self.asdict = asdict
+        self.fetch_size = fetch_size or FETCH_SIZE
+        self.continuation = None
+
+    def fetch(self):
+        if self.cursor is None:
+            rv = Pending(self.client)
+            rv.set_result([])
+            return rv
+        def page(page):
+            self.continuation = page['continuation']
+            if not page['more']:
+                # the server has dropped the cursor
+                self.cursor = None
+            return [self.convert(self.fieldnames, rowid, row, self.asdict) for rowid, row in page['rows']]
+        return self.client._send(self.connection, "cursor_fetchmany", self.cursor,
+                dict(size=self.fetch_size)).then(page)
+
+    def __iter__(self):
+        while 1:
+            rows = self.fetch().result()
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    def close(self):
+        """
+            Drop the cursor on the server before the rows are exhausted.
+        """
+        if self.cursor is not None:
+            cursor, self.cursor = self.cursor, None
+            if not self.connection.closed:
+                return self.client._send(self.connection, "cursor_close", cursor, None)
+
+class AsyncFilemandClient:
+    """
+        A pool of connections to filemand, used without blocking.
+        Each request goes to the connection with the fewest requests
+        outstanding.
+
+        get_file returns a handle for the client; the file is opened
+        on each connection when it is first used there. A cursor's
+        pages are read on the connection it was opened on.
+    """
+    client_class = FilemandClient
+
+    def __init__(self, host, port, connections=4, codec='json', DUZ=None, DT=None, isProgrammer=None):
+        self.host = host
+        self.port = port
+        self.codec = codec
+        self.size = connections
+        self._connect_data = dict(DUZ=DUZ, DT=DT, isProgrammer=isProgrammer)
+        self._files = []
+        self._file_keys = {}
+        self.connections = []
+
+    def _new_client(self):
+        client = self.client_class(self.host, self.port, codec=self.codec)
+        client.connect(**self._connect_data)
+        return client
+
+    def _connection(self):
+        """
+            The connection with the fewest requests outstanding,
+            opening a new one while there are fewer than size.
+        """
+        self.connections = [connection for connection in self.connections if not connection.closed]
+        idle = [connection for connection in self.connections if not connection.pending]
+        if idle:
+            return idle[0]
+        if len(self.connections) < self.size:
+            # The connection is set up with blocking requests.
+            connection = _Connection(self._new_client())
+            self.connections.append(connection)
+            return connection
+        return min(self.connections, key=lambda connection: len(connection.pending))
+
+    def _send(self, connection, request_id, handle, data):
+        pending = Pending(self)
+        try:
+            connection.send(request_id, handle, data, pending)
+        except (socket.error, FilemanError), e:
+            connection.close(e)
+            pending.set_exception(e)
+        return pending
+
+    #--------------------------------------------------------------------------------------------
+    # The event loop
+
+    def fileno_list(self):
+        """
+            The sockets to watch for input.
+        """
+        return [connection.fileno() for connection in self.connections if not connection.closed]
+
+    def writing(self):
+        """
+            The sockets with output queued, to watch for writability.
+        """
+        return [connection.fileno() for connection in self.connections
+                if not connection.closed and connection.outbuf]
+
+    def poll(self, timeout=0):
+        """
+            Send queued output and read the responses which have arrived.
+            Waits up to timeout seconds for something to happen, None to
+            wait indefinitely. Returns the number of connections serviced.
+        """
+        connections = [connection for connection in self.connections if not connection.closed]
+        if not connections:
+            return 0
+        writers = [connection for connection in connections if connection.outbuf]
+        try:
+            readable, writable, _ = select.select(connections, writers, [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return 0
+            raise
+        for connection in writable:
+            try:
+                connection.flush()
+            except socket.error, e:
+                connection.close(FilemanError("Error sending to the server: %s" % e))
+        for connection in readable:
+            try:
+                connection.read()
+            except (socket.error, FilemanError), e:
+                connection.close(isinstance(e, FilemanError) and e
+                        or FilemanError("Error reading from the server: %s" % e))
+        return len(readable) + len(writable)
+
+    def wait(self, *pending, **kwargs):
+        """
+            Poll until all the pending results are done, or timeout
+            seconds have passed.
+        """
+        timeout = kwargs.get('timeout')
+        deadline = timeout is not None and time.time() + timeout
+        while [result for result in pending if not result.done]:
+            if deadline is False:
+                remaining = None
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+            if not self.connections:
+                raise FilemanError("No connection to the server")
+            self.poll(remaining)
+        return True
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+    #--------------------------------------------------------------------------------------------
+    # Requests
+
+    def _file_request(self, request_id, handle, data, connection=None):
+        """
+            Send a request for a file, opening the file on the
+            connection first if it is not open there.
+        """
+        if connection is None:
+            connection = self._connection()
+        spec = self._files[int(handle)]
+        server_handle = connection.handles.get(spec)
+        if server_handle is None:
+            server_handle = connection.handles[spec] = self._send(connection, "get_file", None,
+                dict(name=spec[0], internal=spec[1], fieldnames=spec[2] and list(spec[2]),
+                    fieldids=spec[3] and list(spec[3]))).then(lambda rv: rv['handle'])
+            def opened(pending):
+                if pending._error is None:
+                    connection.handles[spec] = pending._value
+                else:
+                    del connection.handles[spec]
+            server_handle.add_done_callback(opened)
+        if isinstance(server_handle, Pending):
+            # pipelined behind the get_file
+            return server_handle.then(lambda server_handle:
+                self._send(connection, request_id, server_handle, data))
+        return self._send(connection, request_id, server_handle, data)
+
+    def get_file(self, name, internal=True, fieldnames=None, fieldids=None):
+        """
+            A Pending for a handle for the file, valid on every connection.
+        """
+        spec = (name, internal, fieldnames and tuple(fieldnames), fieldids and tuple(fieldids))
+        handle = self._file_keys.get(spec)
+        if handle is None:
+            self._files.append(spec)
+            handle = self._file_keys[spec] = str(len(self._files) - 1)
+        # open it now, so a missing file is reported here
+        return self._file_request("dbsfile_fileid", handle, None).then(lambda fileid: handle)
+
+    def get(self, handle, rowid, asdict=False, fields=None):
+        return self._file_request("dbsfile_get", handle, dict(rowid=rowid, asdict=asdict, fields=fields))
+
+    def get_many(self, handle, rowids, asdict=False, fields=None):
+        return self._file_request("dbsfile_get_many", handle, dict(rowids=rowids, asdict=asdict,
+            fields=fields))
+
+    def insert(self, handle, **kwargs):
+        return self._file_request("dbsfile_insert", handle, kwargs)
+
+    def update(self, handle, **kwargs):
+        return self._file_request("dbsfile_update", handle, kwargs)
+
+    def delete(self, handle, _rowid=None, filters=None):
+        return self._file_request("dbsfile_delete", handle, dict(filters=filters, _rowid=_rowid))
+
+    def count(self, handle, limit=None):
+        return self._file_request("dbsfile_count", handle, dict(limit=limit))
+
+    def _cursor(self, connection, convert, asdict, fetch_size):
+        def opened(rv):
+            return AsyncCursor(self, connection, rv['cursor'], rv['fieldnames'],
+                convert, asdict, fetch_size)
+        return opened
+
+    def query(self, handle, limit=100, offset=None, asdict=False, filters=None, order_by=None,
+            continuation=None, fetch_size=None, fields=None):
+        """
+            A Pending for an AsyncCursor over the query results.
+        """
+        connection = self._connection()
+        return self._file_request("dbsfile_query_open", handle,
+            dict(limit=limit, offset=offset, filters=filters, order_by=order_by,
+                continuation=continuation, fields=fields), connection).then(
+            self._cursor(connection, connection.client._query_row, asdict,
+                fetch_size or (limit and min(limit, FETCH_SIZE))))
+
+    def traverser(self, handle, index, from_value=None, to_value=None, ascending=True,
+            from_rule=None, to_rule=None, raw=False, limit=100, offset=None, asdict=False,
+            filters=None, order_by=None, continuation=None, fetch_size=None, fields=None):
+        """
+            A Pending for an AsyncCursor over the traversal.
+        """
+        connection = self._connection()
+        return self._file_request("dbsfile_traverser_open", handle,
+            dict(index=index, from_value=from_value, to_value=to_value,
+                ascending=ascending, from_rule=from_rule, to_rule=to_rule,
+                raw=raw, limit=limit, offset=offset, filters=filters, order_by=order_by,
+                continuation=continuation, fields=fields), connection).then(
+            self._cursor(connection, connection.client._traverser_row, asdict,
+                fetch_size or (limit and min(limit, FETCH_SIZE))))
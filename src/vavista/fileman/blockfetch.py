@@ -0,0 +1,259 @@
+"""
+    Block fetch from M.
+
+    Every call from Python into GT.M has a fixed cost. Walking
+    a global one $ORDER at a time makes that the dominant cost
+    of a traversal, so the walkers here ask M to visit a block
+    of subscripts in a single call and return them packed into
+    one string. The Python generators drain that buffer before
+    going back to M.
+
+    Packing:
+        $C(1) separates the parts of an item
+        $C(2) terminates an item (index blocks) or starts one (file blocks)
+"""
+
+from vavista import M
+
+from shared import valid_rowid
+
+# Default number of items fetched from M per call.
+BLOCK_SIZE = 100
+
+# A block is closed once the packed string passes this length.
+# It must stay below the size of the string buffer in the M binding.
+# Blocks of records end before a record which would pass it, so only
+# a single record longer than this can make a longer block.
+BLOCK_BYTES = 16000
+
+ITEM_SEP = "\x01"
+ITEM_END = "\x02"
+
+# Walk gl(s0,s1) from (s0,s1), collecting up to s3 (key, rowid) pairs into s2.
+# s4 is a counter. On exit s0, s1 hold the last position visited, s0="" at the end.
+_INDEX_BLOCK = ('set s2="",s4=0 for  quit:s4\'<s3!($length(s2)>%(limit)d)  '
+    'set s1=$order(%(gl)ss0,s1),%(asc)d) set:s1="" s0=$order(%(gl)ss0),%(asc)d) quit:s0=""  '
+    'set:s1\'="" s2=s2_s0_$char(1)_s1_$char(2),s4=s4+1')
+
+# Walk the records gl(s0) from s0, collecting up to s2 rowids into s1.
+# s3 is a counter. Stops at the first subscript which is not a rowid, e.g. an index name.
+_FILE_BLOCK = ('set s1="",s3=0 for  quit:s3\'<s2!($length(s1)>%(limit)d)  '
+    'set s0=$order(%(gl)ss0),%(asc)d) quit:s0=""  quit:(s0\'=+s0)!(s0\'>0)  '
+    'set s3=s3+1,s1=s1_$char(2)_s0')
+
+# The walks which pack records build each record in a buffer, which is
+# added to s1 at the top of the next pass. A record which would take a
+# non-empty block past the limit sets the buffer to $C(3), which ends
+# the block without it, and steps the position back to the last record
+# packed, so the next block starts with it.
+_LAST_PACKED = '$piece($piece(s1,$char(2),$length(s1,$char(2))),$char(1))'
+
+# As _FILE_BLOCK, and pack the first level data nodes of each record after its rowid.
+# s5 is the record buffer.
+_FILE_BLOCK_NODES = ('set s1="",s3=0,s5="" for  quit:s5=$char(3)  '
+    'set:s5\'="" s1=s1_s5,s3=s3+1,s5="" quit:s3\'<s2!($length(s1)>%(limit)d)  '
+    'set s0=$order(%(gl)ss0),%(asc)d) quit:s0=""  quit:(s0\'=+s0)!(s0\'>0)  '
+    'set s5=$char(2)_s0,s4="" for  set s4=$order(%(gl)ss0,s4)) quit:s4=""  '
+    'set:$data(%(gl)ss0,s4))#2 s5=s5_$char(1)_s4_$char(1)_%(gl)ss0,s4) '
+    'if s1\'="",$length(s1)+$length(s5)>%(limit)d set s5=$char(3),s0=' + _LAST_PACKED + ' quit')
+
+# As _FILE_BLOCK_NODES, packing only the data nodes listed in s5, separated by $C(2).
+# s6 is a counter, s7 the record buffer.
+_FILE_BLOCK_LISTED = ('set s1="",s3=0,s7="" for  quit:s7=$char(3)  '
+    'set:s7\'="" s1=s1_s7,s3=s3+1,s7="" quit:s3\'<s2!($length(s1)>%(limit)d)  '
+    'set s0=$order(%(gl)ss0),%(asc)d) quit:s0=""  quit:(s0\'=+s0)!(s0\'>0)  '
+    'set s7=$char(2)_s0,s6=0 for  set s6=s6+1,s4=$piece(s5,$char(2),s6) quit:s4=""  '
+    'set:$data(%(gl)ss0,s4))#2 s7=s7_$char(1)_s4_$char(1)_%(gl)ss0,s4) '
+    'if s1\'="",$length(s1)+$length(s7)>%(limit)d set s7=$char(3),s0=' + _LAST_PACKED + ' quit')
+
+# Read the records gl(rowid) for the s2 rowids packed in s0, packing each existing
+# record into s1 as for _FILE_BLOCK_NODES. s3 counts the rowids consumed, s6 is
+# the record buffer. A record left out of a full block is not counted.
+_RECORDS = ('set s1="",s3=0,s6="" for  quit:s6=$char(3)  '
+    'set:s6\'="" s1=s1_s6,s6="" quit:s3\'<s2!($length(s1)>%(limit)d)  '
+    'set s3=s3+1,s4=$piece(s0,$char(2),s3) if $data(%(gl)ss4)) set s6=$char(2)_s4,s5="" '
+    'for  set s5=$order(%(gl)ss4,s5)) quit:s5=""  '
+    'set:$data(%(gl)ss4,s5))#2 s6=s6_$char(1)_s5_$char(1)_%(gl)ss4,s5) '
+    'if s1\'="",$length(s1)+$length(s6)>%(limit)d set s6=$char(3),s3=s3-1 quit')
+
+# As _RECORDS, packing only the data nodes listed in s6. s7 is a counter,
+# s8 the record buffer.
+_RECORDS_LISTED = ('set s1="",s3=0,s8="" for  quit:s8=$char(3)  '
+    'set:s8\'="" s1=s1_s8,s8="" quit:s3\'<s2!($length(s1)>%(limit)d)  '
+    'set s3=s3+1,s4=$piece(s0,$char(2),s3) if $data(%(gl)ss4)) set s8=$char(2)_s4,s7=0 '
+    'for  set s7=s7+1,s5=$piece(s6,$char(2),s7) quit:s5=""  '
+    'set:$data(%(gl)ss4,s5))#2 s8=s8_$char(1)_s5_$char(1)_%(gl)ss4,s5) '
+    'if s1\'="",$length(s1)+$length(s8)>%(limit)d set s8=$char(3),s3=s3-1 quit')
+
+# Walk the fields ^DD(file,s0) from s0, packing up to s2 fields into s1 as
+# fieldid, ^DD(file,field,0), the title .1 and the help 3. s3 is a counter.
+# Stops at the first subscript which is not a field number.
+_DD_BLOCK = ('set s1="",s3=0 for  quit:s3\'<s2!($length(s1)>%(limit)d)  '
+    'set s0=$order(^DD(%(fileid)s,s0)) quit:s0=""  quit:s0\'=+s0  '
+    'set s3=s3+1,s1=s1_s0_$char(1)_$get(^DD(%(fileid)s,s0,0))_$char(1)_$get(^DD(%(fileid)s,s0,.1))'
+    '_$char(1)_$get(^DD(%(fileid)s,s0,3))_$char(2)')
+
+# $$VFILE^DILFD for the s2 file numbers packed in s0, packed into s1.
+_VFILE_BLOCK = ('set s1="" for s3=1:1:s2 set s1=s1_$$VFILE^DILFD($piece(s0,$char(2),s3))_$char(2)')
+
+def _unpack(block):
+    """
+        Split a packed block into its items, each a list of parts.
+    """
+    return [item.split(ITEM_SEP) for item in block.split(ITEM_END)[:-1]]
+
+def index_block_walk(gl, lastkey="", lastrowid=None, ascending=True, block_size=None):
+    """
+        A generator which walks a traditional index, yielding (key, rowid)
+        pairs in index order.
+
+            gl is the open form of the index, e.g. ^DIZ(999900,"B",
+
+        The walk starts after the position (lastkey, lastrowid).
+        If lastrowid is None, the walk starts at the key after lastkey,
+        if lastrowid is "", it starts at the first rowid within lastkey.
+
+        Range checking is left to the caller. Stopping early costs
+        at most one block of over-fetch.
+    """
+    if block_size is None:
+        block_size = BLOCK_SIZE
+    block_size = max(int(block_size), 1)
+
+    if ascending:
+        asc = 1
+    else:
+        asc = -1
+
+    lastkey = str(lastkey)
+    if lastrowid is None or lastkey == "":
+        # locate the first index value
+        lastkey, = M.mexec("""set s0=$order(%ss0),%d)""" % (gl, asc), M.INOUT(lastkey))
+        lastrowid = ""
+
+    code = _INDEX_BLOCK % {'gl': gl, 'asc': asc, 'limit': BLOCK_BYTES}
+    while lastkey != "":
+        lastkey, lastrowid, block, count = M.mexec(code, M.INOUT(lastkey), M.INOUT(str(lastrowid)),
+            M.INOUT(""), str(block_size), M.INOUT(""))
+        for key, rowid in _unpack(block):
+            yield key, rowid
+
+def file_block_walk(gl, lastrowid="0", ascending=True, block_size=None, prefetch=False, only_nodes=None):
+    """
+        A generator which walks the records of a file in rowid order,
+        yielding (rowid, nodes) pairs.
+
+            gl is the open form of the file, e.g. ^DIZ(999900,
+
+        The walk starts after lastrowid, "%" walks down from the last
+        record of the file. If prefetch is set, nodes is a
+        dictionary of the first level data nodes of the record, i.e.
+        {"0": "NAME^TEXT"}, fetched in the same call as the rowid,
+        otherwise nodes is None. If only_nodes is given, only those
+        data nodes are fetched.
+    """
+    if block_size is None:
+        block_size = BLOCK_SIZE
+    block_size = max(int(block_size), 1)
+
+    if ascending:
+        asc = 1
+    else:
+        asc = -1
+
+    listed = []
+    if prefetch and only_nodes is not None:
+        code = _FILE_BLOCK_LISTED % {'gl': gl, 'asc': asc, 'limit': BLOCK_BYTES}
+        listed = [ITEM_END.join(only_nodes), M.INOUT(""), M.INOUT("")]
+    elif prefetch:
+        code = _FILE_BLOCK_NODES % {'gl': gl, 'asc': asc, 'limit': BLOCK_BYTES}
+        listed = [M.INOUT("")]
+    else:
+        code = _FILE_BLOCK % {'gl': gl, 'asc': asc, 'limit': BLOCK_BYTES}
+
+    lastrowid = str(lastrowid)
+    while 1:
+        lastrowid, block = M.mexec(code, M.INOUT(lastrowid), M.INOUT(""),
+            str(block_size), M.INOUT(""), M.INOUT(""), *listed)[:2]
+        items = [item.split(ITEM_SEP) for item in block.split(ITEM_END)[1:]]
+        for item in items:
+            if prefetch:
+                yield item[0], dict(zip(item[1::2], item[2::2]))
+            else:
+                yield item[0], None
+
+        # A block ending short of lastrowid reached the end of the file.
+        if not items or items[-1][0] != lastrowid or not valid_rowid(lastrowid):
+            break
+
+def fetch_records(gl, rowids, block_size=None, only_nodes=None):
+    """
+        A generator which reads the records of a file by rowid, yielding
+        (rowid, nodes) pairs, as file_block_walk with prefetch set.
+
+            gl is the open form of the file, e.g. ^DIZ(999900,
+
+        The rowids are sent to M block_size at a time. Rowids which
+        do not exist in the file are not returned. If only_nodes is
+        given, only those data nodes are fetched.
+    """
+    if block_size is None:
+        block_size = BLOCK_SIZE
+    block_size = max(int(block_size), 1)
+
+    if only_nodes is not None:
+        code = _RECORDS_LISTED % {'gl': gl, 'limit': BLOCK_BYTES}
+        listed = [ITEM_END.join(only_nodes), M.INOUT(""), M.INOUT("")]
+    else:
+        code = _RECORDS % {'gl': gl, 'limit': BLOCK_BYTES}
+        listed = [M.INOUT("")]
+
+    rowids = [str(rowid) for rowid in rowids]
+    for start in range(0, len(rowids), block_size):
+        chunk = rowids[start:start+block_size]
+        while chunk:
+            block, consumed = M.mexec(code, ITEM_END.join(chunk), M.INOUT(""),
+                str(len(chunk)), M.INOUT(""), M.INOUT(""), M.INOUT(""), *listed)[:2]
+            for item in block.split(ITEM_END)[1:]:
+                item = item.split(ITEM_SEP)
+                yield item[0], dict(zip(item[1::2], item[2::2]))
+            # A large record can close the block early.
+            chunk = chunk[int(consumed):]
+
+def dd_block_walk(fileid, block_size=None):
+    """
+        A generator which walks the field definitions of a file,
+        yielding (fieldid, ^DD(file,field,0), title, help) in field
+        order, as M.ddwalk does one field at a time.
+    """
+    if block_size is None:
+        block_size = BLOCK_SIZE
+    block_size = max(int(block_size), 1)
+
+    code = _DD_BLOCK % {'fileid': fileid, 'limit': BLOCK_BYTES}
+    lastfieldid = "0"
+    while 1:
+        lastfieldid, block, count = M.mexec(code, M.INOUT(lastfieldid), M.INOUT(""),
+            str(block_size), M.INOUT(""))
+        for item in _unpack(block):
+            yield tuple(item)
+        # A short block, not closed by its length, reached the last field.
+        if lastfieldid == "" or (int(count) < block_size and len(block) <= BLOCK_BYTES):
+            break
+
+def vfile_flags(fileids, block_size=None):
+    """
+        $$VFILE^DILFD for each of the file numbers, as a dictionary
+        {fileid: "0" or "1"}, in as few calls as possible.
+    """
+    if block_size is None:
+        block_size = BLOCK_SIZE
+    block_size = max(int(block_size), 1)
+
+    rv = {}
+    fileids = sorted(set([str(fileid) for fileid in fileids]))
+    for start in range(0, len(fileids), block_size):
+        chunk = fileids[start:start+block_size]
+        flags, counter = M.mexec(_VFILE_BLOCK, ITEM_END.join(chunk), M.INOUT(""), str(len(chunk)), M.INOUT(""))
+        rv.update(zip(chunk, flags.split(ITEM_END)))
+    return rv
@@ -4,19 +4,36 @@
     The fileman interface needs to operate in client server mode.
     The API is single threaded, but I want to run from a multi-threaded
     client. Each thread can connect separately to the server
+
+    Queries and traversals are opened as cursors on the server, held in
+    the connection's handle table. The client reads them a page at a
+    time with cursor_fetchmany, so neither side holds the whole result.
+
+    Every frame carries a sequence id, which the server copies to the
+    response. A client can send several requests before reading the
+    responses, or send a group of requests in one batch frame.
+
+    FilemandClientPool shares a bounded set of connections between
+    threads. A connection is checked out for each request, and the
+    file handles opened on a connection are kept for the next checkout.
 """
 
+import contextlib
+import errno
 import json
+import os
 import struct
 import socket
 import select
 import logging
 import datetime
+import threading
 import time
 
 logger = logging.getLogger(__file__)
 
 from shared import FilemanErrorNumber, FilemanError
+import wirecodec
 
 def json_encoder(obj):
     """
@@ -43,23 +60,228 @@ def json_decoder(dct):
         dt = dct['__date__']
         return datetime.datetime.strptime(dt, "%Y-%m-%d")
     elif '__exception__' in dct:
-        if dct["__exception__"] == "FilemanErrorNumber":
-            codes = dct["codes"]
-            texts = dct["texts"]
-            raise FilemanErrorNumber(codes=codes, texts=texts)
-        if dct["__exception__"] == "FilemanError":
-            message = dct["message"]
-            raise FilemanError(message)
+        wirecodec.raise_exception(dct)
     return dct
 
+def json_dumps(value):
+    return json.dumps(value, default=json_encoder)
+
+def json_loads(data):
+    if not isinstance(data, basestring):
+        data = str(data)
+    return json.loads(data, object_hook=json_decoder)
+
+# The codecs for the request and response data, name: (encode, decode).
+# A connection starts with json, set_codec switches it.
+CODECS = {
+    'json': (json_dumps, json_loads),
+    'binary': (wirecodec.dumps, wirecodec.loads),
+}
+
+# Payloads up to this size are copied behind the frame length, so that a
+# frame goes out in one write. The rest of a larger payload is sent from
+# a view of it, rather than copying it.
+SEND_COPY_BYTES = 65536
+
+def _send_all(sock, data):
+    """
+        sendall, restarted after an interrupt without resending data.
+    """
+    view = memoryview(data)
+    sent = 0
+    while sent < len(view):
+        try:
+            sent += sock.send(view[sent:])
+        except socket.error, e:
+            if e.errno != errno.EINTR:
+                raise
+    return sent
+
+# The frame header - length of the frame body, sequence id.
+_FRAME = struct.Struct("!LL")
+
+def send_frame(sock, payload, header="", seq=0):
+    """
+        Send a frame - the 4 byte network order length and 4 byte
+        sequence id, the header (e.g. "request_id:handle:"), then
+        the payload.
+    """
+    _send_all(sock, _FRAME.pack(len(header) + len(payload), seq) + header + payload[:SEND_COPY_BYTES])
+    if len(payload) > SEND_COPY_BYTES:
+        _send_all(sock, memoryview(payload)[SEND_COPY_BYTES:])
+
+def _recv_exact(sock, length, eof=False):
+    """
+        Read length bytes into a new bytearray. If eof is set, None is
+        returned if the connection closes before the first byte.
+    """
+    buf = bytearray(length)
+    view = memoryview(buf)
+    received = 0
+    while received < length:
+        try:
+            count = sock.recv_into(view[received:], length - received)
+        except socket.error, e:
+            if e.errno != errno.EINTR:
+                raise
+            continue
+        if count == 0:
+            if eof and received == 0:
+                return None
+            raise socket.error(errno.ECONNRESET, "Connection closed within a frame")
+        received += count
+    return buf
+
+def recv_frame(sock):
+    """
+        Read a frame, returning (sequence id, body). The body is read
+        into one preallocated bytearray, which the codecs decode in
+        place. Returns None if the connection has closed.
+    """
+    header = _recv_exact(sock, _FRAME.size, eof=True)
+    if header is None:
+        return None
+    length, seq = _FRAME.unpack_from(header)
+    return seq, _recv_exact(sock, length)
+
+class BatchResult:
+    """
+        The response to a request made within FilemandClient.batch().
+        value is the response, or raises the error from the server.
+    """
+    _value = None
+    _error = None
+    done = False
+
+    def set(self, status, value):
+        if status == 'ok':
+            self._value = value
+        else:
+            value["__exception__"] = status
+            self._error = value
+        self.done = True
+
+    @property
+    def value(self):
+        if not self.done:
+            raise FilemanError("The batch has not been sent")
+        if self._error:
+            wirecodec.raise_exception(self._error)
+        return self._value
+
+class Batch:
+    """
+        The requests made within FilemandClient.batch()
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.results = []
+
+    def values(self):
+        """
+            The responses, in request order. Raises the first error.
+        """
+        return [result.value for result in self.results]
+
+# Requests which can not be batched, as the client needs the response at once.
+NOT_BATCHED = set(["connect", "set_codec", "ping", "get_file", "dbsfile_description",
+    "dbsfile_query_open", "dbsfile_traverser_open", "cursor_fetchmany", "cursor_close"])
+
+# Rows requested per round trip from a server side cursor.
+FETCH_SIZE = 100
+
+class RemoteCursor:
+    """
+        The rows of a query or traversal held open on the server.
+        The rows are fetched fetch_size at a time as the caller
+        iterates, so the first row does not wait for the whole result.
+
+        continuation is the token to request the rows after the last
+        page fetched, None at the end of the results. The server cursor
+        is closed when the rows are exhausted, or by close().
+
+        release is called once the server cursor is gone, so a pooled
+        connection can be returned.
+    """
+    release = None
+
+    def __init__(self, client, cursor, fieldnames, convert, asdict=False, fetch_size=None):
+        self.client = client
+        self.cursor = cursor
+        self.fieldnames = fieldnames
+        self.convert = convert
+        self.asdict = asdict
+        self.fetch_size = fetch_size or FETCH_SIZE
+        self.continuation = None
+        self._rows = []
+
+    def _released(self):
+        release, self.release = self.release, None
+        if release is not None:
+            release()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while not self._rows:
+            if self.cursor is None:
+                raise StopIteration
+            try:
+                page = self.client._mk_request("cursor_fetchmany", handle=self.cursor,
+                    data=dict(size=self.fetch_size))
+            except:
+                self.cursor = None
+                self._released()
+                raise
+            self.continuation = page['continuation']
+            if not page['more']:
+                # the server has dropped the cursor
+                self.cursor = None
+                self._released()
+            self._rows = page['rows']
+            self._rows.reverse()
+        rowid, row = self._rows.pop()
+        return self.convert(self.fieldnames, rowid, row, self.asdict)
+
+    def close(self):
+        """
+            Drop the cursor on the server before the rows are exhausted.
+        """
+        if self.cursor is not None:
+            cursor, self.cursor = self.cursor, None
+            self._rows = []
+            try:
+                if self.client.connected:
+                    self.client._mk_request("cursor_close", handle=cursor)
+            finally:
+                self._released()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
 class FilemandClient:
     socket = None
     connected = False
     _connect_data = None
+    codec = 'json'
+    _seq = 0
+    _responses = None
+    _batch = None
+    _file_handles = None
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, codec='json'):
+        """
+            codec is the preferred encoding for the data, see CODECS.
+            The server may only support json.
+        """
         self.host = host
         self.port = port
+        self.preferred_codec = codec
         self._reconnect()
         logger.info("FilemandClient initialised")
 
@@ -67,13 +289,54 @@ class FilemandClient:
         self.socket = clientsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         clientsocket.connect((self.host, self.port))
         self.connected = True
+        self.codec = 'json'
+        self._responses = {}
+        # handles from the previous connection are gone
+        self._file_handles = {}
+        if self.preferred_codec != 'json':
+            self.set_codec(self.preferred_codec)
         if self._connect_data:
             self.connect(**self._connect_data)
 
+    def set_codec(self, codec):
+        """
+            Ask the server to switch the connection to the codec.
+            Returns the codec the server chose, json if it does not
+            support the codec.
+        """
+        self.codec = self._mk_request("set_codec", data=dict(codecs=[codec, 'json']))
+        return self.codec
+
     def _mk_request(self, request_id, handle=None, data=None):
         """
             Send a request to the server
             Wait for the response
+
+            Within batch(), the request is added to the batch, and
+            a BatchResult is returned.
+        """
+        if self._batch is not None:
+            if request_id in NOT_BATCHED:
+                raise FilemanError("The request %s can not be batched" % request_id)
+            result = BatchResult()
+            self._batch.requests.append([request_id, handle, data])
+            self._batch.results.append(result)
+            return result
+
+        return self.read_response(self.send_request(request_id, handle, data))
+
+    def _disconnect(self):
+        try:
+            self.socket.shutdown(1)
+            self.socket.close()
+        except:
+            pass
+        self.connected = False
+
+    def send_request(self, request_id, handle=None, data=None):
+        """
+            Send a request to the server without waiting for the response.
+            Returns the sequence id to pass to read_response.
         """
         logger.debug("request_id:[%s], handle:[%s], data:[%s]", request_id, handle, data)
 
@@ -89,66 +352,118 @@ class FilemandClient:
             if data == None:
                 data = ""
             else:
-                data = json.dumps(data, default=json_encoder)
-
-            payload_len = len(request_id) + len(handle) + len(data) + 2
+                data = CODECS[self.codec][0](data)
 
-            header = struct.pack("!L", payload_len) + '%s:%s:' % (request_id, handle)
-            self.socket.sendall(header)
-            if data != None:
-                self.socket.sendall(data)
+            self._seq = seq = (self._seq + 1) & 0xffffffff
+            send_frame(self.socket, data, '%s:%s:' % (request_id, handle), seq)
+            return seq
+        except Exception, e:
+            self._disconnect()
+            raise
 
-            length_message = self.socket.recv(4)
-            if len(length_message) == 0:
-                raise Exception("Error, Server terminated the conversation")
+    def read_response(self, seq):
+        """
+            Wait for the response to the request seq. Responses to
+            other requests which arrive first are held until they
+            are asked for.
+        """
+        try:
+            while seq not in self._responses:
+                frame = recv_frame(self.socket)
+                if frame is None:
+                    raise Exception("Error, Server terminated the conversation")
+                self._responses[frame[0]] = frame[1]
+        except Exception, e:
+            self._disconnect()
+            raise
 
-            assert len(length_message) == 4, "Error too few bytes returned from read"
-            length = struct.unpack("!L", length_message)[0]
+        recv_buffer = self._responses.pop(seq)
 
-            if length == 0:
-                return None
+        # To propagate exception from the server to the client.
+        # The exception name is in the __exception__ value in the dict.
+        # raised by the codec
 
-            recv_len  = 0
-            recv_buffer = []
-            while recv_len < length:
-                bufsize = length - recv_len
-                if bufsize > 4096:
-                    bufsize = 4096
-                buffer = self.socket.recv(4096)
-                recv_buffer.append(buffer)
-                recv_len += len(buffer)
-
-            # To propagate exception from the server to the client.
-            # The exception name is in the __exception__ value in the dict.
-            # raised by the json decoder
-
-            if length:
-                recv_buffer = ''.join(recv_buffer)
-                try:
-                    response = json.loads(recv_buffer, object_hook=json_decoder)
-                except:
-                    print recv_buffer
-                    raise
-                return response
-        except Exception, e:
+        if recv_buffer:
             try:
-                self.socket.shutdown(1)
-                self.socket.close()
+                return CODECS[self.codec][1](recv_buffer)
+            except FilemanError:
+                raise
             except:
-                pass
-            self.connected = False
-            raise
+                print recv_buffer
+                self._disconnect()
+                raise
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+            Collect the requests made in the with block, and send them to
+            the server in one frame when the block ends.
+
+                with client.batch() as batch:
+                    client.dbsfile_get(handle, "1", False)
+                    client.dbsfile_get(handle, "2", False)
+                row1, row2 = batch.values()
+
+            Each request returns a BatchResult, filled in when the batch
+            is sent. An error in one request does not stop the others.
+        """
+        if self._batch is not None:
+            raise FilemanError("Batches can not be nested")
+        batch = self._batch = Batch()
+        try:
+            yield batch
+        finally:
+            self._batch = None
+        if batch.requests:
+            responses = self._mk_request("batch", data=dict(requests=batch.requests))
+            for result, (status, value) in zip(batch.results, responses):
+                result.set(status, value)
 
     def connect(self, DUZ=None, DT=None, isProgrammer=None):
         self._connect_data = dict(DUZ=DUZ, DT=DT, isProgrammer=isProgrammer)
+        # the server drops its handles on connect
+        self._file_handles = {}
         return self._mk_request("connect", data = dict(DUZ=DUZ, DT=DT, isProgrammer=isProgrammer))
 
+    def ping(self):
+        """
+            Check the server is responding on this connection.
+        """
+        return self._mk_request("ping") == "pong"
+
+    def resident_dds(self):
+        """
+            The data dictionaries held by the server process on this
+            connection, see FilemandServer.cmd_resident_dds.
+        """
+        return self._mk_request("resident_dds")
+
     def list_files(self):
         return self._mk_request("list_files")
 
     def get_file(self, name=None, internal=True, fieldnames=None, fieldids=None):
         return self._mk_request("get_file", data = dict(name=name, internal=internal, fieldnames=fieldnames, fieldids=fieldids))
 
+    def file_handle(self, name, internal=True, fieldnames=None, fieldids=None):
+        """
+            The handle for a file on this connection. The file is opened
+            once per connection, and the handle kept for later calls.
+        """
+        key = (name, internal, fieldnames and tuple(fieldnames), fieldids and tuple(fieldids))
+        if self._file_handles is None:
+            self._file_handles = {}
+        handle = self._file_handles.get(key)
+        if handle is None:
+            # get_file can not be batched, so is sent ahead of a batch
+            batch, self._batch = self._batch, None
+            try:
+                handle = self.get_file(name=name, internal=internal, fieldnames=fieldnames,
+                        fieldids=fieldids)['handle']
+            finally:
+                self._batch = batch
+            self._file_handles[key] = handle
+        return handle
+
     def dbsfile_description(self, handle):
         from shared import STRING, ROWID
         rv = []
@@ -164,8 +479,13 @@ class FilemandClient:
     def dbsfile_fm_description(self, handle):
         return self._mk_request("dbsfile_fm_description", handle=handle)
 
-    def dbsfile_get(self, handle, rowid, asdict):
-        return self._mk_request("dbsfile_get", handle=handle, data=dict(rowid=rowid, asdict=asdict))
+    def dbsfile_get(self, handle, rowid, asdict, fields=None):
+        return self._mk_request("dbsfile_get", handle=handle, data=dict(rowid=rowid, asdict=asdict,
+            fields=fields))
+
+    def dbsfile_get_many(self, handle, rowids, asdict, fields=None):
+        return self._mk_request("dbsfile_get_many", handle=handle, data=dict(rowids=rowids, asdict=asdict,
+            fields=fields))
 
     def dbsfile_update(self, handle, **kwargs):
         return self._mk_request("dbsfile_update", handle=handle, data=kwargs)
@@ -186,29 +506,39 @@ class FilemandClient:
             data=dict(filters=filters, _rowid=_rowid))
 
     def dbsfile_traverser(self, handle, index, from_value, to_value, ascending,
-            from_rule, to_rule, raw, limit, offset, asdict, filters, order_by):
-        fieldnames, rows = self._mk_request("dbsfile_traverser", handle=handle,
+            from_rule, to_rule, raw, limit, offset, asdict, filters, order_by, continuation=None,
+            fetch_size=None, fields=None):
+        rv = self._mk_request("dbsfile_traverser_open", handle=handle,
             data = dict(index=index, from_value=from_value, to_value=to_value, 
                 ascending=ascending, from_rule=from_rule, to_rule=to_rule, 
-                raw=raw, limit=limit, offset=offset, filters=filters, order_by=order_by))
-        for rowid, row in rows:
-            if asdict:
-                row = dict(zip(fieldnames, row))
+                raw=raw, limit=limit, offset=offset, filters=filters, order_by=order_by,
+                continuation=continuation, fields=fields))
+        return RemoteCursor(self, rv['cursor'], rv['fieldnames'], self._traverser_row, asdict,
+            fetch_size or (limit and min(limit, FETCH_SIZE)))
+
+    def _traverser_row(self, fieldnames, rowid, row, asdict):
+        if asdict:
+            row = dict(zip(fieldnames, row))
+            row['_rowid'] = rowid
+        return row
+
+    def dbsfile_query(self, handle, limit, offset, asdict, filters, order_by, continuation=None,
+            fetch_size=None, fields=None):
+        rv = self._mk_request("dbsfile_query_open", handle=handle,
+            data = dict(limit=limit, offset=offset, filters=filters, order_by=order_by,
+                continuation=continuation, fields=fields))
+        return RemoteCursor(self, rv['cursor'], rv['fieldnames'], self._query_row, asdict,
+            fetch_size or (limit and min(limit, FETCH_SIZE)))
+
+    def _query_row(self, fieldnames, rowid, row, asdict):
+        if asdict:
+            row = dict(zip(fieldnames, row))
+            if type(rowid) == list:
+                row['_rowid'] = ",".join(rowid)
+                row['_parentid'] = ",".join(rowid[:-1])
+            else:
                 row['_rowid'] = rowid
-            yield row
-
-    def dbsfile_query(self, handle, limit, offset, asdict, filters, order_by):
-        fieldnames, rows = self._mk_request("dbsfile_query", handle=handle,
-            data = dict(limit=limit, offset=offset, filters=filters, order_by=order_by))
-        for rowid, row in rows:
-            if asdict:
-                row = dict(zip(fieldnames, row))
-                if type(rowid) == list:
-                    row['_rowid'] = ",".join(rowid)
-                    row['_parentid'] = ",".join(rowid[:-1])
-                else:
-                    row['_rowid'] = rowid
-            yield row
+        return row
 
     def dbsfile_count(self, handle, limit):
         return self._mk_request("dbsfile_count", handle=handle,
@@ -222,6 +552,325 @@ class FilemandClient:
             self.socket.shutdown(1)
             self.socket.close()
 
+class FilemandClientPool:
+    """
+        A bounded pool of FilemandClient connections, shared between
+        threads. It offers the calls of a FilemandClient, so it can be
+        used in place of one, e.g. by DBS(remote=True, pool=...).
+
+        Each call checks a connection out for the duration of the
+        request. A connection idle for more than ping_interval seconds
+        is pinged before reuse, and replaced if it does not answer.
+        When all size connections are in use, a call waits up to
+        timeout seconds for one to be returned.
+
+        get_file returns a handle for the pool; the file is opened on
+        each connection when first used there, and the connection keeps
+        the server handle for later checkouts.
+
+        A cursor keeps its connection until it is exhausted or closed.
+        A lock keeps the connection with the thread until the matching
+        unlock, as M locks belong to the server process. connection()
+        and batch() hold one connection for a block of calls.
+
+        Each connection remembers the user it was connected as. The
+        calls made on the pool are made as the user given to connect().
+        user() returns the calls of the pool made as another user, so
+        that one pool can be shared by DBS instances for several users.
+        A connection last used by another user is connected again as
+        the caller before it is handed out.
+    """
+    client_class = FilemandClient
+
+    def __init__(self, host, port, size=4, codec='json', timeout=30, ping_interval=30):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.codec = codec
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self._connect_data = None
+        self._files = []
+        self._file_keys = {}
+        self._idle = []    # (client, time returned)
+        self._open = 0
+        self._lock = threading.Condition()
+        self._local = threading.local()
+
+    def _new_client(self):
+        return self.client_class(self.host, self.port, codec=self.codec)
+
+    def checkout(self, connect_data=None):
+        """
+            A connection for the exclusive use of the caller, to be given
+            back with checkin(). It is connected as the user connect_data,
+            by default the user of the pool.
+        """
+        if connect_data is None:
+            connect_data = self._connect_data
+        deadline = self.timeout is not None and time.time() + self.timeout
+        self._lock.acquire()
+        try:
+            while 1:
+                if self._idle:
+                    # prefer a connection already connected as this user
+                    matching = [i for i, (client, returned) in enumerate(self._idle)
+                        if client._connect_data == connect_data]
+                    if matching:
+                        client, returned = self._idle.pop(matching[-1])
+                    else:
+                        client, returned = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    client = None
+                    break
+                if deadline is False:
+                    self._lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise FilemanError("No filemand connection available after %s seconds" % self.timeout)
+                    self._lock.wait(remaining)
+        finally:
+            self._lock.release()
+
+        try:
+            if client is not None and (time.time() - returned > self.ping_interval
+                    or select.select([client.socket], [], [], 0)[0]):
+                # an idle connection is only readable if the server closed it
+                try:
+                    client.ping()
+                except Exception:
+                    logger.info("Pooled connection failed health check, replacing it")
+                    client._disconnect()
+                    client = None
+            if client is None:
+                client = self._new_client()
+            if connect_data and client._connect_data != connect_data:
+                client.connect(**connect_data)
+        except:
+            if client is not None and client.connected:
+                client._disconnect()
+            self._discard()
+            raise
+        return client
+
+    def checkin(self, client):
+        """
+            Return a connection to the pool. A connection which has
+            failed is closed and dropped.
+        """
+        if not client.connected:
+            self._discard()
+            return
+        self._lock.acquire()
+        try:
+            self._idle.append((client, time.time()))
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def _discard(self):
+        self._lock.acquire()
+        try:
+            self._open -= 1
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """
+            Close the idle connections.
+        """
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        finally:
+            self._lock.release()
+        for client, returned in idle:
+            client._disconnect()
+
+    def _pinned(self, connect_data):
+        """
+            The connection held by this thread, if it is connected as the user.
+        """
+        client = getattr(self._local, 'client', None)
+        if client is not None and client._connect_data == (connect_data or self._connect_data):
+            return client
+        return None
+
+    @contextlib.contextmanager
+    def connection(self, connect_data=None):
+        """
+            Hold one connection for the calls made by this thread
+            in the with block.
+        """
+        client = self._pinned(connect_data)
+        if client is not None:
+            yield client
+            return
+        held = getattr(self._local, 'client', None)
+        client = self._local.client = self.checkout(connect_data)
+        try:
+            yield client
+        finally:
+            self._local.client = held
+            self.checkin(client)
+
+    @contextlib.contextmanager
+    def batch(self, connect_data=None):
+        """
+            As FilemandClient.batch(), on one connection.
+        """
+        with self.connection(connect_data) as client:
+            with client.batch() as batch:
+                yield batch
+
+    def connect(self, DUZ=None, DT=None, isProgrammer=None):
+        """
+            Set the user for the calls made on the pool.
+        """
+        self._connect_data = dict(DUZ=DUZ, DT=DT, isProgrammer=isProgrammer)
+        return ""
+
+    def user(self, DUZ=None, DT=None, isProgrammer=None):
+        """
+            The calls of the pool, made as this user.
+        """
+        return FilemandPoolUser(self, DUZ=DUZ, DT=DT, isProgrammer=isProgrammer)
+
+    def list_files(self, connect_data=None):
+        with self.connection(connect_data) as client:
+            return client.list_files()
+
+    def get_file(self, name=None, internal=True, fieldnames=None, fieldids=None, connect_data=None):
+        """
+            A handle for the file, valid on every connection of the pool.
+        """
+        spec = (name, internal, fieldnames and tuple(fieldnames), fieldids and tuple(fieldids))
+        self._lock.acquire()
+        try:
+            handle = self._file_keys.get(spec)
+            if handle is None:
+                self._files.append(spec)
+                handle = self._file_keys[spec] = len(self._files) - 1
+        finally:
+            self._lock.release()
+        with self.connection(connect_data) as client:
+            # fail here if the file is not there
+            client.file_handle(*spec)
+        return {'handle': str(handle)}
+
+    def _call(self, method, handle, connect_data, *args, **kwargs):
+        """
+            Make a dbsfile_ request on a checked out connection, after
+            mapping the pool's file handle to the connection's.
+        """
+        pinned = self._pinned(connect_data)
+        if pinned is None and getattr(self._local, 'client', None) is not None:
+            raise FilemanError("This thread holds a pooled connection as another user")
+        client = pinned or self.checkout(connect_data)
+        keep = False
+        try:
+            server_handle = client.file_handle(*self._files[int(handle)])
+            rv = getattr(client, method)(server_handle, *args, **kwargs)
+            if isinstance(rv, RemoteCursor) and not pinned:
+                # the cursor gives the connection back when it is done
+                rv.release = lambda: self.checkin(client)
+                keep = True
+            elif method == "dbsfile_lock":
+                # locks only count while they are what pins the connection
+                if not pinned:
+                    self._local.client = client
+                    self._local.locks = 1
+                    keep = True
+                elif getattr(self._local, 'locks', 0):
+                    self._local.locks += 1
+            elif method == "dbsfile_unlock" and getattr(self._local, 'locks', 0):
+                self._local.locks -= 1
+                if self._local.locks == 0:
+                    self._local.client = None
+                    pinned = None
+            return rv
+        finally:
+            if not pinned and not keep:
+                self.checkin(client)
+
+    def __getattr__(self, name):
+        if name.startswith("dbsfile_"):
+            return lambda handle, *args, **kwargs: self._call(name, handle, None, *args, **kwargs)
+        raise AttributeError(name)
+
+class FilemandPoolUser:
+    """
+        The calls of a FilemandClientPool made as one user.
+        See FilemandClientPool.user().
+    """
+
+    def __init__(self, pool, DUZ=None, DT=None, isProgrammer=None):
+        self.pool = pool
+        self.connect(DUZ=DUZ, DT=DT, isProgrammer=isProgrammer)
+
+    def connect(self, DUZ=None, DT=None, isProgrammer=None):
+        self._connect_data = dict(DUZ=DUZ, DT=DT, isProgrammer=isProgrammer)
+        return ""
+
+    def connection(self):
+        return self.pool.connection(self._connect_data)
+
+    def batch(self):
+        return self.pool.batch(self._connect_data)
+
+    def list_files(self):
+        return self.pool.list_files(self._connect_data)
+
+    def get_file(self, name=None, internal=True, fieldnames=None, fieldids=None):
+        return self.pool.get_file(name=name, internal=internal, fieldnames=fieldnames, fieldids=fieldids,
+            connect_data=self._connect_data)
+
+    def __getattr__(self, name):
+        if name.startswith("dbsfile_"):
+            return lambda handle, *args, **kwargs: self.pool._call(name, handle, self._connect_data,
+                *args, **kwargs)
+        raise AttributeError(name)
+
+class ServerCursor:
+    """
+        A query or traversal held open by the server between
+        fetchmany requests. It lives in the connection's handle table.
+    """
+
+    def __init__(self, dbsfile, iterator, limit=None, traverser=False):
+        self.dbsfile = dbsfile
+        self.ext_filename = dbsfile.ext_filename
+        self.iterator = iterator
+        self.limit = limit and int(limit) or None
+        self.traverser = traverser
+        self.returned = 0
+        self.done = False
+
+    def fetchmany(self, size):
+        """
+            The next size [rowid, row] pairs. done is set once the
+            results are exhausted.
+        """
+        rows = []
+        while not self.done and len(rows) < size:
+            try:
+                row = self.iterator.next()
+            except StopIteration:
+                self.done = True
+                break
+            if self.traverser:
+                row = [self.iterator.rowid, row]
+            rows.append(row)
+            self.returned += 1
+            if self.limit and self.returned >= self.limit:
+                self.done = True
+        return rows
+
 class FilemandServer:
     """
         Simple server - will receive requests from a client and serve them
@@ -229,9 +878,20 @@ class FilemandServer:
     dbs = None
     handles = None
     rowcount = None
+    codec = 'json'
+    _next_codec = None
+    requests = 0
+    locks = 0
 
-    def __init__(self, socket):
+    def __init__(self, socket, recycle=None):
+        """
+            recycle, if given, is called with the number of requests
+            served after each request. When it returns True, the
+            connection is closed as soon as it holds no cursors or
+            locks, and the client reconnects to a fresh worker.
+        """
         self.socket = socket
+        self.recycle = recycle
         logger.info("FilemandServer initialised")
 
     def __call__(self):
@@ -240,12 +900,17 @@ class FilemandServer:
 
             Request Protocol:
                 4 byte network format integer
+                4 byte network format sequence id
                 request followed by :
                 handle followed by :
                 data (json encoded)
             Response
                 4 byte network format integer
+                4 byte network format sequence id, from the request
                 data (json encoded)
+
+            The data is encoded by the connection's codec, json until
+            the client asks for another with set_codec.
         """
         self.socket.setblocking(1)
         # TODO SO_REUSEADDR
@@ -259,85 +924,52 @@ class FilemandServer:
                 except Exception, e:
                     continue
 
-                length_message = self.socket.recv(4)
+                frame = recv_frame(self.socket)
 
-                if len(length_message) == 0:
+                if frame is None:
                     logger.info("Zero length message received, shutting down")
                     self.socket.shutdown(1)
                     self.socket.close()
                     return
 
-                assert len(length_message) == 4, "Error too few bytes returned from read"
-                length = struct.unpack("!L", length_message)[0]
-                assert length > 0, "A zero length frame was received"
-
-                recv_buffer = []
-                recv_len = 0
-                while recv_len < length:
-                    bufsize = length - recv_len
-                    if bufsize > 4096:
-                        bufsize = 4096
-                    try:
-                        buffer = self.socket.recv(4096)
-                    except socket.error, e:
-                        if e.errno != 4:
-                            raise e
-                        buffer = ""
-                    recv_buffer.append(buffer)
-                    recv_len += len(buffer)
-                recv_buffer = ''.join(recv_buffer)
-
-                # TODO: can avoid a copy here
-                request_id, handle, request = recv_buffer.split(':', 2)
-
-                if handle:
-                    dbsfile = self.handles[long(handle)]
-                    filename = dbsfile.ext_filename+", "
-                else:
-                    filename = ""
-                logger.debug("request: %s(%s%s)", request_id, filename, request)
+                seq, recv_buffer = frame
+                self.requests += 1
 
-                fn = getattr(self, "cmd_" + request_id)
-                assert fn, "Unknown request [%s] received" % request_id
+                assert len(recv_buffer) > 0, "A zero length frame was received"
+
+                # The data is left in the receive buffer for the codec
+                request_end = recv_buffer.find(':')
+                handle_end = recv_buffer.find(':', request_end + 1)
+                request_id = str(recv_buffer[:request_end])
+                handle = str(recv_buffer[request_end + 1:handle_end])
+                request = buffer(recv_buffer, handle_end + 1)
 
-                timeStart = time.time()
-                self.rowcount = None
                 try:
                     if request:
-                        response = fn(handle, json.loads(request))
-                    else:
-                        response = fn(handle)
-
-                    if self.rowcount != None:
-                        rc = "returned %d rows, " % self.rowcount
+                        request = CODECS[self.codec][1](request)
                     else:
-                        rc = ""
-                    logger.debug("request: %s(%s%s) %stook %f seconds",
-                        request_id, filename, request, rc, time.time() - timeStart)
-
-                except FilemanErrorNumber, e:
-                    logger.exception("request [%s], raised a FilemanErrorNumber", request_id)
-                    response = {"__exception__": "FilemanErrorNumber", "codes": e.codes, "texts": e.texts}
+                        request = None
                 except FilemanError, e:
-                    logger.exception("request [%s], raised a FilemanError", request_id)
                     response = {"__exception__": "FilemanError", "message": e.message()}
+                else:
+                    response = self._dispatch(request_id, handle, request)
 
+                # Interrupts happen, GT.M being clever. send_frame restarts the write.
                 if response == None:
-                    while 1:
-                        # I am putting this in a loop because interrupts are
-                        # happening GT.M being clever.
-                        try:
-                            self.socket.sendall(struct.pack("!L", 0))
-                        except socket.error, e:
-                            if e.errno != 4:
-                                raise e
-                            continue
-                        break
+                    send_frame(self.socket, "", seq=seq)
                 else:
-                    response = json.dumps(response, default=json_encoder)
-                    length = struct.pack("!L", len(response))
-                    self.socket.sendall(length)
-                    self.socket.sendall(response)
+                    send_frame(self.socket, CODECS[self.codec][0](response), seq=seq)
+
+                if self._next_codec:
+                    # set_codec is answered in the old codec
+                    self.codec, self._next_codec = self._next_codec, None
+
+                if self.recycle and self._idle() and self.recycle(self.requests):
+                    logger.info("Closing the connection after %d requests, the worker is due to be recycled",
+                        self.requests)
+                    self.socket.shutdown(1)
+                    self.socket.close()
+                    return
 
         except Exception, e:
             logger.exception("Exiting due to exception")
@@ -345,7 +977,87 @@ class FilemandServer:
             self.socket.shutdown(1)
             self.socket.close()
 
+    def _idle(self):
+        """
+            True if the connection holds nothing the client would lose
+            on reconnecting - no open cursors or locks.
+        """
+        if self.locks:
+            return False
+        for handle in (self.handles or {}).values():
+            if isinstance(handle, ServerCursor):
+                return False
+        return True
+
+    def _dispatch(self, request_id, handle, request):
+        """
+            Run the handler for a request. Fileman errors are returned
+            as a dictionary {"__exception__": ...}, to be raised by the client.
+        """
+        if handle and long(handle) in self.handles:
+            dbsfile = self.handles[long(handle)]
+            filename = dbsfile.ext_filename+", "
+        else:
+            filename = ""
+        logger.debug("request: %s(%s%s)", request_id, filename, request)
+
+        fn = getattr(self, "cmd_" + request_id)
+        assert fn, "Unknown request [%s] received" % request_id
+
+        timeStart = time.time()
+        self.rowcount = None
+        try:
+            if request is not None:
+                response = fn(handle, request)
+            else:
+                response = fn(handle)
+
+            if self.rowcount != None:
+                rc = "returned %d rows, " % self.rowcount
+            else:
+                rc = ""
+            logger.debug("request: %s(%s%s) %stook %f seconds",
+                request_id, filename, request, rc, time.time() - timeStart)
+
+        except FilemanErrorNumber, e:
+            logger.exception("request [%s], raised a FilemanErrorNumber", request_id)
+            response = {"__exception__": "FilemanErrorNumber", "codes": e.codes, "texts": e.texts}
+        except FilemanError, e:
+            logger.exception("request [%s], raised a FilemanError", request_id)
+            response = {"__exception__": "FilemanError", "message": e.message()}
+        return response
+
     ## These are the actual handlers.
+
+    def cmd_batch(self, handle, request):
+        """
+            Run a group of requests, [request_id, handle, data], in order.
+            Returns a [status, response] for each, the status is "ok",
+            or the name of the exception raised by the request.
+        """
+        rv = []
+        for request_id, handle, data in request['requests']:
+            if request_id == "batch":
+                raise FilemanError("Batches can not be nested")
+            if handle is None:
+                handle = ""
+            response = self._dispatch(request_id, str(handle), data)
+            if type(response) == dict and "__exception__" in response:
+                rv.append([response.pop("__exception__"), response])
+            else:
+                rv.append(["ok", response])
+        return rv
+
+    def cmd_set_codec(self, handle, request):
+        """
+            Switch the connection to the first codec in request['codecs']
+            which the server supports. Returns the codec name.
+        """
+        for codec in request['codecs']:
+            if codec in CODECS:
+                self._next_codec = codec
+                return codec
+        return self.codec
         
     def cmd_connect(self, handle, request):
         """
@@ -360,6 +1072,22 @@ class FilemandServer:
         self.handles = {}
         return ""
 
+    def cmd_ping(self, handle=None, request=None):
+        """
+            Health check from a connection pool.
+        """
+        return "pong"
+
+    def cmd_resident_dds(self, handle=None, request=None):
+        """
+            Admin request - the data dictionaries this process has loaded,
+            e.g. warmed up by a filemand worker, and the DD registry
+            counters.
+        """
+        from vavista.fileman.dbsdd import registry
+        return {'pid': os.getpid(), 'requests': self.requests,
+            'dds': [list(dd) for dd in registry.resident()], 'stats': registry.stats()}
+
     def cmd_list_files(self, handle=None, request=None):
         """
             Return the list of files supported on this server.
@@ -391,7 +1119,13 @@ class FilemandServer:
 
     def cmd_dbsfile_get(self, handle, request):
         dbsfile = self.handles[long(handle)]
-        return dbsfile.get(request['rowid'], asdict=request['asdict'])
+        return dbsfile.get(request['rowid'], asdict=request['asdict'], fields=request.get('fields'))
+
+    def cmd_dbsfile_get_many(self, handle, request):
+        dbsfile = self.handles[long(handle)]
+        rv = dbsfile.get_many(request['rowids'], asdict=request['asdict'], fields=request.get('fields'))
+        self.rowcount = len(rv)
+        return rv
 
     def cmd_dbsfile_update(self, handle, request):
         dbsfile = self.handles[long(handle)]
@@ -403,11 +1137,16 @@ class FilemandServer:
 
     def cmd_dbsfile_lock(self, handle, request):
         dbsfile = self.handles[long(handle)]
-        return dbsfile.lock(_rowid=request['_rowid'], timeout=request['timeout'])
+        # DBSFile.lock raises if the record can not be locked
+        rv = dbsfile.lock(_rowid=request['_rowid'], timeout=request['timeout'])
+        self.locks += 1
+        return rv
 
     def cmd_dbsfile_unlock(self, handle, request):
         dbsfile = self.handles[long(handle)]
-        return dbsfile.unlock(_rowid=request['_rowid'])
+        rv = dbsfile.unlock(_rowid=request['_rowid'])
+        self.locks = max(self.locks - 1, 0)
+        return rv
 
     def cmd_dbsfile_delete(self, handle, request):
         dbsfile = self.handles[long(handle)]
@@ -423,13 +1162,14 @@ class FilemandServer:
         cursor = dbsfile.traverser(index=request['index'], from_value=request['from_value'],
                 to_value=request['to_value'], ascending=request['ascending'],
                 from_rule=request['from_rule'], to_rule=request['to_rule'], raw=request['raw'],
-                offset=request['offset'], filters=request['filters'], order_by=request['order_by'])
+                offset=request['offset'], filters=request['filters'], order_by=request['order_by'],
+                continuation=request.get('continuation'), fields=request.get('fields'))
         for i, row in enumerate(cursor):
             rv.append([cursor.rowid, row])
             if limit and i >= limit-1:
                 break
         self.rowcount = len(rv)
-        return (dbsfile.fieldnames(), rv)
+        return (dbsfile.fieldnames(request.get('fields')), rv, cursor.continuation)
 
     def cmd_dbsfile_count(self, handle, request):
         dbsfile = self.handles[long(handle)]
@@ -441,10 +1181,59 @@ class FilemandServer:
     # filters
     def cmd_dbsfile_query(self, handle, request):
         dbsfile = self.handles[long(handle)]
-        cursor = dbsfile.query(limit=request['limit'], offset=request['offset'], filters=request['filters'], order_by=request['order_by'])
+        cursor = dbsfile.query(limit=request['limit'], offset=request['offset'], filters=request['filters'],
+                order_by=request['order_by'], continuation=request.get('continuation'),
+                fields=request.get('fields'))
         rv = list(cursor)
         self.rowcount = len(rv)
-        return (dbsfile.fieldnames(), rv)
+        return (dbsfile.fieldnames(request.get('fields')), rv, cursor.continuation)
+
+    def _open_cursor(self, dbsfile, iterator, limit, traverser=False, fields=None):
+        cursor = ServerCursor(dbsfile, iterator, limit, traverser)
+        handle = id(cursor)
+        self.handles[handle] = cursor
+        return {'cursor': str(handle), 'fieldnames': dbsfile.fieldnames(fields)}
+
+    def cmd_dbsfile_query_open(self, handle, request):
+        """
+            As dbsfile_query, but the rows are held in a cursor,
+            read with cursor_fetchmany.
+        """
+        dbsfile = self.handles[long(handle)]
+        cursor = dbsfile.query(limit=request['limit'], offset=request['offset'], filters=request['filters'],
+                order_by=request['order_by'], continuation=request.get('continuation'),
+                fields=request.get('fields'))
+        return self._open_cursor(dbsfile, cursor, request['limit'], fields=request.get('fields'))
+
+    def cmd_dbsfile_traverser_open(self, handle, request):
+        """
+            As dbsfile_traverser, but the rows are held in a cursor,
+            read with cursor_fetchmany.
+        """
+        dbsfile = self.handles[long(handle)]
+        cursor = dbsfile.traverser(index=request['index'], from_value=request['from_value'],
+                to_value=request['to_value'], ascending=request['ascending'],
+                from_rule=request['from_rule'], to_rule=request['to_rule'], raw=request['raw'],
+                offset=request['offset'], filters=request['filters'], order_by=request['order_by'],
+                continuation=request.get('continuation'), fields=request.get('fields'))
+        return self._open_cursor(dbsfile, cursor, request['limit'], traverser=True,
+                fields=request.get('fields'))
+
+    def cmd_cursor_fetchmany(self, handle, request):
+        """
+            The next request['size'] rows of a cursor. The cursor is
+            dropped once it is exhausted.
+        """
+        cursor = self.handles[long(handle)]
+        rows = cursor.fetchmany(int(request['size']))
+        self.rowcount = len(rows)
+        if cursor.done:
+            del self.handles[long(handle)]
+        return {'rows': rows, 'more': not cursor.done, 'continuation': cursor.iterator.continuation}
+
+    def cmd_cursor_close(self, handle, request=None):
+        self.handles.pop(long(handle), None)
+        return ""
 
     def cmd_dbsfile_fileid(self, handle, request=None):
         dbsfile = self.handles[long(handle)]
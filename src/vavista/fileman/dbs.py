@@ -13,7 +13,7 @@ from shared import FilemanError
 from dbsdd import DD
 from dbsfile import DBSFile
 
-from clientserver import FilemandClient
+from clientserver import FilemandClient, FilemandClientPool
 
 class DBSFileRemote:
     """
@@ -47,8 +47,11 @@ class DBSFileRemote:
             self._fm_description = self.remote.dbsfile_fm_description(self.handle)
         return self._fm_description
 
-    def get(self, rowid, asdict=False):
-        return self.remote.dbsfile_get(self.handle, rowid, asdict=asdict)
+    def get(self, rowid, asdict=False, fields=None):
+        return self.remote.dbsfile_get(self.handle, rowid, asdict=asdict, fields=fields)
+
+    def get_many(self, rowids, asdict=False, fields=None):
+        return self.remote.dbsfile_get_many(self.handle, rowids, asdict=asdict, fields=fields)
 
     def insert(self, **kwargs):
         return self.remote.dbsfile_insert(self.handle, **kwargs)
@@ -66,23 +69,32 @@ class DBSFileRemote:
         return self.remote.dbsfile_delete(self.handle, _rowid=_rowid, filters=filters)
 
     def traverser(self, index, from_value=None, to_value=None, ascending=True, from_rule=None, to_rule=None,
-            raw=False, limit=100, offset=None, asdict=False, filters=None, order_by=None):
+            raw=False, limit=100, offset=None, asdict=False, filters=None, order_by=None, continuation=None,
+            fields=None):
         return self.remote.dbsfile_traverser(self.handle,
             index, from_value=from_value, to_value=to_value, ascending=ascending,
             from_rule=from_rule, to_rule=to_rule, raw=raw, limit=limit, offset=offset, asdict=asdict,
-            filters=filters, order_by=order_by)
+            filters=filters, order_by=order_by, continuation=continuation, fields=fields)
 
     def count(self, limit=None):
         return self.remote.dbsfile_count(self.handle, limit=limit)
 
-    def query(self, limit=100, offset=None, asdict=False, filters=None, order_by=None):
+    def query(self, limit=100, offset=None, asdict=False, filters=None, order_by=None, continuation=None,
+            fields=None):
         return self.remote.dbsfile_query(self.handle, limit=limit, offset=offset, asdict=asdict,
-            filters=filters, order_by=order_by)
+            filters=filters, order_by=order_by, continuation=continuation, fields=fields)
 
 class DBS(object):
 
-    def __init__(self, DUZ, DT, isProgrammer=False, remote=False, host='', port=9010):
+    def __init__(self, DUZ, DT, isProgrammer=False, remote=False, host='', port=9010, codec='json',
+            pool=None):
         """
+            codec is the encoding asked for on a remote connection, 'json' or 'binary'.
+
+            pool shares connections between threads on a remote connection.
+            It is either a FilemandClientPool, which can be shared by many
+            DBS instances, for any users, or the number of connections for
+            a new pool.
         """
         if DUZ is None:
             self.DUZ = "0"
@@ -95,7 +107,13 @@ class DBS(object):
         self.isProgrammer = isProgrammer and True or False
 
         if remote:
-            self.remote = FilemandClient(host, port)
+            if isinstance(pool, FilemandClientPool):
+                self.remote = pool.user(DUZ=DUZ, DT=DT, isProgrammer=isProgrammer)
+            elif pool:
+                self.remote = FilemandClientPool(host, port, size=pool, codec=codec).user(
+                    DUZ=DUZ, DT=DT, isProgrammer=isProgrammer)
+            else:
+                self.remote = FilemandClient(host, port, codec=codec)
             self.remote.connect(DUZ=DUZ, DT=DT, isProgrammer=isProgrammer)
         else:
             self.remote = None
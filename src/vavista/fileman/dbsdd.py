@@ -103,11 +103,16 @@ Indices (Traditional):
 
 """
 
+import collections
 import datetime
+import re
+import time
 
 from vavista import M
 
 from shared import  FilemanError, valid_rowid
+from blockfetch import dd_block_walk, vfile_flags
+import ddcache
 
 
 #---- [ Data Dictionary ]------------------------------------------------------------------
@@ -196,6 +201,26 @@ class Field(object):
         # Implemented in subclass if required
         pass
 
+    # Attributes which are caches or links to other objects, not part
+    # of the field definition.
+    _snapshot_exclude = ('ownerdd', '_ffile')
+
+    def snapshot(self):
+        """
+            The state of the field, for a DD snapshot.
+        """
+        return dict([(k, v) for k, v in self.__dict__.items() if k not in self._snapshot_exclude])
+
+    @classmethod
+    def restore(cls, state, ownerdd):
+        """
+            Recreate a field from its snapshot, without reading ^DD.
+        """
+        field = cls.__new__(cls)
+        field.__dict__.update(state)
+        field.ownerdd = ownerdd
+        return field
+
     def __str__(self, msgs=[]):
         msgs = [] + msgs
         if self.mandatory: msgs.append("(mandatory)")
@@ -224,8 +249,11 @@ class Field(object):
         rv['fmql_type'] = self.fmql_type
         return rv
 
+    # Set if c_isa needs $$VFILE^DILFD for the file number in the flags.
+    needs_vfile = False
+
     @classmethod
-    def isa(cls, flags):
+    def isa(cls, flags, vfile=None):
         """
             Determine whether the flags spec provided represents that type of Field
 
@@ -233,6 +261,9 @@ class Field(object):
             [*] - field is screened
             [I] - don't know yet - something to do with labs
             [R] - mandatory
+
+            vfile is a dictionary of $$VFILE^DILFD flags by file number,
+            fetched in bulk by the caller, see vfile_flags().
         """
 
         # Strip leading, non-type specific flags
@@ -243,7 +274,7 @@ class Field(object):
             else:
                 break
         
-        return cls.c_isa(flags)
+        return cls.c_isa(flags, vfile)
 
     def pyfrom_internal(self, s):
         return s
@@ -358,7 +389,7 @@ class FieldDatetime(Field):
         return rv
 
     @classmethod
-    def c_isa(cls, flags):
+    def c_isa(cls, flags, vfile=None):
         return flags and flags[0] == 'D'
 
     def pyfrom_internal(self, s):
@@ -471,7 +502,7 @@ class FieldNumeric(Field):
             self.format_info = ts0, ts1
 
     @classmethod
-    def c_isa(cls, flags):
+    def c_isa(cls, flags, vfile=None):
         return flags and flags[0] == 'N'
 
     def pyfrom_internal(self, s):
@@ -528,7 +559,7 @@ class FieldText(Field):
     fmql_type = FT_TEXT
 
     @classmethod
-    def c_isa(cls, flags):
+    def c_isa(cls, flags, vfile=None):
         if len(flags) == 0:
             # name field can be defined without a type.
             return True
@@ -541,7 +572,7 @@ class FieldSet(Field):
         self.details = [i.split(":",1) for i in fieldinfo[2].split(';') if i]
 
     @classmethod
-    def c_isa(cls, flags):
+    def c_isa(cls, flags, vfile=None):
         return flags and flags[0] == 'S'
 
     def validate_insert(self, s, internal=True):
@@ -565,23 +596,30 @@ class FieldWP(Field):
         ('^DD(9999907.02,.01,0)', 'wp2^WL^^0;1^Q'),  # word-wrap
     """
     fmql_type = FT_WP
-    wrapinfo = None
+    needs_vfile = True
+    _wrapinfo = False
 
     @classmethod
-    def c_isa(cls, flags):
+    def c_isa(cls, flags, vfile=None):
         n = leading_number(flags)
         if len(n) > 0:
-            s0, = M.func("$$VFILE^DILFD", n)
+            if vfile is not None and n in vfile:
+                s0 = vfile[n]
+            else:
+                s0, = M.func("$$VFILE^DILFD", n)
             return s0 == "0"
         return False
 
-    def init_type(self, fieldinfo):
-        " Extract the wrap specification "
-        super(FieldWP, self).init_type(fieldinfo)
-        subfileid = leading_number(strip_leading_chars(fieldinfo[1]))
-        if M.Globals["^DD"][subfileid].exists():
-            fs = M.Globals["^DD"][subfileid][".01"][0].value
-            self.wrapinfo = fs.split("^")[1]
+    @property
+    def wrapinfo(self):
+        " The wrap specification, read from the subfile when first used "
+        if self._wrapinfo is False:
+            self._wrapinfo = None
+            subfileid = leading_number(strip_leading_chars(self._fieldinfo[1]))
+            if M.Globals["^DD"][subfileid].exists():
+                fs = M.Globals["^DD"][subfileid][".01"][0].value
+                self._wrapinfo = fs.split("^")[1]
+        return self._wrapinfo
 
     def pyfrom_internal(self, s):
         if s == "":
@@ -645,7 +683,7 @@ class FieldComputed(Field):
     fmql_type = FT_COMPUTED
 
     @classmethod
-    def c_isa(cls, flags):
+    def c_isa(cls, flags, vfile=None):
         return flags and flags[0] == 'C'
 
 class FieldPointer(Field):
@@ -653,7 +691,6 @@ class FieldPointer(Field):
     laygo = True
 
     _ffile = None
-    _dd = None
 
     def describe(self):
         rv = super(FieldPointer, self).describe()
@@ -661,7 +698,7 @@ class FieldPointer(Field):
         return rv
 
     @classmethod
-    def c_isa(cls, flags):
+    def c_isa(cls, flags, vfile=None):
         return flags and flags[0] == 'P'
 
     def init_type(self, fieldinfo):
@@ -675,21 +712,24 @@ class FieldPointer(Field):
         """
             Retrieve a remote record using a Pointer type
         """
-        if self._ffile and not fieldnames:
+        dd = self.dd
+        if self._ffile and self._ffile.dd is dd and not fieldnames:
             ff = self._ffile
         else:
             # cannot use the cached version, as it may not consistent fieldnames
             from vavista.fileman.dbsfile import DBSFile
-            ff = DBSFile(self.dd, internal=internal, fieldnames=fieldnames)
+            ff = DBSFile(dd, internal=internal, fieldnames=fieldnames)
             if not fieldnames:
                 self._ffile = ff
         return ff.get(s)
 
     @property
     def dd(self):
-        if self._dd is None:
-            self._dd = DD(self.foreign_fileid)
-        return self._dd
+        """
+            The DD of the pointed to file. This is looked up in the
+            registry on each use, so the field does not hold it.
+        """
+        return DD(self.foreign_fileid)
 
     def validate_insert(self, s, internal=True):
         """
@@ -738,12 +778,11 @@ class FieldVPointer(Field):
     fmql_type = FT_VPOINTER
 
     # map fieldid to fileid, prompt text, prefix, laygo? ?, openform
-    remotefiles = None
+    _remotefiles = None
 
     # map open form version of file root to prefix
-    of_map = None
+    _of_map = None
     _ffile = None
-    _dd = None
 
     def describe(self):
         rv = super(FieldVPointer, self).describe()
@@ -752,12 +791,28 @@ class FieldVPointer(Field):
         return rv
 
     def init_type(self, fieldinfo):
-        " Extract the remote file specifications "
         super(FieldVPointer, self).init_type(fieldinfo)
-        self.remotefiles = remotefiles = {}
-        self.of_map = of_map = {}
         self._ffile = {}
-        self._dd = {}
+
+    @property
+    def remotefiles(self):
+        if self._remotefiles is None:
+            self._load_remotefiles()
+        return self._remotefiles
+
+    @property
+    def of_map(self):
+        if self._of_map is None:
+            self._load_remotefiles()
+        return self._of_map
+
+    def _load_remotefiles(self):
+        """
+            Extract the remote file specifications. This needs the DD of
+            each remote file, so is left until the field is used.
+        """
+        remotefiles = {}
+        of_map = {}
 
         for remotefileid in [k for k, v in M.Globals["^DD"]["9999923"][1]["V"].keys_with_decendants() if k[0] in "123456789"]:
             spec = M.Globals["^DD"]["9999923"][1]["V"][remotefileid][0].value.split("^")
@@ -770,10 +825,18 @@ class FieldVPointer(Field):
             # remote file information
             remotefiles[spec[3]] = (spec[0], spec[1], spec[2], spec[3], spec[4], open_form)
 
+        self._remotefiles, self._of_map = remotefiles, of_map
+
     @classmethod
-    def c_isa(cls, flags):
+    def c_isa(cls, flags, vfile=None):
         return flags and flags[0] == 'V'
 
+    @classmethod
+    def restore(cls, state, ownerdd):
+        field = super(FieldVPointer, cls).restore(state, ownerdd)
+        field._ffile = {}
+        return field
+
     def pyfrom_internal(self, s):
         if s == "":
             return None
@@ -822,12 +885,11 @@ class FieldVPointer(Field):
         """
         ref, key = s.split(".", 1)
 
-        if ref in self._ffile and not fieldnames:
+        dd = DD(self.remotefiles[ref][0])
+        if ref in self._ffile and self._ffile[ref].dd is dd and not fieldnames:
             ffile = self._ffile[ref]
         else:
             from vavista.fileman.dbsfile import DBSFile
-            foreign_fileid = self.remotefiles[ref][0]
-            dd = DD(foreign_fileid)
             ffile = DBSFile(dd, internal=internal, fieldnames=fieldnames)
             if not fieldnames:
                 self._ffile[ref] = ffile
@@ -837,7 +899,7 @@ class FieldMUMPS(Field):
     fmql_type = FT_MUMPS
 
     @classmethod
-    def c_isa(cls, flags):
+    def c_isa(cls, flags, vfile=None):
         return flags and flags[0] == 'K'
 
     def validate_insert(self, s, internal=True):
@@ -852,7 +914,7 @@ class FieldMUMPS(Field):
 
 class FieldSubfile(Field):
     fmql_type = FT_SUBFILE
-    _dd = None
+    needs_vfile = True
     _subfileid = None
 
     def describe(self):
@@ -863,10 +925,13 @@ class FieldSubfile(Field):
         return rv
 
     @classmethod
-    def c_isa(cls, flags):
+    def c_isa(cls, flags, vfile=None):
         n = leading_number(strip_leading_chars(flags))
         if len(n) > 0:
-            s0, = M.func("$$VFILE^DILFD", n)
+            if vfile is not None and n in vfile:
+                s0 = vfile[n]
+            else:
+                s0, = M.func("$$VFILE^DILFD", n)
             return s0 != "0"
         return False
 
@@ -878,9 +943,10 @@ class FieldSubfile(Field):
 
     @property
     def dd(self):
-        if self._dd is None:
-            self._dd = DD(self.subfileid,  parent_fieldid=self.fieldid)
-        return self._dd
+        """
+            The DD of the subfile, looked up in the registry on each use.
+        """
+        return DD(self.subfileid,  parent_fieldid=self.fieldid)
 
     @property
     def fields(self):
@@ -929,12 +995,37 @@ class FieldSubfile(Field):
 FIELD_TYPES = [FieldText, FieldDatetime, FieldNumeric, FieldSet, FieldWP, FieldPointer,
     FieldVPointer, FieldMUMPS, FieldComputed, FieldSubfile]
 
+# class name -> class, for restoring snapshots
+FIELD_CLASSES = dict([(klass.__name__, klass) for klass in FIELD_TYPES])
+
+# Cross reference set logic which subscripts the index by the value,
+# S ^DIZ(999900,"B",X,DA)="" or S ^DIZ(999900,"B",$E(X,1,30),DA)=""
+_VALUE_KEY = re.compile(r'^S \^[^(]+\((.*,)?"(?P<name>[^"]+)",(X|\$E\(X,1,(?P<length>\d+)\)),DA\)=""$')
+
 class Index(object):
+    """
+        A traditional index. If value_key is set, the index is subscripted
+        by the value of the column, truncated to key_length characters
+        if key_length is set.
+    """
     name = table = columns = None
-    def __init__(self, name, table, columns):
+    value_key = False
+    key_length = None
+    def __init__(self, name, table, columns, value_key=False, key_length=None):
         self.name = name
         self.table = table
         self.columns = columns
+        self.value_key = value_key
+        self.key_length = key_length
+    def set_logic(self, logic):
+        """
+            Look at the set logic of the cross reference, to see
+            whether the index key is the column value.
+        """
+        match = _VALUE_KEY.match(logic or "")
+        if match and match.group('name') == self.name:
+            self.value_key = True
+            self.key_length = match.group('length') and int(match.group('length')) or None
     def __str__(self):
         return "Index(%s) on table %s, columns %s" % (self.name, self.table, self.columns)
     def __unicode__(self):
@@ -979,6 +1070,7 @@ class _DD(object):
     _attrs = None
     parent_dd = None
     parent_fieldid = None
+    _snapshot_tried = False
 
     def __init__(self, filename, parent_dd=None, parent_fieldid=None):
         """
@@ -1062,6 +1154,9 @@ class _DD(object):
 
         """
         if self._indices is None:
+            self._load_snapshot()
+        if self._indices is None:
+            start = time.time()
             i = []
 
             # TODO: this is not right for multi-column keys
@@ -1090,6 +1185,7 @@ class _DD(object):
             # Now trawl the listed columns in the data dictionary, and load their
             # cross references.
             cr_names = {}
+            cr_logic = {}
             for c in columns.keys():
                 idx_root = M.Globals["^DD"][self.fileid][c][1]
                 if not idx_root[0].exists():
@@ -1102,6 +1198,8 @@ class _DD(object):
                             f = cr_names.get(parts[1], list())
                             f.append(c)
                             cr_names[parts[1]] = f
+                            if idx_root[cr_id][1].exists():
+                                cr_logic[parts[1]] = idx_root[cr_id][1].value
 
             # Now, just delete items from the index list if they are not in cr_names
             self._indices = []
@@ -1116,8 +1214,12 @@ class _DD(object):
                                 invalid = True
                                 continue
                         if not invalid:
+                            if len(cr) == 1:
+                                index.set_logic(cr_logic.get(index.name))
                             self._indices.append(index)
 
+            registry.loaded(time.time() - start)
+
         return self._indices
 
     @property
@@ -1164,20 +1266,32 @@ class _DD(object):
             Return information about the dd fields
         """
         if self._fields is None:
+            self._load_snapshot()
+        if self._fields is None:
+            start = time.time()
             M.mset('U', "^") # DBS Calls Require this
             f = self._fields = {}
             attrs = self.fieldnames = {}
-            fieldid = "0"
-            while 1:
-                # Subscript 0 is field description, .1 is the title, 3 is help
-                fieldid, info, title, fieldhelp = M.ddwalk(self._fileid, fieldid)
-                #fieldid, info, title, fieldhelp = M.mexec(
-                #    """set s0=$order(^DD(s2,s0)) Q:s0'=+s0  s s1=$G(^DD(s2,s0,0)),s3=$G(^DD(s2,s0,.1)),s4=$G(^DD(s2,s0,3))""",
-                #    M.INOUT(str(fieldid)), M.INOUT(""), str(self._fileid), M.INOUT(""), M.INOUT(""))
+
+            # Subscript 0 is field description, .1 is the title, 3 is help.
+            # They are read a block of fields at a time.
+            rows = []
+            vfile_numbers = []
+            for fieldid, info, title, fieldhelp in dd_block_walk(self.fileid):
                 if fieldid == "" or fieldid[0] not in "0123456789.":
                     break
-
-                info = info.split("^", 4) 
+                info = info.split("^", 4)
+                rows.append((fieldid, info, title, fieldhelp))
+                # WP and subfile fields are told apart by $$VFILE^DILFD,
+                # which is fetched for all the fields in one call.
+                if len(info) > 1 and info[1]:
+                    cheap = [klass for klass in FIELD_TYPES if not klass.needs_vfile and klass.isa(info[1])]
+                    n = leading_number(strip_leading_chars(info[1]))
+                    if not cheap and n:
+                        vfile_numbers.append(n)
+            vfile = vfile_numbers and vfile_flags(vfile_numbers) or {}
+
+            for fieldid, info, title, fieldhelp in rows:
                 label = self._clean_label(info[0])
                 try:
                     ftype = info[1]
@@ -1186,7 +1300,7 @@ class _DD(object):
                 if ftype:
                     finst = None
                     for klass in FIELD_TYPES:
-                        if klass.isa(ftype):
+                        if klass.isa(ftype, vfile):
                             finst = f[fieldid] = klass(fieldid, label, info)
                             finst.fileid = self.fileid
                             finst.ownerdd = self
@@ -1200,8 +1314,68 @@ class _DD(object):
                 else:
                     assert finst, "FIELD [%s] %s has no fieldspec" % (label, info)
 
+            registry.loaded(time.time() - start)
+            ddcache.save(self)
+
         return self._fields
 
+    def _load_snapshot(self):
+        """
+            Load the fields and indices from the snapshot on disk,
+            if there is a current one. Only tried once.
+        """
+        if self._snapshot_tried:
+            return False
+        self._snapshot_tried = True
+        return ddcache.load(self)
+
+    def snapshot(self):
+        """
+            The fields and indices, to be saved by ddcache.
+        """
+        return {
+            'fileid': self.fileid,
+            'filename': self.filename,
+            'fields': [(fieldid, field.__class__.__name__, field.snapshot())
+                    for fieldid, field in self.fields.items()],
+            'fieldnames': self.fieldnames,
+            'indices': [(index.name, index.table, index.columns, index.value_key, index.key_length)
+                    for index in self.indices],
+            'gl': self.parent_dd is None and self._cache_gl or None,
+        }
+
+    def restore(self, snapshot):
+        """
+            Set the fields and indices from a snapshot.
+        """
+        self._fields = dict([(fieldid, FIELD_CLASSES[klass].restore(state, self))
+                for fieldid, klass, state in snapshot['fields']])
+        self.fieldnames = snapshot['fieldnames']
+        self._indices = [Index(*index) for index in snapshot['indices']]
+        if not self.filename:
+            self.filename = snapshot['filename']
+        if self._cache_gl is None and self.parent_dd is None:
+            self._cache_gl = snapshot['gl']
+
+    def storage_nodes(self, fieldids=None):
+        """
+            Return the record nodes which hold the simple (piece or
+            extract) fields, e.g. ["0", "1"] for storage "0;1", "1;3".
+        """
+        if fieldids is None:
+            fieldids = self.fields.keys()
+        nodes = set()
+        for fieldid in fieldids:
+            field = self.fields.get(fieldid)
+            if field is None or field.fmql_type in [FT_WP, FT_SUBFILE, FT_COMPUTED]:
+                continue
+            if not field.storage or field.storage.find(';') == -1:
+                continue
+            node = field.storage.split(';')[0]
+            if node.strip():
+                nodes.add(node)
+        return sorted(nodes)
+
     def __str__(self):
         rv = ["Data Dictionary for %s (%s)" % (self.filename, self.fileid)]
         for fieldid in sorted(self.fields.keys()):
@@ -1283,42 +1457,190 @@ class _DD(object):
                 txt.append(v)
         return '\n'.join(txt)
 
-def DD(filename=None, parent_dd=None, parent_fieldid=None, subfile_path=None, cache={}):
+class DDRegistry(object):
     """
-        Simple mechanism to cache DD objects.
+        The DDs loaded by this process, by fileid, filename and subfile path.
+
+        At most max_files DDs are held; the least recently used is dropped
+        to make room. A DD is reloaded if ^DD(file,0,"DT") has changed -
+        this is checked when the DD is used, at most once every
+        check_interval seconds.
+
+        Pointer and subfile fields hold the fileid of the DD they refer
+        to, and look it up here on each use, so they do not keep an
+        evicted or changed DD. An open DBSFile keeps the DD it was opened
+        with; get_file() again to see a changed DD.
+
+        hits, misses, evictions and invalidations count the lookups,
+        loads is the number of field or index walks of ^DD, and load_time
+        the seconds spent in them.
+    """
+    max_files = 1000
+    check_interval = 60
+
+    def __init__(self, max_files=None, check_interval=None):
+        if max_files is not None:
+            self.max_files = max_files
+        if check_interval is not None:
+            self.check_interval = check_interval
+        self.clear()
+
+    def clear(self):
+        # id(dd) -> [dd, keys, DT, time DT checked], least recently used first
+        self._entries = collections.OrderedDict()
+        self._keys = {}
+        self.hits = self.misses = self.loads = self.evictions = self.invalidations = 0
+        self.load_time = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _dt(self, fileid):
+        return M.mexec('set s0=$G(^DD(%s,0,"DT"))' % fileid, M.INOUT(""))[0]
+
+    def _lookup(self, key):
+        entry_id = self._keys.get(key)
+        if entry_id is None:
+            return None
+        entry = self._entries[entry_id]
+        dd = entry[0]
+        if dd._fileid and self.check_interval is not None:
+            now = time.time()
+            if now - entry[3] >= self.check_interval:
+                entry[3] = now
+                if self._dt(dd._fileid) != entry[2]:
+                    self.invalidations += 1
+                    self._remove(entry_id)
+                    return None
+        # most recently used
+        del self._entries[entry_id]
+        self._entries[entry_id] = entry
+        return dd
+
+    def _add(self, dd, keys):
+        for key in keys:
+            if key in self._keys:
+                self._remove(self._keys[key])
+        entry_id = id(dd)
+        self._entries[entry_id] = [dd, keys, dd._fileid and self._dt(dd._fileid), time.time()]
+        for key in keys:
+            self._keys[key] = entry_id
+        while self.max_files and len(self._entries) > self.max_files:
+            self.evictions += 1
+            self._remove(self._entries.keys()[0])
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry is not None:
+            for key in entry[1]:
+                if self._keys.get(key) == entry_id:
+                    del self._keys[key]
+
+    def get(self, filename=None, parent_dd=None, parent_fieldid=None, subfile_path=None):
+        """
+            The DD for a file, loading it if it is not held.
+            See DD().
+        """
+        key = subfile_path or filename
+        dd = self._lookup(key)
+
+        if subfile_path:
+            # work out the parent_dd, parent_fieldid
+            path = subfile_path.split('::')
+            parent_dd = self.get(path[0])
+            parent_fieldid = path[-1]
+            for part in path[1:-1]:
+                # intermediate subfiles
+                field = parent_dd.fields[part]
+                parent_dd = field.dd
+
+            filename = parent_dd.fields[parent_fieldid].subfileid
+
+        if dd is None or (parent_dd and parent_fieldid and (dd.parent_dd != parent_dd or parent_fieldid != dd.parent_fieldid)):
+            self.misses += 1
+            dd = _DD(filename, parent_dd=parent_dd, parent_fieldid=parent_fieldid)
+            if subfile_path:
+                keys = [subfile_path]
+            else:
+                keys = set([k for k in (key, dd.fileid, dd.filename) if k])
+            self._add(dd, list(keys))
+        else:
+            self.hits += 1
+        return dd
+
+    def invalidate(self, fileid=None):
+        """
+            Drop the DD for a file, or all DDs.
+        """
+        if fileid is None:
+            self._entries.clear()
+            self._keys.clear()
+            return
+        for entry_id, entry in self._entries.items():
+            if entry[0]._fileid == fileid:
+                self._remove(entry_id)
+
+    def loaded(self, seconds):
+        """
+            Called by a DD when it has walked ^DD.
+        """
+        self.loads += 1
+        self.load_time += seconds
+
+    def resident(self):
+        """
+            The DDs held, as a list of
+            (fileid, filename, fields loaded, indices loaded).
+        """
+        return sorted([(dd._fileid, dd.filename, dd._fields is not None, dd._indices is not None)
+            for dd, keys, dt, checked in self._entries.values()])
+
+    def stats(self):
+        return {'files': len(self), 'hits': self.hits, 'misses': self.misses, 'loads': self.loads,
+            'load_time': self.load_time, 'evictions': self.evictions, 'invalidations': self.invalidations}
+
+registry = DDRegistry()
+
+def DD(filename=None, parent_dd=None, parent_fieldid=None, subfile_path=None):
+    """
+        Return the DD for a file, from the registry.
 
         There is a hack here because I found out late in the day that DD records
         can be shared among subfiles. I pass down a full path to the subfile
         from Django.
     """
-    if filename:
-        dd = cache.get(filename)
-    elif subfile_path:
-        dd = cache.get(subfile_path)
-
-    if subfile_path:
-        # work out the parent_dd, parent_fieldid
-        path = subfile_path.split('::')
-        parent_dd = DD(path[0])
-        parent_fieldid = path[-1]
-        for part in path[1:-1]:
-            # intermediate subfiles
-            field = parent_dd.fields[part]
-            parent_dd = field.dd
-
-        filename = parent_dd.fields[parent_fieldid].subfileid
-
-    if dd is None or (parent_dd and parent_fieldid and (dd.parent_dd != parent_dd or parent_fieldid != dd.parent_fieldid)):
-        file_dd = _DD(filename, parent_dd=parent_dd, parent_fieldid=parent_fieldid)
-        if subfile_path:
-            cache[subfile_path] = file_dd
-        else:
-            cache[file_dd.fileid] = file_dd
-            if file_dd.filename:
-                cache[file_dd.filename] = file_dd
-
-    if subfile_path:
-        return cache[subfile_path]
-    else:
-        return cache[filename]
-    
+    return registry.get(filename, parent_dd=parent_dd, parent_fieldid=parent_fieldid, subfile_path=subfile_path)
+
+def warm_up(filename, pointers=True):
+    """
+        Load the DD for a file, with everything a query on it will need -
+        the fields, indices, the subfile DDs, and the DDs of the files
+        it points to. Pointed to files are loaded, but their pointers
+        are not followed. Returns the number of DDs loaded.
+    """
+    seen = set()
+    def load(dd, pointers):
+        if dd.fileid is None or id(dd) in seen:
+            return
+        seen.add(id(dd))
+        dd.fields, dd.attrs, dd.indices
+        for field in dd.fields.values():
+            if field.fmql_type == FT_SUBFILE and field.subfileid != dd.fileid:
+                load(field.dd, pointers)
+            elif field.fmql_type == FT_POINTER and pointers:
+                load(field.dd, False)
+            elif field.fmql_type == FT_VPOINTER and pointers:
+                for spec in field.remotefiles.values():
+                    load(DD(spec[0]), False)
+    dd = DD(filename)
+    if dd.fileid is None:
+        raise FilemanError("File not found [%s]" % filename)
+    load(dd, pointers)
+    return len(seen)
+
+def resident_dds():
+    """
+        The DDs loaded by this process, as a list of
+        (fileid, filename, fields loaded, indices loaded).
+    """
+    return registry.resident()
@@ -7,20 +7,22 @@
 import logging
 
 from vavista import M
-from shared import FilemanError, valid_rowid
+from shared import FilemanError, valid_rowid, query_digest, encode_continuation, decode_continuation
 
-from dbsrow import DBSRow
+from dbsrow import DBSRow, RecordDecoder, resolve_fields
 
 logger = logging.getLogger(__file__)
 
-from query_planner import make_plan
+from query_planner import make_plan, key_in_range, index_start, file_rows, cache_record, choose_index
+from blockfetch import index_block_walk, file_block_walk, fetch_records
 
 class IndexIterator:
     results = None
+    results_complete = False
 
     def __init__(self, gl_prefix, index, from_value=None, to_value=None, ascending=True,
         from_rule=">=", to_rule="<", raw=False, getter=None, description=None, filters=None,
-        limit=None, offset=None):
+        limit=None, offset=None, block_size=None, digest=None, resume=None):
         """
             An iterator which will traverse an index.
             The iterator should return (key, rowid) pairs.
@@ -32,6 +34,10 @@ class IndexIterator:
             ^DIZ(999900,"B","hello there from unit test2",185)=""
             ^DIZ(999900,"B","record 1",1)=""
 
+            The index is read from M block_size entries at a time.
+
+            resume is a decoded continuation token. The traversal
+            continues after the (key, rowid) it holds, ignoring the offset.
         """
         self.index = index
         self.gl = gl_prefix + '"%s",' % index
@@ -45,6 +51,7 @@ class IndexIterator:
         self.description = description
         self.filters = filters
         self.limit, self.offset = limit, offset
+        self.digest = digest
 
         if self.from_value != None and self.to_value != None:
             if self.ascending:
@@ -52,14 +59,14 @@ class IndexIterator:
             else:
                 assert(self.to_value <= self.from_value)
         
-        if self.from_value is None:
-            if ascending:
-                self.lastkey = " "
-            else:
-                self.lastkey = "ZZZZZZZZZZZZZZ"
+        if resume:
+            self.lastkey, self.lastrowid = resume['key'], resume['rowid']
+            lastrowid = self.lastrowid
+            self.offset = None
         else:
-            self.lastkey = self.from_value
-        self.lastrowid = ""
+            self.lastkey, lastrowid = index_start(self.from_value, self.from_rule)
+            self.lastrowid = ""
+        self._walk = index_block_walk(self.gl, self.lastkey, lastrowid, ascending, block_size)
 
         if self.offset:
             self.skip_rows = int(self.offset)
@@ -76,68 +83,32 @@ class IndexIterator:
     def rowid(self):
         return self.lastrowid
 
-    def next(self):
-        lastkey = self.lastkey
-        lastrowid = self.lastrowid
-        if self.ascending:
-            asc = 1
-        else:
-            asc = -1
+    @property
+    def continuation(self):
+        """
+            A token to continue the traversal after the last row returned,
+            None if the traversal is complete.
+        """
+        if self.results_complete or self.lastrowid == "":
+            return None
+        return encode_continuation(dict(digest=self.digest, index=self.index, ascending=self.ascending,
+            key=self.lastkey, rowid=self.lastrowid))
 
+    def next(self):
         # TODO: Fileman seems to structure indices with keys in the global path
         #       or in the value - need to investigate further
 
         # There is a mad collation approach in M, where numbers sort before non-numbers.
         # this really messes up the keys.
         # How should I search? 
-
-        # There is an inefficiency here it takes three searches to find the next record.
-        while 1:
-            if lastrowid is None:
-                # locate the next matching index value
-                lastkey, = M.mexec("""set s0=$order(%ss0),%s)""" % (self.gl, asc), M.INOUT(str(lastkey)))
-                if lastkey == "":
-                    break
-
-                if self.ascending:
-                    if self.from_value is not None:
-                        if self.from_rule == ">" and lastkey <= self.from_value:
-                            continue
-                        if self.from_rule == ">=" and lastkey < self.from_value:
-                            assert 0
-                    if self.to_value is not None:
-                        if self.to_rule == "<=" and lastkey > self.to_value:
-                            break
-                        if self.to_rule == "=" and lastkey != self.to_value:
-                            break
-                        if self.to_rule == "<" and lastkey >= self.to_value:
-                            break
-                    self.lastkey = lastkey
-                    lastrowid = "0"
-
-                else: # descending
-                    if self.from_value is not None:
-                        if self.from_rule == "<" and lastkey >= self.from_value:
-                            continue
-                        if self.from_rule == "<=" and lastkey > self.from_value:
-                            assert 0
-                    if self.to_value is not None:
-                        if self.to_rule == ">=" and lastkey < self.to_value:
-                            break
-                        if self.to_rule == "=" and lastkey != self.to_value:
-                            break
-                        if self.to_rule == ">" and lastkey <= self.to_value:
-                            break
-                    self.lastkey = lastkey
-                    lastrowid = ""
-
-            # Have the key, get the first matching rowid
-            lastrowid, = M.mexec("""set s0=$order(%s"%s",s1),%d)""" % (self.gl, self.lastkey, asc),
-                    M.INOUT(str(lastkey)), lastrowid)
-            if lastrowid == "":
-                # No match
-                lastrowid = None
+        for lastkey, lastrowid in self._walk:
+            in_range = key_in_range(lastkey, self.ascending, self.from_value, self.from_rule,
+                    self.to_value, self.to_rule)
+            if in_range < 0:
                 continue
+            if in_range > 0:
+                self._walk = iter(())
+                break
 
             if self.filters:
                 # Are filters to be applied?
@@ -148,11 +119,13 @@ class IndexIterator:
                 self.skip_rows -= 1
                 continue
 
+            self.lastkey = lastkey
             self.lastrowid = lastrowid
             if self.raw:
                 return self.lastkey, self.lastrowid
             return self.getter(self.lastrowid)
 
+        self.results_complete = True
         raise StopIteration
 
 class RowIterator:
@@ -161,9 +134,17 @@ class RowIterator:
 
     def __init__(self, gl, from_rowid=None, to_rowid=None, ascending=True,
         from_rule=">=", to_rule="<", raw=False, getter=None, description=None,
-        filters=None, limit=None, offset=None):
+        filters=None, limit=None, offset=None, gl_cache=None, storage_nodes=None, block_size=None,
+        digest=None, resume=None):
         """
             An iterator which will traverse a table
+
+            The rowids are read from M block_size at a time. If storage_nodes
+            is given, the record nodes are read with them and loaded into
+            the gl_cache used by the getter and filters.
+
+            resume is a decoded continuation token. The traversal
+            continues after the rowid it holds, ignoring the offset.
         """
         self.gl = gl
         self.from_rowid = from_rowid
@@ -177,6 +158,13 @@ class RowIterator:
         self.filters = filters
         self.limit = limit
         self.offset = offset
+        self.gl_cache = gl_cache
+        self.storage_nodes = storage_nodes
+        self.block_size = block_size
+        self.digest = digest
+        self._rows = None
+        self._cached_keys = []
+        self._resumed = None
 
         # the new person file has non-integer user ids
         if self.from_rowid != None:
@@ -203,6 +191,10 @@ class RowIterator:
             if self.lastrowid.endswith(".0"):
                 self.lastrowid = self.lastrowid[:-2]
 
+        if resume:
+            self.lastrowid = self._resumed = resume['rowid']
+            self.offset = None
+
         if self.offset:
             self.skip_rows = int(self.offset)
         else:
@@ -212,8 +204,6 @@ class RowIterator:
         if self.limit:
             self.limit = int(self.limit)
 
-        self.first_pass = True
-
     def __iter__(self):
         return self
 
@@ -221,38 +211,31 @@ class RowIterator:
     def rowid(self):
         return self.lastrowid
 
+    @property
+    def continuation(self):
+        """
+            A token to continue the traversal after the last row returned,
+            None if the traversal is complete.
+        """
+        if self.results_complete or (self.results_returned == 0 and self._resumed is None):
+            return None
+        return encode_continuation(dict(digest=self.digest, index=None, ascending=self.ascending,
+            key=None, rowid=self.lastrowid))
+
     def next(self):
 
         # Have we exceeded limit
         if self.limit and self.results_returned >= self.limit:
             raise StopIteration
 
-        lastrowid = self.lastrowid    # This value should be a string throughout. 
-        if self.ascending:
-            asc = 1
-        else:
-            asc = -1
-
-        while not self.results_complete:
-            # If this is the first pass, we may have the id of a record, which needs to 
-            # be verified
-            found = False
-            if self.first_pass:
-                self.first_pass = False
-                if lastrowid is None and asc == -1:
-                    lastrowid, = M.mexec("""set s0=$order(%ss0),-1)""" % self.gl, M.INOUT('%'))
-                    if valid_rowid(lastrowid):
-                        found = True
-                elif lastrowid and float(lastrowid) > 0:
-                    row_exists, = M.mexec("""set s0=$data(%ss0))""" % (self.gl), M.INOUT(lastrowid))
-                    if valid_rowid(row_exists):
-                        found = True
-
-            if not found:
-                lastrowid, = M.mexec("""set s0=$order(%ss0),%d)""" % (self.gl, asc), M.INOUT(lastrowid))
-                if not valid_rowid(lastrowid):
-                    break
+        prefetch = self.gl_cache is not None and self.storage_nodes is not None
+        if self._rows is None:
+            if self._resumed is None:
+                self._rows = file_rows(self.gl, self.lastrowid, self.ascending, self.block_size, prefetch)
+            else:
+                self._rows = file_block_walk(self.gl, self._resumed, self.ascending, self.block_size, prefetch)
 
+        for lastrowid, nodes in self._rows:
             # Check boundary values
             f_lastrowid = float(lastrowid)
             if self.ascending:
@@ -276,6 +259,14 @@ class RowIterator:
                     if f_lastrowid < self.to_rowid and self.to_rule == ">=":
                         break
 
+            if prefetch:
+                for gl_id in self._cached_keys:
+                    self.gl_cache.pop(gl_id, None)
+                self._cached_keys = []
+                if nodes is not None:
+                    self._cached_keys = cache_record(self.gl_cache, "%s%s)" % (self.gl, lastrowid),
+                        nodes, self.storage_nodes)
+
             if self.filters:
                 # Are filters to be applied?
                 if not self.filters(lastrowid):
@@ -294,8 +285,53 @@ class RowIterator:
             return self.getter(self.lastrowid)
 
         self.results_complete = True
+        self._rows = iter(())
         raise StopIteration
 
+class QueryIterator:
+    """
+        The results of DBSFile.query - (rowid, row) pairs, or the plan
+        messages for explain.
+    """
+
+    def __init__(self, dbsfile, plan, gl_cache, position, digest, explain=False, fields=None):
+        self.dbsfile = dbsfile
+        self.plan = plan
+        self.gl_cache = gl_cache
+        self.position = position
+        self.digest = digest
+        self.explain = explain
+        self.fields = fields
+
+    def __iter__(self):
+        return self
+
+    @property
+    def continuation(self):
+        """
+            A token to continue the query after the last row returned.
+            None if the results are complete, or the plan sorts the
+            rows, so there is no traversal position to resume from.
+        """
+        position = self.position
+        if self.explain or not position.get('resumable') or position.get('done') or 'rowid' not in position:
+            return None
+        return encode_continuation(dict(digest=self.digest, traversal=position['traversal'],
+            index=position['index'], ascending=position['ascending'], range=position['range'],
+            key=position['key'], rowid=position['rowid']))
+
+    def next(self):
+        if self.explain:
+            return self.plan.next()
+        row = self.plan.next()
+        rowid, gl_root, rowid_path = row[:3]
+        if len(row) > 3:
+            # index-only scan
+            return rowid, self.dbsfile._index_row(row[3], fields=self.fields)
+        if len(rowid_path) == 1:
+            return rowid, self.dbsfile._get(rowid, gl_cache=self.gl_cache, fields=self.fields)
+        return rowid_path[::2], self.dbsfile._get(rowid_path, gl_cache=self.gl_cache, fields=self.fields)
+
 class DBSFile(object):
     """
         This class provides mechanisms to return rows.
@@ -304,6 +340,9 @@ class DBSFile(object):
 
         The get method should return something approximating a result
         from dbapi.
+
+        The file keeps the DD it was opened with, even if the registry
+        drops or reloads it. Open the file again to see a changed DD.
     """
     dd = None
     internal = True
@@ -313,6 +352,8 @@ class DBSFile(object):
     _fieldnames = None
     _field_cache = None
     _gl_cache = None
+    _decoders = None
+    _projections = None
     ext_filename = None
 
     def __init__(self, dd, internal=True, fieldids=None, fieldnames=None, ext_filename=None):
@@ -328,6 +369,8 @@ class DBSFile(object):
 
         assert (dd.fileid is not None)
         self._field_cache = {}
+        self._decoders = {}
+        self._projections = {}
 
     def __str__(self):
         return "DBSFILE %s (%s)" % (self.dd.filename, self.dd.fileid)
@@ -336,7 +379,9 @@ class DBSFile(object):
     def fileid(self):
         return self.dd.fileid
 
-    def fieldnames(self):
+    def fieldnames(self, fields=None):
+        if fields is not None:
+            return self._projection(fields)[1]
         if self._fieldnames is None:
             # TODO: if only have fieldids, have to look them up
             return self.fieldids
@@ -363,7 +408,7 @@ class DBSFile(object):
             self._fm_description = self.dd.describe(fieldids = self.fieldids)
         return self._fm_description
 
-    def get(self, rowid, asdict=False):
+    def get(self, rowid, asdict=False, fields=None):
         """
             The logic to retrieve and update the row is in the DBSRow class.
             This call constructs a DBSRow class, and verifies that
@@ -373,17 +418,109 @@ class DBSFile(object):
 
             Multiples are a problem. The multiple is returned as a nested
             sequence of sequences.
+
+            fields overrides the projection of the file for this call,
+            as a list of field names or fieldids.
+        """
+        return self._get(rowid, asdict, self._gl_cache, fields=fields)
+
+    def get_many(self, rowids, asdict=False, fields=None):
+        """
+            Retrieve a list of rows, as get(), in one pass.
+
+            The records are read from M in blocks, rather than with
+            a call per row. The result is in the order of rowids.
+            A rowid which does not exist gives None rather than
+            raising an error.
+        """
+        rowids = list(rowids)
+        gl_cache = {}
+        found = set()
+        if self.internal:
+            gl = self.dd.m_open_form()
+            storage_nodes = self._decoder(self._projection(fields)[0]).nodes.keys()
+            simple = [str(rowid) for rowid in rowids if valid_rowid(str(rowid))]
+            for rowid, nodes in fetch_records(gl, simple, only_nodes=storage_nodes):
+                cache_record(gl_cache, "%s%s)" % (gl, rowid), nodes, storage_nodes)
+                found.add(rowid)
+
+        rv = []
+        for rowid in rowids:
+            if str(rowid) in found:
+                rv.append(self._get(str(rowid), asdict, gl_cache, verified=True, fields=fields))
+                continue
+            if self.internal and valid_rowid(str(rowid)):
+                rv.append(None)
+                continue
+            # Subfile paths and external values go through get()
+            try:
+                rv.append(self._get(rowid, asdict, gl_cache, fields=fields))
+            except FilemanError:
+                rv.append(None)
+        return rv
+
+    def _get(self, rowid, asdict=False, gl_cache=None, verified=False, fields=None):
+        """
+            get() reading the record through the given gl_cache
         """
-        record = DBSRow(self, self.dd, rowid, fieldids=self.fieldids, internal=self.internal)
+        fieldids, fieldnames = self._projection(fields)
+        record = DBSRow(self, self.dd, rowid, fieldids=fieldids, internal=self.internal)
         if self.internal:
-            record.raw_retrieve(self._gl_cache)
+            record.raw_retrieve(gl_cache, self._decoder(fieldids), verified)
         else:
             record.retrieve()
         if asdict:
-            return dict(zip(self.fieldnames(), record.as_list()))
+            return dict(zip(fieldnames, record.as_list()))
         else:
             return record.as_list()
 
+    def _index_row(self, values, fields=None):
+        """
+            The row for the values read from an index key, as get()
+            would read from the record.
+        """
+        fieldids = self._projection(fields)[0]
+        return tuple([self.dd.fields[fieldid].pyfrom_internal(values[fieldid]) for fieldid in fieldids])
+
+    def _projection(self, fields=None):
+        """
+            The (fieldids, fieldnames) of a per-call projection. fields are
+            field names or fieldids. None is the projection the file was
+            opened with.
+        """
+        if fields is None:
+            return self.fieldids, self.fieldnames()
+        key = tuple(fields)
+        projection = self._projections.get(key)
+        if projection is None:
+            fieldids, fieldnames = [], []
+            for field in fields:
+                if field.startswith("_rowid"):
+                    continue
+                if field in self.dd.fields:
+                    fieldid = field
+                else:
+                    fieldid = self.dd.attrs.get(field)
+                    if fieldid is None:
+                        raise FilemanError("File %s has no field [%s]" % (self.dd.filename, field))
+                fieldids.append(fieldid)
+                fieldnames.append(field)
+            if not fieldids:
+                raise FilemanError("No fields to retrieve in [%s]" % ", ".join(fields))
+            projection = self._projections[key] = (fieldids, fieldnames)
+        return projection
+
+    def _decoder(self, fieldids=None):
+        """
+            The RecordDecoder for a projection, compiled on first use.
+        """
+        key = fieldids and tuple(fieldids) or None
+        decoder = self._decoders.get(key)
+        if decoder is None:
+            fields, fieldids = resolve_fields(self.dd, fieldids)
+            decoder = self._decoders[key] = RecordDecoder(fields)
+        return decoder
+
     def _index_select(self, filters, order_by):
         """
             Given the filters, can we use an index
@@ -467,13 +604,12 @@ class DBSFile(object):
                 colname = sargable.keys()[0]
                 index = sargable[colname][0]
             else:
-                # More than one option. How to choose the best?
-                # result order, file order, other?
-                # or '=' has precendence over range?
-
-                # Choose first for now
-                colname = sargable.keys()[0]
-                index = sargable[colname][0]
+                # More than one option. Choose on the estimated rows
+                # from the index statistics.
+                candidates = [(colname, indices[0], [(rule[1], rule[2]) for rule in filters if rule[0] == colname])
+                    for (colname, indices) in sargable.items() if indices]
+                colname, index, estimates = choose_index(self, candidates, order_by)
+                logger.debug("_index_select estimates: %s", estimates)
 
         # At this point we have choosen an index. Have to choose the 
         # traversal rules, and remove the index from the filters
@@ -521,7 +657,7 @@ class DBSFile(object):
             return (filters, index, from_value, to_value, from_rule, to_rule, ascending, True)
 
     def traverser(self, index=None, from_value=None, to_value=None, ascending=True, from_rule=None, to_rule=None, raw=False,
-            filters=None, limit=None, offset=None, order_by=None):
+            filters=None, limit=None, offset=None, order_by=None, block_size=None, continuation=None, fields=None):
         """
             Return an iterator which will traverse an index.
             The iterator should return (key, rowid) pairs.
@@ -529,7 +665,24 @@ class DBSFile(object):
             By default match the from value but not the to value.
             In the case where the from value = to value, we want an 
             exact match only.
+
+            block_size is the number of index entries fetched per call into M.
+
+            fields overrides the projection of the file for the rows
+            returned, as for get().
+
+            The iterator's continuation property is a token for the
+            position after the last row returned. Passed back as
+            continuation, with the same arguments, the traversal seeks
+            to that position rather than skipping an offset.
         """
+        digest = query_digest(self.fileid, index, from_value, to_value, ascending, from_rule, to_rule,
+            filters, order_by)
+        if continuation:
+            resume = decode_continuation(continuation, digest)
+        else:
+            resume = None
+
         pre_sorted = False
         if index is None and from_value == None and to_value == None:
             # Index is not specified, but we may have filters - look at the filters
@@ -572,14 +725,32 @@ class DBSFile(object):
         else:
             filter_function = None
 
+        if resume and (resume['index'], resume['ascending']) != (index or None, ascending):
+            raise FilemanError("Continuation token does not match the traversal")
+
+        fieldids = self._projection(fields)[0]
+        getter = lambda rowid: self.get(rowid, fields=fields)
+
         if index:
             return IndexIterator(gl_prefix, index, from_value, to_value, ascending,
-                from_rule, to_rule, raw, getter=self.get, description=self.description,
-                filters=filter_function, limit=limit, offset=offset)
+                from_rule, to_rule, raw, getter=getter, description=self.description,
+                filters=filter_function, limit=limit, offset=offset, block_size=block_size,
+                digest=digest, resume=resume)
         else:
+            if raw and not filters:
+                storage_nodes = None
+            else:
+                # the nodes of the projection and the filter columns
+                if raw:
+                    fieldids = []
+                if fieldids is not None:
+                    fieldids = list(fieldids) + [self.dd.attrs.get(colname)
+                        for (colname, comparator, value) in filters or []]
+                storage_nodes = self.dd.storage_nodes(fieldids)
             return RowIterator(gl_prefix, from_value, to_value, ascending,
-                from_rule, to_rule, raw, getter=self.get, description=self.description,
-                filters=filter_function, limit=limit, offset=offset)
+                from_rule, to_rule, raw, getter=getter, description=self.description,
+                filters=filter_function, limit=limit, offset=offset, gl_cache=self._gl_cache,
+                storage_nodes=storage_nodes, block_size=block_size, digest=digest, resume=resume)
 
     def _dd_field_byname(self, colname):
         """ Cached lookup of data-dictionary """
@@ -589,21 +760,33 @@ class DBSFile(object):
             self._field_cache[colname] = field = self.dd.fields[fieldid]
         return field
 
-    def query(self, filters=None, limit=None, offset=None, order_by=None, explain=False):
+    def query(self, filters=None, limit=None, offset=None, order_by=None, explain=False, block_size=None,
+            continuation=None, fields=None):
         """
             This is implemented to support Django Clients
+
+            Returns a QueryIterator over the (rowid, row) results. Its
+            continuation property is a token for the position after the
+            last row returned. Passed back as continuation, with the same
+            filters and order_by, the query seeks to that position rather
+            than skipping an offset.
+
+            fields overrides the projection of the file for the rows
+            returned, as for get(). Only the record nodes the projection
+            needs are read.
         """
-        gl_cache = {}
-        plan = make_plan(self, filters=filters, order_by=order_by, limit=limit, offset=offset, gl_cache=gl_cache, explain=explain)
-        if explain:
-            for message in plan:
-                yield message
+        digest = query_digest(self.fileid, filters, order_by)
+        if continuation:
+            resume = decode_continuation(continuation, digest)
         else:
-            for rowid, gl_root, rowid_path in plan:
-                if len(rowid_path) == 1:
-                    yield rowid, self.get(rowid)
-                else:
-                    yield rowid_path[::2], self.get(rowid_path)
+            resume = None
+
+        gl_cache = {}
+        position = {}
+        plan = make_plan(self, filters=filters, order_by=order_by, limit=limit, offset=offset, gl_cache=gl_cache,
+            block_size=block_size, prefetch=True, position=position, resume=resume,
+            fieldids=self._projection(fields)[0], explain=explain)
+        return QueryIterator(self, plan, gl_cache, position, digest, explain, fields)
 
     def filter_row(self, _rowid, filters):
         """
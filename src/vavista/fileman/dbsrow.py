@@ -31,6 +31,114 @@ class FilemanLockFailed(FilemanError):
 def err_to_str(err):
     return '\n'.join(["%s = %s" % x for x in err.serialise()])
 
+def resolve_fields(dd, fieldids=None):
+    """
+        Map the requested fieldids to data dictionary fields.
+        Returns (fields, fieldids) where fields is a dict keyed on fieldid.
+
+        For subfiles, if the field name is T1, the field of interest is
+        T1 in subfile T1 (T1->.01). T1->T2 is field T2 in file T1.
+    """
+    if not fieldids:
+        fieldids = dd.fields.keys()
+        fieldids.sort()
+        return dd.fields, fieldids
+
+    fields = dict()
+    for fieldid in fieldids:
+        if type(fieldid) == tuple:
+            parent, child = fieldid
+            parent = dd.fields[parent]
+            child = parent.dd.fields[child]
+            fields[fieldid] = (parent, child)
+        else:
+            fields[fieldid] = dd.fields[fieldid]
+    return fields, fieldids
+
+class RecordDecoder(object):
+    """
+        Decodes the stored form of a record for a projection of fields.
+
+        It is compiled once from the data dictionary. The simple fields are
+        grouped by the storage node that holds them, so decoding a record
+        reads each node once and splits it on "^" once.
+
+            nodes = {"0": [(1, ".01", converter), ((1, 30), "2", converter)]}
+
+        A piece is either a "^" piece number or a (start, end) $E range.
+        Multiples, WP fields etc. are left in "other" and retrieved by
+        the field itself.
+    """
+    nodes = None
+    other = None
+    force_cooked = False
+
+    def __init__(self, fields):
+        self.nodes = {}
+        self.other = []
+        for (fieldid, field) in sorted(fields.items()):
+            if type(fieldid) == tuple:                 # Subfile list
+                self.other.append((fieldid, field))
+                continue
+            if field.fmql_type in [FT_COMPUTED]:
+                # If any of the fields are a "computed", cannot use the raw retrieve.
+                self.force_cooked = True
+            spec = self._compile(field)
+            if spec is None:
+                self.other.append((fieldid, field))
+            else:
+                node, piece = spec
+                self.nodes.setdefault(node, []).append((piece, fieldid, field.pyfrom_internal))
+
+    def _compile(self, field):
+        """
+            Return (node, piece) for a field stored in a piece of a node,
+            None if the field must retrieve itself.
+        """
+        if field.fmql_type in [FT_WP, FT_SUBFILE, FT_COMPUTED]:
+            return None
+        storage = field.storage
+        if not storage or storage.count(';') != 1:
+            return None
+        node, piece = storage.split(';')
+        if not node.strip():
+            return None
+        try:
+            if piece.startswith('E'):
+                # Extract Storage - programmers manual 15.3.2
+                e_off, e_end = piece[1:].split(',')
+                return node, (int(e_off), int(e_end))
+            return node, int(piece)
+        except ValueError:
+            return None
+
+    def decode(self, gl_rec, cache, result):
+        """
+            Decode the simple fields of the record gl_rec into result.
+            Matches Field.retrieve followed by Field.pyfrom_internal.
+        """
+        for node, pieces in self.nodes.items():
+            gl_piece = gl_rec[node]
+            value = None
+            if cache != None:
+                gl_id = gl_piece.closed_form
+                value = cache.get(gl_id)
+            if value == None:
+                value = gl_piece.value
+                if cache != None:
+                    cache[gl_id] = value
+            if not value:
+                continue
+            parts = None
+            for piece, fieldid, converter in pieces:
+                if type(piece) == tuple:
+                    result[fieldid] = converter(value[piece[0] - 1: piece[1]])
+                else:
+                    if parts is None:
+                        parts = value.split("^")
+                    if len(parts) >= piece:
+                        result[fieldid] = converter(parts[piece - 1])
+
 class DBSRow(object):
     """
         This is the key to the whole implementation.  This object maps to a single row
@@ -62,23 +170,7 @@ class DBSRow(object):
         self._internal = internal
         self._changed_fields = []
 
-        # For subfiles, if the field name is T1, the field of interest is
-        # T1 in subfile T1 (T1->.01). T1->T2 is field T2 in file T1.
-        fields = self._fields = dict()
-        if fieldids:
-            for fieldid in fieldids:
-                if type(fieldid) == tuple:
-                    parent, child = fieldid
-                    parent = dd.fields[parent]
-                    child = parent.dd.fields[child]
-                    fields[fieldid] = (parent, child)
-                else:
-                    fields[fieldid] = dd.fields[fieldid]
-            self._fieldids = fieldids
-        else:
-            self._fields = dd.fields
-            self._fieldids = dd.fields.keys()
-            self._fieldids.sort()
+        self._fields, self._fieldids = resolve_fields(dd, fieldids)
 
         # Lazy evaluation
         if tmpid:
@@ -188,7 +280,7 @@ class DBSRow(object):
             gl = dd.m_open_form() + "%s)" % self._rowid
             return M.Globals.from_closed_form(gl)
 
-    def raw_retrieve(self, cache=None):
+    def raw_retrieve(self, cache=None, decoder=None, verified=False):
         """
             The DBS retrieve function seems very slow so I am trying
             to retrieve the data directly from the global.
@@ -200,15 +292,17 @@ class DBSRow(object):
             methods, i.e. the kernal intro data.
 
             This code should create an identical result to the retrieve() below.
+
+            decoder is a RecordDecoder compiled for the fields of this row.
+            DBSFile keeps one per projection, so it is not rebuilt per row.
+            If verified is set, the caller has already checked that the
+            record exists.
         """
+        if decoder is None:
+            decoder = RecordDecoder(self._fields)
 
         # If any of the fields are a "computed", cannot use the raw retrieve.
-        force_cooked = False
-        for (fieldid, field) in self._fields.items():
-            if type(fieldid) != tuple and field.fmql_type in [FT_COMPUTED]:
-                force_cooked = True
-                break
-        if force_cooked:
+        if decoder.force_cooked:
             return self.retrieve()
 
         self._stored_data = result = {}
@@ -220,10 +314,13 @@ class DBSRow(object):
         # gl_rec = M.Globals.from_closed_form(gl)
         gl_rec = self._get_gl()
 
-        if not gl_rec.exists():
+        if not verified and not gl_rec.exists():
             raise FilemanError("File %s, record %s, does not exist", dd.filename, self._rowid)
 
-        for (fieldid, field) in self._fields.items():
+        # Simple values
+        decoder.decode(gl_rec, cache, result)
+
+        for (fieldid, field) in decoder.other:
             if type(fieldid) == tuple:                 # Subfile list
                 parent, child = field
                 retrieved = parent.retrieve(gl_rec, cache, [child])
@@ -0,0 +1,124 @@
+"""
+    Snapshots of data dictionaries on disk.
+
+    Building a DD walks ^DD field by field, and the index listing node
+    by node, which is thousands of M calls for a large file. Once built,
+    the fields, the name map, the indices and the subfile link are
+    written to SNAPSHOT_DIR/<database>/<fileid>.dd, and the next process
+    loads them from there.
+
+    A snapshot holds a stamp of the file's ^DD header,
+
+        ^DD(file,0), ^DD(file,0,"DT"), ^DD(file,0,"UP"), ^DIC(file,0,"GL")
+
+    read with one M call. Fileman updates the header when the DD is
+    edited, so a snapshot whose stamp no longer matches is ignored and
+    rebuilt.
+
+    Snapshots are off unless SNAPSHOT_DIR is set, from the environment
+    variable VAVISTA_DD_CACHE, or by the caller (e.g. filemand --dd-cache).
+    The directory must only be writable by the owner of the process.
+"""
+
+import cPickle
+import hashlib
+import logging
+import os
+import tempfile
+
+from vavista import M
+
+logger = logging.getLogger(__file__)
+
+# Directory for the snapshots, None to disable them.
+SNAPSHOT_DIR = os.environ.get("VAVISTA_DD_CACHE") or None
+
+# Bumped when the snapshot layout changes, so old snapshots are ignored.
+SNAPSHOT_VERSION = 3
+
+def stamp(fileid):
+    """
+        A checksum of the ^DD header of the file.
+    """
+    header, = M.mexec('''set s0=$G(^DD(%s,0))_"|"_$G(^DD(%s,0,"DT"))_"|"_$G(^DD(%s,0,"UP"))_"|"_$G(^DIC(%s,0,"GL"))'''
+            % (fileid, fileid, fileid, fileid), M.INOUT(""))
+    return hashlib.md5(header).hexdigest()
+
+def snapshot_path(fileid):
+    """
+        The snapshot file for fileid. Snapshots are kept apart for each
+        global directory, so that databases do not share them.
+    """
+    database = hashlib.md5(os.environ.get("gtmgbldir", "")).hexdigest()[:12]
+    return os.path.join(SNAPSHOT_DIR, database, "%s.dd" % fileid)
+
+def load(dd):
+    """
+        Fill in the fields and indices of dd from its snapshot.
+        Returns False if there is no snapshot, or it is out of date.
+    """
+    if not SNAPSHOT_DIR or not dd.fileid:
+        return False
+    path = snapshot_path(dd.fileid)
+    try:
+        f = open(path, "rb")
+    except IOError:
+        return False
+    try:
+        try:
+            snapshot = cPickle.load(f)
+        except Exception:
+            logger.warning("Ignoring unreadable DD snapshot %s", path)
+            return False
+    finally:
+        f.close()
+
+    if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('stamp') != stamp(dd.fileid):
+        return False
+    dd.restore(snapshot)
+    return True
+
+def save(dd):
+    """
+        Write the snapshot for dd. The file is written under a new name
+        and renamed, so a reader never sees part of it.
+    """
+    if not SNAPSHOT_DIR or not dd.fileid:
+        return
+    snapshot = dd.snapshot()
+    snapshot['version'] = SNAPSHOT_VERSION
+    snapshot['stamp'] = stamp(dd.fileid)
+
+    path = snapshot_path(dd.fileid)
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        f = os.fdopen(fd, "wb")
+        try:
+            cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+    except (IOError, OSError), e:
+        logger.warning("Could not write DD snapshot %s: %s", path, e)
+
+def invalidate(fileid=None):
+    """
+        Remove the snapshot for a file, or all files.
+    """
+    if not SNAPSHOT_DIR:
+        return
+    if fileid is None:
+        directory = os.path.dirname(snapshot_path("0"))
+        paths = []
+        if os.path.isdir(directory):
+            paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".dd")]
+    else:
+        paths = [snapshot_path(fileid)]
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
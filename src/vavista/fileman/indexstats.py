@@ -0,0 +1,129 @@
+"""
+    Statistics on the traditional indices, for the query planner.
+
+    An index is sampled by walking the first SAMPLE_ROWS entries
+    ^GLOBAL("IDX",key,rowid). The sample gives the number of
+    rows per key, and for small indices, the whole distribution
+    of the keys.
+
+    The statistics are held per file, and an index is only sampled
+    when the planner needs to choose between indices. They are
+    resampled when they are older than STATS_TTL seconds, or the
+    record count of the file has moved by more than STATS_DRIFT.
+
+    A refresh resamples the index rather than updating the old
+    statistics. The sample is bounded by SAMPLE_ROWS, so this is a
+    single short walk, and the index keeps no change log to apply.
+"""
+
+import time
+
+from blockfetch import index_block_walk
+
+# Index entries read when sampling an index.
+SAMPLE_ROWS = 1000
+
+# Seconds before the statistics on an index are resampled.
+STATS_TTL = 3600
+
+# Fraction the file record count can change by before an index is resampled.
+STATS_DRIFT = 0.2
+
+# fileid -> {index name: IndexStats}
+_stats = {}
+
+class IndexStats(object):
+    """
+        The result of sampling an index.
+
+            keys is a list of (key, rows) in index order
+            entries is the number of index entries sampled
+            complete is set if the whole index was sampled
+            file_rows is the file record count when sampled
+    """
+    keys = None
+    entries = 0
+    complete = False
+    file_rows = 0
+    sampled_at = 0
+
+    def __init__(self, index, keys, entries, complete, file_rows):
+        self.index = index
+        self.keys = keys
+        self.entries = entries
+        self.complete = complete
+        self.file_rows = file_rows
+        self.sampled_at = time.time()
+
+    def __str__(self):
+        return "IndexStats %s, rows per key %.1f, distinct keys %d%s" % (self.index,
+                self.rows_per_key, self.distinct_keys, "" if self.complete else " (estimated)")
+
+    @property
+    def rows_per_key(self):
+        if not self.keys:
+            return 0.0
+        return float(self.entries) / len(self.keys)
+
+    @property
+    def distinct_keys(self):
+        """
+            Number of keys in the index. If only part of the index was
+            sampled, this is extrapolated from the file record count.
+        """
+        if self.complete or not self.keys:
+            return len(self.keys)
+        return max(len(self.keys), int(self.file_rows / self.rows_per_key))
+
+    @property
+    def last_key(self):
+        if not self.keys:
+            return None
+        return self.keys[-1][0]
+
+    def stale(self, file_rows):
+        if time.time() - self.sampled_at > STATS_TTL:
+            return True
+        return abs(file_rows - self.file_rows) > STATS_DRIFT * max(self.file_rows, 100)
+
+def sample_index(gl_prefix, index, file_rows, sample_rows=None):
+    """
+        Walk the start of an index, counting the rows under each key.
+    """
+    if sample_rows is None:
+        sample_rows = SAMPLE_ROWS
+
+    gl = gl_prefix + '"%s",' % index
+    keys = []
+    entries = 0
+    complete = True
+    for key, rowid in index_block_walk(gl, block_size=min(sample_rows, 500)):
+        if entries >= sample_rows:
+            complete = False
+            break
+        if keys and keys[-1][0] == key:
+            keys[-1][1] += 1
+        else:
+            keys.append([key, 1])
+        entries += 1
+    return IndexStats(index, keys, entries, complete, file_rows)
+
+def index_stats(dd, index, file_rows):
+    """
+        Statistics for an index on the file dd. The index is sampled
+        if there are no statistics, or they are stale.
+    """
+    file_stats = _stats.setdefault(dd.fileid, {})
+    stats = file_stats.get(index)
+    if stats is None or stats.stale(file_rows):
+        stats = file_stats[index] = sample_index(dd.m_open_form(), index, file_rows)
+    return stats
+
+def invalidate(fileid=None):
+    """
+        Drop the statistics for a file, or all files.
+    """
+    if fileid is None:
+        _stats.clear()
+    else:
+        _stats.pop(fileid, None)
@@ -9,8 +9,17 @@
     TODO: Explain
 
     A query planner takes the SQL statement and coverts it to
-    a tree. The implementation here does not support joins or
-    unions or ors so the tree becomes a pipeline.
+    a tree. The implementation here does not support joins, so the
+    tree becomes a pipeline. Filters are and-ed together. An "or"
+    is a filter group:
+
+        [None, 'or', [branch, branch, ...]]
+
+    where a branch is a filter or a list of filters.
+
+    Where several indices are selective, the rowids from each
+    are intersected before any record is read. An "or" where each
+    branch can use an index is a union of the rowids.
 
     terminology:
 
@@ -22,17 +31,27 @@
     best index. 
 
     the data is fed through a pipeline to apply all of the 
-    appropriate filters to it. The output is sorted.
+    appropriate filters to it. The output is sorted. If there is
+    a limit, only the first offset+limit rows are kept by the sort.
 
     This code does not handle functions. It is built as required
     rather than trying to build an optimiser.
 
 """
 
+import heapq
+import itertools
 import logging
+import os
+import re
+import tempfile
+import cPickle as pickle
 
 from vavista import M
-from shared import valid_rowid
+from shared import FilemanError, valid_rowid
+from blockfetch import index_block_walk, file_block_walk, fetch_records, BLOCK_SIZE, BLOCK_BYTES, ITEM_SEP, ITEM_END
+from indexstats import index_stats
+from dbsdd import FT_DATETIME, FT_NUMERIC, FT_SET, FT_TEXT, FT_POINTER
 
 logger = logging.getLogger(__file__)
 
@@ -47,6 +66,7 @@ def _reverse_sign(s):
 #------------------------------------------------------------------------------------------------
 # The generators that implement the pipeline
 # These pass the rowid and the global root of the row downwards.
+# An index-only scan adds a fourth item, the {fieldid: value} read from the index.
 
 def offset_limit(stream, limit=None, offset=None, explain=False):
     """
@@ -73,47 +93,422 @@ def offset_limit(stream, limit=None, offset=None, explain=False):
         if limit is not None and emitted >= limit:
             break
 
-def sorter(stream, order_by, dd, gl_cache=None, explain=False):
+class _Descending(object):
     """
-        If we are sorting the result, create a temporary store with key, fileid.
-        Only support a order_by columns with the same direction (i.e. ascending or descending).
+        Wraps a sort key value to reverse its ordering, so that
+        order_by columns can be mixed ascending and descending.
     """
-    if explain:
-        for message in stream: yield message
-        yield "sorter order_by = %s" % order_by
-        return
+    __slots__ = ('value',)
 
-    values = []
-    ascending = True
+    def __init__(self, value):
+        self.value = value
+
+    def __getstate__(self):
+        return (self.value,)
+
+    def __setstate__(self, state):
+        self.value, = state
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __le__(self, other):
+        return other.value <= self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
+
+    def __ge__(self, other):
+        return other.value >= self.value
+
+def _sort_fields(order_by, dd):
+    """
+        The fields to build a sort key from, with the direction of each.
+        Ties are broken on the rowid, in the direction of the last column.
+    """
     fields = []
+    ascending = True
 
     for (fieldid, direction) in order_by:
         if fieldid in ('_rowid', '_parentid'):
-            fields.append(fieldid)
+            field = fieldid
         else:
             field = dd.fields[fieldid]
-            fields.append(field)
-        if direction == 'ASC':
-            ascending = True
-        else:
-            ascending = False
+        ascending = (direction == 'ASC')
+        fields.append((field, ascending))
+    return fields, ascending
 
-    for rowid, rec_gl_closed_form, rowid_path in stream:
+def _m_sort_value(value):
+    """
+        A column value as the string M holds it - numbers in canonic
+        form, unicode as UTF-8.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, float):
+        if value == int(value):
+            return str(int(value))
+        value = repr(value)
+        # M has no leading zero, .5 not 0.5
+        if value.startswith("0."):
+            return value[1:]
+        if value.startswith("-0."):
+            return "-" + value[2:]
+        return value
+    return str(value)
+
+def _sort_key(value):
+    """
+        The sort key of a column value, in M collation. Empty values
+        come first, as they do in m_sorter().
+    """
+    if value is None or value == "":
+        return (0,)
+    return (1, _m_collation(_m_sort_value(value)))
+
+def _sort_values(stream, fields, ascending, gl_cache):
+    """
+        Generator of (key, (rowid, rec_gl_closed_form, rowid_path)) for the
+        rows in stream. The keys sort ascending, with the descending
+        columns wrapped. The key ends with the rowid, then the position
+        of the row in the stream, so sorter(), top_n_sorter() and
+        m_sorter() all give the same order.
+    """
+    for seq, row in enumerate(stream):
+        rowid, rec_gl_closed_form, rowid_path = row[:3]
         rec = M.Globals.from_closed_form(rec_gl_closed_form)
         key = []
-        for field in fields:
+        for field, field_ascending in fields:
             if field == '_rowid':
-                key.append(rowid)
+                value = rowid
             else:
-                key.append(field.retrieve(rec, gl_cache))
-        values.append((key, (rowid, rec_gl_closed_form, rowid_path)))
+                value = field.retrieve(rec, gl_cache)
+            value = _sort_key(value)
+            if not field_ascending:
+                value = _Descending(value)
+            key.append(value)
+        tie = _m_collation(rowid)
+        if not ascending:
+            tie = _Descending(tie)
+        key.extend([tie, seq])
+        yield (key, (rowid, rec_gl_closed_form, rowid_path))
+
+def _spill(values):
+    """
+        Write a sorted run to a temporary file, return the file.
+    """
+    run = tempfile.TemporaryFile()
+    for value in values:
+        pickle.dump(value, run, pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
 
-    values.sort()
-    if not ascending:
-        values.reverse()
+def _read_run(run):
+    """
+        Generator over a sorted run written by _spill()
+    """
+    while 1:
+        try:
+            yield pickle.load(run)
+        except EOFError:
+            return
+
+# Rows held in memory by sorter(). Past this, sorted runs are written to disk.
+SORT_BUDGET = 100000
+
+def sorter(stream, order_by, dd, gl_cache=None, budget=None, estimated_rows=None, explain=False):
+    """
+        If we are sorting the result, create a temporary store with key, fileid.
+
+        At most budget rows are held in memory. When the budget is
+        exceeded, the rows are sorted and written to a temporary file
+        as a run. The runs are merged as the result is read.
+
+        Explain gives the runs which estimated_rows would spill.
+    """
+    if budget is None:
+        budget = SORT_BUDGET
+    budget = max(int(budget), 1)
+
+    if explain:
+        for message in stream: yield message
+        spills = ""
+        if estimated_rows is not None:
+            spills = ", %d runs spilled for an estimated %d rows" % (int(estimated_rows) // budget, estimated_rows)
+        yield "sorter order_by = %s, budget = %s rows%s" % (order_by, budget, spills)
+        return
+
+    fields, ascending = _sort_fields(order_by, dd)
+
+    runs = []
+    try:
+        values = []
+        for value in _sort_values(stream, fields, ascending, gl_cache):
+            values.append(value)
+            if len(values) >= budget:
+                values.sort()
+                runs.append(_spill(values))
+                values = []
+        values.sort()
+
+        if runs:
+            logger.info("sorter order_by = %s, spilled %d runs of %d rows", order_by, len(runs), budget)
+            values = heapq.merge(iter(values), *[_read_run(run) for run in runs])
+
+        for key, (rowid, rec_gl_closed_form, rowid_path) in values:
+            yield (rowid, rec_gl_closed_form, rowid_path)
+    finally:
+        for run in runs:
+            run.close()
+
+def top_n_sorter(stream, order_by, dd, n, gl_cache=None, explain=False):
+    """
+        sorter() for when only the first n rows are wanted, i.e. there is
+        a limit. A heap of n rows is kept, rather than the whole result,
+        so memory is bounded by the page size and the cost is O(rows log n).
+
+        The output is the same as the first n rows of sorter().
+    """
+    if explain:
+        for message in stream: yield message
+        yield "top_n_sorter order_by = %s, n = %s" % (order_by, n)
+        return
+
+    fields, ascending = _sort_fields(order_by, dd)
+
+    values = heapq.nsmallest(n, _sort_values(stream, fields, ascending, gl_cache))
     for key, (rowid, rec_gl_closed_form, rowid_path) in values:
         yield (rowid, rec_gl_closed_form, rowid_path)
 
+# ^TMP subtree used by m_sorter(), under ^TMP($J,"QSORT",id). The id
+# holds the pid, as processes forked from one parent count from 1.
+_m_sort_ids = itertools.count(1)
+
+# Total length of the sort key subscripts, counting two characters
+# of overhead per subscript, to fit within the M key size limit.
+M_SORT_KEY_LENGTH = 200
+
+# Above this many rows (estimated from the file header) the sort is done in M.
+M_SORT_ROWS = 50000
+
+def _m_sort_subscripts(key):
+    """
+        The ^TMP subscripts for a key from _sort_values(), without the
+        position. A column is stored as two subscripts, (1, value) or
+        (0, 0) if the value is empty, as M does not allow empty
+        subscripts. The rowid follows the columns.
+
+        Returns None if the subscripts are longer than M_SORT_KEY_LENGTH.
+    """
+    subscripts = []
+    for value in key[:-2]:
+        if isinstance(value, _Descending):
+            value = value.value
+        if value == (0,):
+            subscripts.extend(["0", "0"])
+        else:
+            subscripts.extend(["1", value[1][2]])
+    tie = key[-2]
+    if isinstance(tie, _Descending):
+        tie = tie.value
+    subscripts.append(tie[2])
+    if sum([len(subscript) + 2 for subscript in subscripts]) > M_SORT_KEY_LENGTH:
+        return None
+    return subscripts
+
+def _m_sort_write(write_code, sort_id, rows, seq):
+    """
+        Write a block of (subscripts, row) to ^TMP, numbered up to seq.
+    """
+    items = []
+    for i, (subscripts, (rowid, rec_gl_closed_form, rowid_path)) in enumerate(rows):
+        items.append(ITEM_SEP.join(subscripts + [str(seq - len(rows) + i + 1), rowid, rec_gl_closed_form,
+            "\x03".join([str(p) for p in rowid_path])]))
+    M.mexec(write_code, sort_id, ITEM_END.join(items), str(len(items)), M.INOUT(""), M.INOUT(""))
+
+def m_sorter(stream, order_by, dd, gl_cache=None, block_size=None, explain=False):
+    """
+        sorter() which writes the rows to ^TMP($J,"QSORT",id,key...,rowid,seq)
+        and reads them back in subscript order, so the sort is done by M,
+        using M collation (numbers before strings), and the rows are not
+        held in Python. Ties are broken on the rowid, then the order the
+        rows arrived, as in sorter().
+
+        The rows are written and read a block at a time.
+
+        If a key is too long for the ^TMP subscripts, the rows are
+        passed to sorter() instead.
+    """
+    if explain:
+        for message in stream: yield message
+        yield "m_sorter order_by = %s" % order_by
+        return
+
+    if block_size is None:
+        block_size = BLOCK_SIZE
+    block_size = max(int(block_size), 1)
+
+    fields, ascending = _sort_fields(order_by, dd)
+    depth = len(fields) * 2 + 2
+
+    # Two levels per column, the rowid, then the arrival sequence
+    directions = []
+    for field, field_ascending in fields:
+        directions.extend([field_ascending and "1" or "-1"] * 2)
+    directions.append(ascending and "1" or "-1")
+    directions.append("1")
+
+    sort_id = "%d-%d" % (os.getpid(), _m_sort_ids.next())
+    gl = '^TMP($job,"QSORT",s0,'
+
+    # s1 is a block of rows, s2 rows, each row is its subscripts then rowid, closed form, path
+    write_code = ('for s3=1:1:s2 set s4=$piece(s1,$char(2),s3),%s%s)=$piece(s4,$char(1),%d,%d)' %
+        (gl, ",".join(['$piece(s4,$char(1),%d)' % (i + 1) for i in range(depth)]), depth + 1, depth + 3))
+
+    # Read up to s3 rows into s2 from the position s1, the subscripts of the last row read.
+    # Each level is a FOR on its subscript s4(level). When resuming (s5) only the innermost
+    # level advances on the first pass. s4 counts the rows.
+    levels = ['s4(%d)' % level for level in range(1, depth + 1)]
+    read_code = ['set s2="",s4=0,s5=(s1\'="")']
+    read_code.extend(['set %s=$piece(s1,$char(1),%d)' % (level, i + 1) for i, level in enumerate(levels)])
+    for i, level in enumerate(levels):
+        ref = "%s%s)" % (gl, ",".join(levels[:i + 1]))
+        if i < depth - 1:
+            read_code.append('for  quit:s4\'<s3!($length(s2)>%d)  set:\'s5 %s=$order(%s,%s) quit:%s="" ' %
+                (BLOCK_BYTES, level, ref, directions[i], level))
+        else:
+            read_code.append('for  quit:s4\'<s3!($length(s2)>%d)  set s5=0,%s=$order(%s,%s) quit:%s=""  '
+                'set s4=s4+1,s2=s2_$char(2)_%s,s1=%s' %
+                (BLOCK_BYTES, level, ref, directions[i], level, ref, '_$char(1)_'.join(levels)))
+    read_code = " ".join(read_code)
+
+    def read_sorted():
+        position = ""
+        while 1:
+            position, block, count, resume = M.mexec(read_code, sort_id, M.INOUT(position), M.INOUT(""),
+                str(block_size), M.INOUT(""), M.INOUT(""))
+            for item in block.split(ITEM_END)[1:]:
+                rowid, rec_gl_closed_form, rowid_path = item.split(ITEM_SEP)
+                yield (rowid, rec_gl_closed_form, rowid_path.split("\x03"))
+            # A short block which was not closed on length is the end of the sort.
+            if int(count or 0) < block_size and len(block) <= BLOCK_BYTES:
+                break
+
+    seq = 0
+    try:
+        rows = []
+        values = _sort_values(stream, fields, ascending, gl_cache)
+        for key, row in values:
+            subscripts = _m_sort_subscripts(key)
+            if subscripts is None:
+                # Too long for M. The rows written so far, and the rest of
+                # the stream, are sorted in Python.
+                logger.info("m_sorter order_by = %s, key too long, sorting in Python", order_by)
+                written = []
+                if seq > len(rows):
+                    written = read_sorted()
+                rest = itertools.chain(written, [r for (subs, r) in rows], [row],
+                    (r for (k, r) in values))
+                for row in sorter(rest, order_by, dd, gl_cache):
+                    yield row
+                return
+            seq += 1
+            rows.append((subscripts, row))
+            if len(rows) >= block_size:
+                _m_sort_write(write_code, sort_id, rows, seq)
+                rows = []
+        if rows:
+            _m_sort_write(write_code, sort_id, rows, seq)
+
+        if seq == 0:
+            return
+
+        for row in read_sorted():
+            yield row
+    finally:
+        M.mexec('kill ^TMP($job,"QSORT",s0)', sort_id)
+
+def _sort_stage(stream, order_by, dd, gl_cache=None, limit=None, offset=None, sort_budget=None,
+        estimated_rows=None, block_size=None, explain=False):
+    """
+        Choose the sort for the pipeline. With a limit, only offset+limit
+        rows can be emitted, so only that many need to be kept. Large
+        sorts are done in M.
+    """
+    if limit is not None:
+        return top_n_sorter(stream, order_by, dd, (offset or 0) + limit, gl_cache, explain=explain)
+    if estimated_rows is not None and estimated_rows > M_SORT_ROWS:
+        return m_sorter(stream, order_by, dd, gl_cache, block_size=block_size, explain=explain)
+    return sorter(stream, order_by, dd, gl_cache, budget=sort_budget, estimated_rows=estimated_rows,
+            explain=explain)
+
+def _branch_filters(branch):
+    """
+        A branch of an "or" group is a filter, or a list of filters which must all match.
+    """
+    if branch and type(branch[0]) in (list, tuple):
+        return branch
+    return [branch]
+
+def _filters_match(rowid, rec, filters, dd, gl_cache, values=None):
+    """
+        True if the record matches all the filters.
+        An "or" group, [None, 'or', [branch, ...]], matches if any branch does.
+        values are field values already known, e.g. from an index key.
+    """
+    for fieldid, comparator, value in filters:
+        comparator = comparator.lower()
+
+        if comparator == 'or':
+            for branch in value:
+                if _filters_match(rowid, rec, _branch_filters(branch), dd, gl_cache, values):
+                    break
+            else:
+                return False
+            continue
+
+        ## Need mumps comparisons here - numerics versus non-numerics
+        if fieldid == '_rowid':
+            db_value = rowid
+        elif values and fieldid in values:
+            db_value = values[fieldid]
+        else:
+            field = dd.fields[fieldid]
+            db_value = field.retrieve(rec, gl_cache)
+
+        try:
+            float(db_value)
+            float(value)
+
+            db_value = float(db_value)
+            value = float(value)
+        except:
+            pass
+
+        if comparator == '='  and not (db_value == value):
+            return False
+        if comparator == '>=' and not (db_value >= value):
+            return False
+        if comparator == '>'  and not (db_value > value):
+            return False
+        if comparator == '<'  and not (db_value < value):
+            return False
+        if comparator == '<=' and not (db_value <= value):
+            return False
+        if comparator == 'in' and not (db_value in value):
+            return False
+        # TODO: move the comparator logic into the data-dictionary.
+        #       logic will depend of field types.
+    return True
+
 def apply_filters(stream, dbsfile, filters, gl_cache, explain=False):
     """
         Return true of false for whether rowid matches the set of filters,
@@ -121,69 +516,72 @@ def apply_filters(stream, dbsfile, filters, gl_cache, explain=False):
 
         column > x
         column < x
+        [None, 'or', [[column, '=', x], [[column, '>', y], [column2, '=', z]]]]
     """
     if explain:
         for message in stream: yield message
         yield "apply_filters filters = %s" % filters
         return
 
-    for rowid, rec_gl_closed_form, rowid_path in stream:
+    for row in stream:
+        rowid, rec_gl_closed_form, rowid_path = row[:3]
         rec = M.Globals.from_closed_form(rec_gl_closed_form)
-        emit = True
-        for fieldid, comparator, value in filters:
-            ## Need mumps comparisons here - numerics versus non-numerics
-            if fieldid == '_rowid':
-                db_value = rowid
-            else:
-                field = dbsfile.dd.fields[fieldid]
-                db_value = field.retrieve(rec, gl_cache)
-
-            try:
-                float(db_value)
-                float(value)
-
-                db_value = float(db_value)
-                value = float(value)
-            except:
-                pass
-
-            comparator = comparator.lower()
-
-            if comparator == '='  and not (db_value == value):
-                emit = False
-                break
-            if comparator == '>=' and not (db_value >= value):
-                emit = False
-                break
-            if comparator == '>'  and not (db_value > value):
-                emit = False
-                break
-            if comparator == '<'  and not (db_value < value):
-                emit = False
-                break
-            if comparator == '<=' and not (db_value <= value):
-                emit = False
-                break
-            if comparator == 'in' and not (db_value in value):
-                emit = False
-                break
-            # TODO: move the comparator logic into the data-dictionary.
-            #       logic will depend of field types.
-
-        if emit:
-            yield rowid, rec_gl_closed_form, rowid_path
+        if _filters_match(rowid, rec, filters, dbsfile.dd, gl_cache, len(row) > 3 and row[3] or None):
+            yield row
 
 def null_traversal(explain=False):
     if explain:
         yield "null_traversal"
         return
 
-def file_order_traversal(gl, ranges=None, ascending=True, sf_path=[], explain=False):
+def file_rows(gl, lastrowid, ascending, block_size=None, prefetch=False, only_nodes=None):
     """
-        Originate records by traversing the file in file order (i.e. no index)
+        Generator over the (rowid, nodes) of a file, starting at lastrowid.
+        lastrowid itself is included if the record exists.
     """
-    if ranges:
-        r = ranges[0]
+    if lastrowid is None:
+        # descending from the last record in the file
+        lastrowid = "%"
+    elif float(lastrowid) > 0:
+        # we may have the id of a record, which needs to be verified
+        row_exists, = M.mexec("""set s0=$data(%ss0))""" % (gl), M.INOUT(lastrowid))
+        if row_exists != "0":
+            yield lastrowid, None
+
+    for rowid, nodes in file_block_walk(gl, lastrowid, ascending, block_size, prefetch, only_nodes):
+        yield rowid, nodes
+
+def cache_record(gl_cache, rec_gl_closed_form, nodes, storage_nodes):
+    """
+        Load the prefetched nodes of a record into the gl_cache, so that
+        Field.retrieve does not go back to M. storage_nodes which are not
+        present in the record are cached as empty.
+
+        Returns the cache keys added.
+    """
+    rec = M.Globals.from_closed_form(rec_gl_closed_form)
+    keys = []
+    for node in set(storage_nodes).union(nodes.keys()):
+        gl_id = rec[node].closed_form
+        gl_cache[gl_id] = nodes.get(node, "")
+        keys.append(gl_id)
+    return keys
+
+def _explain_ranges(ranges, quote=""):
+    """
+        The ranges of a traversal, for explain.
+    """
+    if not ranges:
+        ranges = [{'from_rule': None, 'from_value': None, 'to_rule': None, 'to_value': None}]
+    return " OR ".join(["X %s %s%s%s AND X %s %s%s%s" % (r['from_rule'], quote, r['from_value'], quote,
+        r['to_rule'], quote, r['to_value'], quote) for r in ranges])
+
+def _file_range(gl, r, ascending, block_size, prefetch, after=None, only_nodes=None):
+    """
+        Generator over the (rowid, nodes) of a file within the range r.
+        If after is given, the walk resumes after that rowid.
+    """
+    if r:
         from_rowid = r['from_value']
         to_rowid = r['to_value']
         from_rule = r['from_rule']
@@ -191,11 +589,6 @@ def file_order_traversal(gl, ranges=None, ascending=True, sf_path=[], explain=Fa
     else:
         from_rowid, to_rowid, from_rule, to_rule = None, None, None, None
 
-    if explain:
-        yield "file_order_traversal, ascending=%s, gl=%s, X %s %s AND X %s %s" % (ascending,
-                gl, from_rule, from_rowid, to_rule, to_rowid)
-        return
-
     # the new person file has non-integer user ids
     if from_rowid != None:
         from_rowid = float(from_rowid)
@@ -221,33 +614,12 @@ def file_order_traversal(gl, ranges=None, ascending=True, sf_path=[], explain=Fa
         if lastrowid.endswith(".0"):
             lastrowid = lastrowid[:-2]
 
-    first_pass = True
-
-    if ascending:
-        asc = 1
+    if after is None:
+        rows = file_rows(gl, lastrowid, ascending, block_size, prefetch, only_nodes)
     else:
-        asc = -1
-
-    while 1:
-        # If this is the first pass, we may have the id of a record, which needs to 
-        # be verified
-        found = False
-        if first_pass:
-            first_pass = False
-            if lastrowid is None and asc == -1:
-                lastrowid, = M.mexec("""set s0=$order(%ss0),-1)""" % gl, M.INOUT('%'))
-                if valid_rowid(lastrowid):
-                    found = True
-            elif lastrowid and float(lastrowid) > 0:
-                row_exists, = M.mexec("""set s0=$data(%ss0))""" % (gl), M.INOUT(lastrowid))
-                if valid_rowid(row_exists):
-                    found = True
-
-        if not found:
-            lastrowid, = M.mexec("""set s0=$order(%ss0),%d)""" % (gl, asc), M.INOUT(lastrowid))
-            if not valid_rowid(lastrowid):
-                break
+        rows = file_block_walk(gl, after, ascending, block_size, prefetch, only_nodes)
 
+    for lastrowid, nodes in rows:
         # Check boundary values
         f_lastrowid = float(lastrowid)
         if ascending:
@@ -270,9 +642,84 @@ def file_order_traversal(gl, ranges=None, ascending=True, sf_path=[], explain=Fa
                     break
                 if f_lastrowid < to_rowid and to_rule == ">=":
                     break
+        yield lastrowid, nodes
+
+def file_order_traversal(gl, ranges=None, ascending=True, sf_path=[], gl_cache=None, storage_nodes=None,
+        block_size=None, position=None, resume=None, explain=False):
+    """
+        Originate records by traversing the file in file order (i.e. no index)
+
+        The rowids are pulled from M a block at a time. If storage_nodes
+        is given, those record nodes are fetched with the rowids and loaded
+        into the gl_cache as each record is emitted.
+
+        ranges is a list of rowid ranges, visited in order. If every range
+        is a single rowid (an "in" list), the records are read by rowid.
+
+        position is a dictionary updated with the range and rowid of
+        each record as it is emitted, and 'done' at the end of the file.
+        resume is a position to restart the traversal after.
+    """
+    prefetch = gl_cache is not None and storage_nodes is not None
+
+    if explain:
+        yield "file_order_traversal, ascending=%s, gl=%s, %s, prefetch=%s" % (ascending,
+                gl, _explain_ranges(ranges), prefetch)
+        return
+
+    if ranges is None:
+        ranges = [None]
+
+    if resume:
+        first = resume['range']
+    else:
+        first = 0
+
+    if ranges and not [r for r in ranges if not _is_key(r)]:
+        keys = [str(r['from_value']) for r in ranges]
+        key_range = dict([(key, n) for (n, key) in enumerate(keys)])
+        if resume:
+            first += 1
+        # only record numbers - not the file header, an index name or ""
+        keys_left = [key for key in keys[first:] if valid_rowid(key) and float(key) > 0]
+        rows = ((key_range[rowid], rowid, nodes) for (rowid, nodes)
+            in fetch_records(gl, keys_left, block_size, storage_nodes))
+    else:
+        rows = _ranges_rows(gl, ranges, first, ascending, block_size, prefetch, resume and resume['rowid'],
+            storage_nodes)
+
+    # Cache entries of the last record emitted, dropped once the consumer moves on.
+    cached_keys = []
+
+    for range_no, lastrowid, nodes in rows:
+        rec_gl_closed_form = "%s%s)" % (gl, lastrowid)
+        if prefetch:
+            for gl_id in cached_keys:
+                gl_cache.pop(gl_id, None)
+            cached_keys = []
+            if nodes is not None:
+                cached_keys = cache_record(gl_cache, rec_gl_closed_form, nodes, storage_nodes)
+
+        if position is not None:
+            position.update(range=range_no, key=None, rowid=lastrowid)
 
         # If this is a subfile, I need to return the full path.
-        yield (lastrowid, "%s%s)" % (gl, lastrowid), sf_path + [lastrowid])
+        yield (lastrowid, rec_gl_closed_form, sf_path + [lastrowid])
+
+    if position is not None:
+        position['done'] = True
+
+def _ranges_rows(gl, ranges, first, ascending, block_size, prefetch, after=None, only_nodes=None):
+    """
+        Generator over the (range number, rowid, nodes) of a file within the
+        ranges, from range first. The walk of range first resumes after
+        the rowid after, if it is given.
+    """
+    for range_no in range(first, len(ranges)):
+        if range_no != first:
+            after = None
+        for rowid, nodes in _file_range(gl, ranges[range_no], ascending, block_size, prefetch, after, only_nodes):
+            yield range_no, rowid, nodes
 
 def subfile_traversal(stream, dd, ranges=None, ascending=True, explain=False):
     """
@@ -288,7 +735,8 @@ def subfile_traversal(stream, dd, ranges=None, ascending=True, explain=False):
         yield "subfile_traversal, ascending=%s, dd=%s, ranges=%s" % (ascending, dd, ranges)
         return
 
-    for rowid, rec_gl_closed_form, rowid_path in stream:
+    for row in stream:
+        rowid, rec_gl_closed_form, rowid_path = row[:3]
         sf = M.Globals.from_closed_form(rec_gl_closed_form)[gl_subpath]
 
         for sf_rowid, value in sf.keys_with_decendants():  # TODO: smarter filtering
@@ -299,7 +747,60 @@ def subfile_traversal(stream, dd, ranges=None, ascending=True, explain=False):
             yield sf_rowid, "%s%s)" % (sf.open_form, sf_rowid), rowid_path + [gl_subpath, sf_rowid]
 
 
-def index_order_traversal(gl_prefix, index, ranges=None, ascending=True, sf_path=[], explain=False):
+def key_in_range(key, ascending, from_value, from_rule, to_value, to_rule):
+    """
+        Check an index key against the traversal range.
+
+        returns -1 if the key is before the range (skip it),
+        0 if it is within the range, 1 if it is past the range (stop).
+    """
+    if (from_value is not None and from_value == to_value
+            and from_rule in ('>=', '<=') and to_rule in ('>=', '<=')):
+        # A single key. Any other key is past it, whatever the collation.
+        if key == from_value:
+            return 0
+        return 1
+    if ascending:
+        if from_value is not None:
+            if from_rule == ">" and key <= from_value:
+                return -1
+            if from_rule == ">=" and key < from_value:
+                return -1
+        if to_value is not None:
+            if to_rule == "<=" and key > to_value:
+                return 1
+            if to_rule == "=" and key != to_value:
+                return 1
+            if to_rule == "<" and key >= to_value:
+                return 1
+    else: # descending
+        if from_value is not None:
+            if from_rule == "<" and key >= from_value:
+                return -1
+            if from_rule == "<=" and key > from_value:
+                return -1
+        if to_value is not None:
+            if to_rule == ">=" and key < to_value:
+                return 1
+            if to_rule == "=" and key != to_value:
+                return 1
+            if to_rule == ">" and key <= to_value:
+                return 1
+    return 0
+
+def index_start(from_value, from_rule):
+    """
+        Starting position (lastkey, lastrowid) for an index_block_walk.
+        A strict from_rule skips the rows under the from_value key.
+    """
+    if from_value is None:
+        return "", None
+    if from_rule in ('>', '<'):
+        return from_value, None    # looks for the next key after from_value
+    return from_value, ""          # looks for the from_value key
+
+def index_order_traversal(gl_prefix, index, ranges=None, ascending=True, sf_path=[], block_size=None,
+        estimates=None, position=None, resume=None, index_only=None, key_length=None, explain=False):
     """
         A generator which will traverse an index.
         The iterator should yield rowids.
@@ -311,104 +812,128 @@ def index_order_traversal(gl_prefix, index, ranges=None, ascending=True, sf_path
             ^DIZ(999900,"B","hello there from unit test2",185)=""
             ^DIZ(999900,"B","record 1",1)=""
 
+        The (key, rowid) pairs are pulled from M a block at a time.
+        ranges is a list of key ranges, visited in order.
+        estimates are the planner's row estimates for the candidate indices, for explain.
+        position and resume are as for file_order_traversal, with the index key.
+
+        index_only is the fieldid the index is keyed on, for an index-only
+        scan. Each row carries {index_only: key}, so the record is not read.
+        A key of key_length characters may have been truncated by the
+        cross reference, so those rows are left to read the record.
     """
     gl = gl_prefix + '"%s",' % index
 
-    if ranges:
-        r = ranges[0]
-        from_value = r['from_value']
-        to_value = r['to_value']
-        from_rule = r['from_rule']
-        to_rule = r['to_rule']
-    else:
-        from_value, to_value, from_rule, to_rule = None, None, None, None
-
     if explain:
-        yield "index_order_traversal, ascending=%s, gl=%s, index=%s, X %s '%s' AND X %s '%s'" % (ascending,
-                gl, index, from_rule, from_value, to_rule, to_value)
+        message = "index_order_traversal, ascending=%s, gl=%s, index=%s, %s" % (ascending,
+                gl, index, _explain_ranges(ranges, quote="'"))
+        if estimates:
+            message += ", estimated rows: %s" % ", ".join(["%s=%s" % item for item in sorted(estimates.items())])
+        if index_only:
+            message += ", index only"
+            if key_length:
+                message += " (keys of %s characters read from the record)" % key_length
+        yield message
         return
 
-    if from_value != None and to_value != None:
-        if ascending:
-            assert(from_value <= to_value)
-        else:
-            assert(to_value <= from_value)
-    
-    if from_value is None:
-        if ascending:
-            lastkey = " "
-        else:
-            lastkey = "ZZZZZZZZZZZZZZ"
-        lastrowid = ""
-    else:
-        lastkey = from_value
-        if from_rule == '>':
-            lastrowid = None   # looks for the next key after lastkey
+    if ranges is None:
+        ranges = [None]
+
+    for range_no, r in enumerate(ranges):
+        if resume and range_no < resume['range']:
+            continue
+
+        if r:
+            from_value = r['from_value']
+            to_value = r['to_value']
+            from_rule = r['from_rule']
+            to_rule = r['to_rule']
         else:
-            lastrowid = ''     # looks for the lastkey
+            from_value, to_value, from_rule, to_rule = None, None, None, None
 
+        if from_value != None and to_value != None:
+            if ascending:
+                assert(from_value <= to_value)
+            else:
+                assert(to_value <= from_value)
 
-    if ascending:
-        asc = 1
-    else:
-        asc = -1
+        if resume and range_no == resume['range']:
+            # continue after the last row returned
+            lastkey, lastrowid = resume['key'], resume['rowid']
+        else:
+            lastkey, lastrowid = index_start(from_value, from_rule)
 
-    # TODO: Fileman seems to structure indices with keys in the global path
-    #       or in the value - need to investigate further
+        # TODO: Fileman seems to structure indices with keys in the global path
+        #       or in the value - need to investigate further
 
-    # There is a mad collation approach in M, where numbers sort before non-numbers.
-    # this really messes up the keys.
-    # How should I search? 
+        # There is a mad collation approach in M, where numbers sort before non-numbers.
+        # this really messes up the keys.
+        # How should I search? 
 
-    # There is an inefficiency here it takes three searches to find the next record.
-    while 1:
-        if lastrowid is None:
-            # locate the next matching index value
-            lastkey, = M.mexec("""set s0=$order(%ss0),%s)""" % (gl, asc), M.INOUT(str(lastkey)))
-            if lastkey == "":
+        for lastkey, lastrowid in index_block_walk(gl, lastkey, lastrowid, ascending, block_size):
+            in_range = key_in_range(lastkey, ascending, from_value, from_rule, to_value, to_rule)
+            if in_range < 0:
+                continue
+            if in_range > 0:
                 break
 
-            if ascending:
-                if from_value is not None:
-                    if from_rule == ">" and lastkey <= from_value:
-                        continue
-                    if from_rule == ">=" and lastkey < from_value:
-                        assert 0
-                if to_value is not None:
-                    if to_rule == "<=" and lastkey > to_value:
-                        break
-                    if to_rule == "=" and lastkey != to_value:
-                        break
-                    if to_rule == "<" and lastkey >= to_value:
-                        break
-                lastkey = lastkey
-                lastrowid = "0"
-
-            else: # descending
-                if from_value is not None:
-                    if from_rule == "<" and lastkey >= from_value:
-                        continue
-                    if from_rule == "<=" and lastkey > from_value:
-                        assert 0
-                if to_value is not None:
-                    if to_rule == ">=" and lastkey < to_value:
-                        break
-                    if to_rule == "=" and lastkey != to_value:
-                        break
-                    if to_rule == ">" and lastkey <= to_value:
-                        break
-                lastkey = lastkey
-                lastrowid = ""
-
-        # Have the key, get the first matching rowid
-        lastrowid, = M.mexec("""set s0=$order(%s"%s",s1),%d)""" % (gl, lastkey, asc),
-                M.INOUT(str(lastkey)), lastrowid)
-        if lastrowid == "":
-            # No match
-            lastrowid = None
-            continue
+            if position is not None:
+                position.update(range=range_no, key=lastkey, rowid=lastrowid)
+
+            if index_only and not (key_length and len(lastkey) >= key_length):
+                yield (lastrowid, "%s%s)" % (gl_prefix, lastrowid), sf_path + [lastrowid], {index_only: lastkey})
+            else:
+                yield (lastrowid, "%s%s)" % (gl_prefix, lastrowid), sf_path + [lastrowid])
+
+    if position is not None:
+        position['done'] = True
+
+def index_set_traversal(gl_prefix, scans, combine='and', ascending=True, gl_cache=None, storage_nodes=None,
+        block_size=None, position=None, resume=None, explain=False):
+    """
+        Walk several indices, collecting the rowids from each, and combine
+        the sets before any record is read - the intersection for "and",
+        the union for "or".
+
+            scans is a list of (index, ranges). An index of None is a
+            list of rowids, given as single key ranges.
+
+        The records are emitted in rowid order. A resumed traversal
+        starts after the rowid of the resume position.
+    """
+    if explain:
+        yield "index_set_traversal, combine=%s, ascending=%s, %s" % (combine, ascending,
+            "; ".join(["index=%s, %s" % (index, _explain_ranges(ranges, quote="'")) for (index, ranges) in scans]))
+        return
 
-        yield (lastrowid, "%s%s)" % (gl_prefix, lastrowid), sf_path + [lastrowid])
+    rowids = None
+    for index, ranges in scans:
+        if index is None:
+            found = set([_as_key(r['from_value']) for r in ranges])
+        else:
+            found = set([rowid for (rowid, rec_gl_closed_form, rowid_path)
+                in index_order_traversal(gl_prefix, index, ranges, block_size=block_size)])
+        if rowids is None:
+            rowids = found
+        elif combine == 'and':
+            rowids.intersection_update(found)
+        else:
+            rowids.update(found)
+        if combine == 'and' and not rowids:
+            break
+
+    rowids = sorted(rowids or [], key=_m_collation, reverse=not ascending)
+    if resume:
+        last = _m_collation(resume['rowid'])
+        if ascending:
+            rowids = [rowid for rowid in rowids if _m_collation(rowid) > last]
+        else:
+            rowids = [rowid for rowid in rowids if _m_collation(rowid) < last]
+    ranges = [{'from_value': rowid, 'to_value': rowid, 'from_rule': ascending and '>=' or '<=',
+        'to_rule': ascending and '<=' or '>='} for rowid in rowids]
+    for row in file_order_traversal(gl_prefix, ranges, ascending, gl_cache=gl_cache, storage_nodes=storage_nodes,
+            block_size=block_size, position=position):
+        yield row
 
 #------------------------------------------------------------------------------------------------
 
@@ -431,12 +956,40 @@ def _filters_to_sargable(filters):
     """
     sargable = {}
     for fieldid, comparator, value in filters:
-        if (comparator in ["<", "<=", "=", ">=", ">"]) or (comparator.lower() in ["in"] and len(value) == 1):
+        if comparator.lower() == 'or':
+            # equalities on one column, or-ed together, are an "in"
+            fieldid, value = _or_as_in(value)
+            if fieldid is None:
+                continue
+            comparator = 'in'
+        if (comparator in ["<", "<=", "=", ">=", ">"]) or (comparator.lower() in ["in"]):
             if fieldid not in sargable.keys():
                 sargable[fieldid] = []
             sargable[fieldid].append((comparator, value))
     return sargable
 
+def _or_as_in(branches):
+    """
+        If every branch of an "or" is an equality (or "in") on the same
+        column, return the column and the list of values, else (None, None).
+    """
+    column, values = None, []
+    for branch in branches:
+        branch = _branch_filters(branch)
+        if len(branch) != 1:
+            return None, None
+        fieldid, comparator, value = branch[0]
+        if column is not None and fieldid != column:
+            return None, None
+        column = fieldid
+        if comparator == '=':
+            values.append(value)
+        elif comparator.lower() == 'in':
+            values.extend(value)
+        else:
+            return None, None
+    return column, values
+
 def _possible_indices(sargable, dd, parent_dd):
     """
         Given the sargable columns, which ones are actually indexed.
@@ -459,56 +1012,283 @@ def _possible_indices(sargable, dd, parent_dd):
             indices[col_fieldid].append(index.name)
     return indices
 
+def _m_collation(key):
+    """
+        Sort key giving the M collation of subscripts - canonic
+        numbers first, in numeric order, then strings.
+    """
+    if _M_CANONIC.match(key):
+        return (0, float(key), key)
+    return (1, 0, key)
+
+_M_CANONIC = re.compile(r'^(0|-?([1-9][0-9]*(\.[0-9]*[1-9])?|\.[0-9]*[1-9]))$')
+
+def _as_key(value):
+    if isinstance(value, basestring):
+        return value
+    return str(value)
+
 def _ranges_from_index_filters(index_filters, ascending=True):
     """
         Given a set of index filters, return a set of ranges.
 
         from, from_rule, to, to_rule
 
-        There can be more than one range where the "in" rule is provided
+        There can be more than one range where the "in" rule is provided.
+        Each value in the list gives a single key range. The ranges are
+        sorted into traversal order (M collation), without duplicates.
+        An empty list of ranges selects nothing.
     """
-    ### TODO: First attempt - only one set
-
     lb_value, lb_rule, ub_value, ub_rule = None, None, None, None
+    in_values = None
 
     for comparator, value in index_filters:
         comparator = comparator.lower()
-        if comparator in [">", ">=", "=", 'in']:
+        if comparator == 'in':
+            values = set([_as_key(v) for v in value])
+            if in_values is None:
+                in_values = values
+            else:
+                in_values = in_values.intersection(values)
+            continue
+        if comparator in [">", ">=", "="]:
             # TODO: comparason based on mumps rules, not python rules
             if lb_value is None or lb_value < value:
-                if comparator == 'in':
-                    assert(len(value) == 1)
-                    lb_value = value[0]
-                else:
-                    lb_value = value
-                if comparator in ["=", 'in']:
+                lb_value = value
+                if comparator in ["="]:
                     lb_rule = ">="
                 else:
                     lb_rule = comparator
             elif lb_value == value:
                 if lb_rule in [">="] and comparator in [">"]:
                     lb_rule = comparator
-        if comparator in ["<", "<=", "=", 'in']:
+        if comparator in ["<", "<=", "="]:
             # TODO: comparason based on mumps rules, not python rules
             if ub_value is None or ub_value > value:
-                if comparator == 'in':
-                    assert(len(value) == 1)
-                    ub_value = value[0]
-                else:
-                    ub_value = value
-                if comparator in ["=", 'in']:
+                ub_value = value
+                if comparator in ["="]:
                     ub_rule = "<="
                 else:
                     ub_rule = comparator
             elif ub_value == value:
                 if ub_rule in ["<="] and comparator in ["<"]:
                     ub_rule = comparator
+
+    if in_values is None:
+        ranges = [(lb_value, lb_rule, ub_value, ub_rule)]
+    else:
+        # Other bounds on the column are left to apply_filters
+        ranges = [(key, ">=", key, "<=") for key in sorted(in_values, key=_m_collation)]
+
     if ascending:
-        return [{'from_value':lb_value, 'to_value': ub_value, 'from_rule': lb_rule, 'to_rule': ub_rule}]
+        return [{'from_value': lb, 'to_value': ub, 'from_rule': lbr, 'to_rule': ubr} for (lb, lbr, ub, ubr) in ranges]
     else:
-        return [{'from_value':ub_value, 'to_value': lb_value, 'from_rule': ub_rule, 'to_rule': lb_rule}]
+        ranges.reverse()
+        return [{'from_value': ub, 'to_value': lb, 'from_rule': ubr, 'to_rule': lbr}
+            for (lb, lbr, ub, ubr) in ranges]
+
+# Fraction of the file selected by a range the index sample does not cover,
+# bounded on one side, and on both sides.
+RANGE_SELECTIVITY = 1.0 / 3
+BETWEEN_SELECTIVITY = 1.0 / 4
 
-def make_plan(dbsfile, filters=None, order_by=None, limit=None, offset=0, gl_cache=None, explain=False):
+# Rows which have to be sorted cost this many times a row in index order.
+SORT_COST = 2.0
+
+def estimate_rows(stats, ranges, file_rows):
+    """
+        Estimate the rows selected from an index by ascending ranges,
+        from the IndexStats for the index.
+
+        Keys are compared in M collation, as the index was sampled.
+    """
+    total = 0.0
+    for r in ranges:
+        lb, lb_rule, ub, ub_rule = r['from_value'], r['from_rule'], r['to_value'], r['to_rule']
+        if lb is not None:
+            lb = _m_collation(_as_key(lb))
+        if ub is not None:
+            ub = _m_collation(_as_key(ub))
+        if lb is None and ub is None:
+            if stats.complete:
+                total += stats.entries
+            else:
+                total += file_rows
+        elif stats.complete or (ub is not None and stats.last_key is not None
+                and ub < _m_collation(stats.last_key)):
+            # The range is within the sample
+            total += sum([rows for (key, rows) in stats.keys
+                if key_in_range(_m_collation(key), True, lb, lb_rule, ub, ub_rule) == 0])
+        elif _is_key(r):
+            total += stats.rows_per_key
+        elif lb is not None and ub is not None:
+            total += file_rows * BETWEEN_SELECTIVITY
+        else:
+            total += file_rows * RANGE_SELECTIVITY
+    return total
+
+def choose_index(dbsfile, candidates, order_by=None):
+    """
+        Choose the index with the lowest estimated number of rows.
+
+            candidates is a list of (fieldid, index, index_filters)
+
+        An index on the first order_by column saves sorting the result.
+        Returns fieldid, index and the estimates for each index.
+    """
+    file_rows = dbsfile.count()
+    best = None
+    estimates = {}
+    for fieldid, index, index_filters in sorted(candidates):
+        stats = index_stats(dbsfile.dd, index, file_rows)
+        rows = estimate_rows(stats, _ranges_from_index_filters(index_filters), file_rows)
+        estimates[index] = int(rows)
+        cost = rows
+        if order_by and order_by[0][0] != fieldid:
+            cost = cost * SORT_COST
+        if best is None or cost < best[0]:
+            best = (cost, fieldid, index)
+        logger.debug("choose_index: %s, %s", stats, rows)
+    return best[1], best[2], estimates
+
+# An index selecting more rows than this is not walked for an intersection.
+INTERSECT_MAX_ROWS = 100000
+
+# If the best index selects fewer rows than this, it is used on its own.
+INTERSECT_MIN_ROWS = 20
+
+def _intersection_scans(indices, sargable, estimates):
+    """
+        The index scans to intersect, smallest first, when more than one
+        index is selective. None if a single index will do.
+    """
+    selective = [(estimates[indices[fieldid][0]], fieldid) for fieldid in indices
+        if estimates.get(indices[fieldid][0], INTERSECT_MAX_ROWS + 1) <= INTERSECT_MAX_ROWS]
+    selective.sort()
+    if len(selective) < 2 or selective[0][0] < INTERSECT_MIN_ROWS:
+        return None
+    return [(indices[fieldid][0], _ranges_from_index_filters(sargable[fieldid])) for (rows, fieldid) in selective]
+
+def _branch_scan(dbsfile, filters):
+    """
+        The index scan for a branch of an "or", (index, ranges),
+        None if the branch cannot use an index.
+    """
+    sargable = _filters_to_sargable(filters)
+    if '_rowid' in sargable:
+        ranges = _ranges_from_index_filters(sargable['_rowid'])
+        if not [r for r in ranges if not _is_key(r)]:
+            return None, ranges
+    indices = _possible_indices(sargable, dbsfile.dd, None)
+    if not indices:
+        return None
+    if len(indices) == 1:
+        fieldid = indices.keys()[0]
+        index = indices[fieldid][0]
+    else:
+        candidates = [(fieldid, indices[fieldid][0], sargable[fieldid]) for fieldid in indices]
+        fieldid, index, estimates = choose_index(dbsfile, candidates)
+    return index, _ranges_from_index_filters(sargable[fieldid])
+
+def _union_scans(dbsfile, filters):
+    """
+        The index scans to union for an "or" group in the filters,
+        if every branch of it can use an index.
+    """
+    for fieldid, comparator, value in filters:
+        if comparator.lower() != 'or':
+            continue
+        scans = []
+        for branch in value:
+            scan = _branch_scan(dbsfile, _branch_filters(branch))
+            if scan is None:
+                break
+            scans.append(scan)
+        else:
+            if scans:
+                return scans
+    return None
+
+def _is_key(r):
+    """
+        True if the range r selects a single key.
+    """
+    return (r is not None and r['from_value'] is not None and r['from_value'] == r['to_value']
+            and r['from_rule'] in ('>=', '<=') and r['to_rule'] in ('>=', '<='))
+
+def _single_key(ranges):
+    """
+        True if the index ranges select a single key.
+    """
+    return ranges is not None and len(ranges) == 1 and _is_key(ranges[0])
+
+def _ordering_satisfies(ordering, order_by):
+    """
+        ordering is the order a traversal produces rows in, as
+        a list of (fieldid, ascending). True if that is the order_by,
+        so the result does not need to be sorted.
+    """
+    if len(order_by) > len(ordering):
+        return False
+    for (fieldid, ascending), (order_fieldid, direction) in zip(ordering, order_by):
+        if fieldid != order_fieldid or ascending != (direction == 'ASC'):
+            return False
+    return True
+
+def _plan_fieldids(fieldids, filters, order_by):
+    """
+        The fields a plan reads - the projection, and the columns of the
+        filters and the order_by. None, for all the fields, if there is
+        no projection.
+    """
+    if fieldids is None:
+        return None
+    needed = set(fieldids)
+
+    def add_filters(filters):
+        for fieldid, comparator, value in filters:
+            if comparator.lower() == 'or':
+                for branch in value:
+                    add_filters(_branch_filters(branch))
+            else:
+                needed.add(fieldid)
+
+    add_filters(filters or [])
+    for fieldid, direction in order_by or []:
+        needed.add(fieldid)
+    return list(needed)
+
+def _index_only_args(dbsfile, index, fieldid, fieldids, filters, order_by):
+    """
+        Can the rows be read from the index alone? The projection, the
+        filters and the order_by must only use the indexed column, and the index
+        must be keyed on its value. Returns the index_order_traversal
+        arguments for an index-only scan, or {}.
+    """
+    if not fieldids or not dbsfile.internal:
+        return {}
+    dd = dbsfile.dd
+    field = dd.fields.get(fieldid)
+    if field is None or field.fmql_type not in (FT_TEXT, FT_SET, FT_NUMERIC, FT_DATETIME, FT_POINTER):
+        return {}
+    if [f for f in _plan_fieldids(fieldids, filters, order_by) if f not in (fieldid, '_rowid')]:
+        return {}
+    for idx in dd.indices:
+        if idx.name == index and idx.table == dd.fileid and idx.columns == [fieldid] and idx.value_key:
+            return dict(index_only=fieldid, key_length=idx.key_length)
+    return {}
+
+def _estimated_rows(dbsfile, limit=None):
+    """
+        Rows the sort may see, from the record count in the file header.
+        Not needed when there is a limit.
+    """
+    if limit is not None:
+        return None
+    return dbsfile.count()
+
+def make_plan(dbsfile, filters=None, order_by=None, limit=None, offset=0, gl_cache=None, block_size=None,
+        prefetch=False, sort_budget=None, position=None, resume=None, fieldids=None, explain=False):
     """
         Given the filters and the order_by clause
         return an iterator which produces the matching
@@ -520,14 +1300,35 @@ def make_plan(dbsfile, filters=None, order_by=None, limit=None, offset=0, gl_cac
         limit, offset extract a subset from the results
         gl_cache is used to cache globals retrieved to 
         avoid extra calls into M
+        block_size is the number of index entries or records fetched per call into M
+        prefetch loads the record nodes into the gl_cache on file order traversals
+        fieldids is the projection the rows are read for. Only the record nodes
+        it, the filters and the order_by need are prefetched. If the projection
+        and the filters only use the column of the index traversed, and
+        the rows come in the order asked for, the rows are read from the
+        index alone.
+        sort_budget is the number of rows a sort holds in memory before spilling to disk
+
+        position is a dictionary which follows the traversal. It describes
+        the plan, and is 'resumable' if the rows stream in traversal order,
+        i.e. there is no sort. The range, key and rowid of the last row
+        returned can be passed back as resume, to continue the query
+        after that row. The offset is not applied to a resumed query.
     """
     pipeline = None
 
     dd = dbsfile.dd
 
     if dd.parent_dd:
+        if resume:
+            raise FilemanError("Subfile queries can not be resumed")
+        if position is not None:
+            position['resumable'] = False
         return make_subfile_plan(dbsfile, filters=filters, order_by=order_by, limit=limit, offset=offset, gl_cache=gl_cache, explain=explain)
 
+    if resume:
+        offset = 0
+
     ### First we need a traverser. There are a number of options,
     ### file_order_traversal - order by the file records
     ### index_order_traversal - traverse the file using a traditional index
@@ -541,98 +1342,159 @@ def make_plan(dbsfile, filters=None, order_by=None, limit=None, offset=0, gl_cac
 
     gl_prefix = dbsfile.dd.m_open_form()
 
+    if prefetch and gl_cache is not None:
+        storage_nodes = dd.storage_nodes(_plan_fieldids(fieldids, filters, order_by))
+    else:
+        storage_nodes = None
+    fetch = dict(gl_cache=gl_cache, storage_nodes=storage_nodes, block_size=block_size)
+    track = dict(position=position, resume=resume)
+    index = None
+    ascending = True
+
     ### Case 1: Straight file dump
     if not filters and not order_by:
-        pipeline = file_order_traversal(gl_prefix, explain=explain)
+        pipeline = file_order_traversal(gl_prefix, explain=explain, **dict(fetch, **track))
+        traversal = 'file'
     
     ### Case 2:  if there is no filters, but there is an order by,
     #            find an index for the order_by
     #            format of order_by: "order_by": [["_rowid", "ASC"]
 
     elif not filters and order_by:
-        if len(order_by) > 1:
-            logging.warn("Extra columns on order-by, currently ignored %s", order_by)
-
-        if len(order_by) == 1 and order_by[0][0] == '_rowid':
-            if order_by[0][1] == 'ASC':
-                pipeline = file_order_traversal(gl_prefix, explain=explain)
-            else:
-                pipeline = file_order_traversal(gl_prefix, ascending=False, explain=explain)
+        ascending = (order_by[0][1] == 'ASC')
+        if order_by[0][0] == '_rowid':
+            pipeline = file_order_traversal(gl_prefix, ascending=ascending, explain=explain, **dict(fetch, **track))
+            ordering = [('_rowid', ascending)]
+            traversal = 'file'
 
         else:
             # TODO: Subfiles
             order_fieldid = order_by[0][0]
             index = _index_for_column(dd, order_fieldid)
             if index:
-                pipeline = index_order_traversal(gl_prefix, index, ascending = (order_by[0][1] == 'ASC'), explain=explain)
+                ordering = [(order_fieldid, ascending), ('_rowid', ascending)]
+                if not _ordering_satisfies(ordering, order_by):
+                    index_only = {}   # the sort reads the records
+                else:
+                    index_only = _index_only_args(dbsfile, index, order_fieldid, fieldids, filters, order_by)
+                pipeline = index_order_traversal(gl_prefix, index, ascending=ascending,
+                        block_size=block_size, explain=explain, **dict(index_only, **track))
+                traversal = 'index'
             else:
-                pipeline = file_order_traversal(gl_prefix, explain=explain)
-                pipeline = sorter(pipeline, order_by, dd, gl_cache, explain=explain)
+                ascending = True
+                pipeline = file_order_traversal(gl_prefix, explain=explain, **dict(fetch, **track))
+                ordering = [('_rowid', True)]
+                traversal = 'file'
 
-            
     ### Case 3: There are filters
     else:
 
         # 1. Identify the sargable columns
         sargable = _filters_to_sargable(filters)
+
+        # 2. find columns with indexes
+        #    choose the preferred index (sargable + orderable, fileorder, first index)
+        estimates = None
         if not sargable:
-            pipeline = file_order_traversal(gl_prefix, explain=explain)
-        else:
+            fieldid = None
+            index = None
 
-            # 2. find columns with indexes
-            #    choose the preferred index (sargable + orderable, fileorder, first index)
-            if len(sargable.keys()) == 1 and sargable.keys()[0] == '_rowid':
-                # direct record retrieve - indexes not necessary
-                fieldid = "_rowid"
-                index = None
+        elif len(sargable.keys()) == 1 and sargable.keys()[0] == '_rowid':
+            # direct record retrieve - indexes not necessary
+            fieldid = "_rowid"
+            index = None
 
-            else:
-                indices =  _possible_indices(sargable, dd, None)
-                if len(indices) == 0:
-                    fieldid = None
-                    index = None
+        else:
+            indices =  _possible_indices(sargable, dd, None)
+            if len(indices) == 0:
+                fieldid = None
+                index = None
 
-                elif len(indices) == 1:
-                    fieldid = indices.keys()[0]
-                    index = indices[fieldid][0]  # There can be more than one - why?
+            elif len(indices) == 1:
+                fieldid = indices.keys()[0]
+                index = indices[fieldid][0]  # There can be more than one - why?
 
-                else:
-                    # More than one option. How to choose the best?
-                    # result order, file order, other?
-                    # or '=' has precendence over range?
-
-                    # Choose first for now
-                    fieldid = indices.keys()[0]
-                    index = indices[fieldid][0]
-
-            # At this point we have choosen an index. Have to choose the 
-            # traversal rules, and remove the index from the filters
-            if fieldid:
-                index_filters = sargable[fieldid]
             else:
-                index_filters = []
+                # More than one option. Choose on the estimated rows
+                # from the index statistics, preferring the result order.
+                candidates = [(fieldid, indices[fieldid][0], sargable[fieldid]) for fieldid in indices]
+                pinned = [c for c in candidates if resume and resume.get('index') == c[1]]
+                if pinned:
+                    # A resumed query stays on the index it started with.
+                    fieldid, index = pinned[0][:2]
+                else:
+                    fieldid, index, estimates = choose_index(dbsfile, candidates, order_by)
+
+        # 3. Combine indices - several selective indices are intersected,
+        #    an "or" where every branch has an index is a union.
+        scans, combine = None, None
+        if estimates and not (limit is not None and order_by and order_by[0][0] == fieldid):
+            scans, combine = _intersection_scans(indices, sargable, estimates), 'and'
+        if not scans and index == None and fieldid != '_rowid':
+            scans, combine = _union_scans(dbsfile, filters), 'or'
+
+        # No index for the filters - an index on the order_by column
+        # saves sorting the result. Rows with an empty value are not in
+        # the index, so the column must be mandatory.
+        if (not scans and index == None and fieldid != '_rowid' and order_by
+                and order_by[0][0] not in ('_rowid', '_parentid')
+                and getattr(dd.fields.get(order_by[0][0]), 'mandatory', False)):
+            index = _index_for_column(dd, order_by[0][0])
+            if index:
+                fieldid = order_by[0][0]
 
-            # Ignoring sub-order-by rules
-            if index == None and order_by and order_by[0][0] == '_rowid':
-                ascending = (order_by[0][1] == 'ASC')
-            elif order_by and order_by[0][0] == fieldid:
-                ascending = (order_by[0][1] == 'ASC')
-            else:
-                ascending = True
+        # At this point we have choosen an index. Have to choose the 
+        # traversal rules, and remove the index from the filters
+        if fieldid in sargable:
+            index_filters = sargable[fieldid]
+        else:
+            index_filters = []
 
-            ranges = _ranges_from_index_filters(index_filters, ascending)
+        if order_by and order_by[0][0] == ((index and not scans) and fieldid or '_rowid'):
+            ascending = (order_by[0][1] == 'ASC')
+        else:
+            ascending = True
 
-            if index == None:
-                pipeline = file_order_traversal(gl_prefix, ranges=ranges, ascending=ascending, explain=explain)
+        ranges = _ranges_from_index_filters(index_filters, ascending)
+
+        if scans:
+            pipeline = index_set_traversal(gl_prefix, scans, combine, ascending=ascending, explain=explain,
+                    **dict(fetch, **track))
+            ordering = [('_rowid', ascending)]
+            traversal, index = 'set', None
+        elif index == None:
+            pipeline = file_order_traversal(gl_prefix, ranges=ranges, ascending=ascending, explain=explain,
+                    **dict(fetch, **track))
+            ordering = [('_rowid', ascending)]
+            traversal = 'file'
+        else:
+            traversal = 'index'
+            ordering = [(fieldid, ascending), ('_rowid', ascending)]
+            if _single_key(ranges):
+                # All the rows have the same key, they are in rowid order.
+                ordering = ordering[1:]
+            if order_by and not _ordering_satisfies(ordering, order_by):
+                index_only = {}   # the sort reads the records
             else:
-                pipeline = index_order_traversal(gl_prefix, index=index, ranges=ranges, ascending=ascending, explain=explain)
+                index_only = _index_only_args(dbsfile, index, fieldid, fieldids, filters, order_by)
+            pipeline = index_order_traversal(gl_prefix, index=index, ranges=ranges, ascending=ascending,
+                    block_size=block_size, estimates=estimates, explain=explain, **dict(index_only, **track))
 
-        if order_by:
-            pipeline = sorter(pipeline, order_by, dd, gl_cache, explain=explain)
-
-    if filters:
         pipeline = apply_filters(pipeline, dbsfile, filters, gl_cache, explain=explain)
 
+    # Sort, if the traversal does not give the order. Filters are applied
+    # first, so that only the matching rows are sorted.
+    needs_sort = order_by and not _ordering_satisfies(ordering, order_by)
+    if needs_sort:
+        pipeline = _sort_stage(pipeline, order_by, dd, gl_cache, limit, offset, sort_budget,
+                    _estimated_rows(dbsfile, limit), block_size, explain=explain)
+
+    if position is not None:
+        position.update(traversal=traversal, index=index, ascending=ascending, resumable=not needs_sort)
+    if resume and (needs_sort or (resume.get('traversal'), resume.get('index'), resume.get('ascending'))
+            != (traversal, index, ascending)):
+        raise FilemanError("Continuation token does not match the query plan")
+
     if offset or limit:
         pipeline = offset_limit(pipeline, limit=limit, offset=offset, explain=explain)
 
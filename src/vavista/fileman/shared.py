@@ -3,6 +3,10 @@
     Functionality shared across fileman modules
 """
 
+import base64
+import hashlib
+import json
+
 class FilemanError(Exception):
     def __init__(self, message, *args, **kwargs):
         self._message = message
@@ -94,3 +98,39 @@ def clean_rowid(rowid):
     if rowid is None: return None
     return ('%f' % float(rowid)).rstrip('0').rstrip('.').lstrip('0')
 
+
+#---------- Continuation tokens --------------------------------------
+
+def query_digest(*args):
+    """
+        A short digest of the arguments of a query or traversal.
+        A continuation token is only accepted by the query which issued it.
+    """
+    return hashlib.md5(json.dumps(args, sort_keys=True, default=str)).hexdigest()[:16]
+
+def encode_continuation(state):
+    """
+        Pack the position a query or traversal stopped at, e.g.
+
+            {'digest': ..., 'index': 'B', 'ascending': True, 'key': 'ROW4', 'rowid': '4'}
+
+        into an opaque token. The M keys are byte strings, they are
+        carried as latin-1.
+    """
+    state = dict([(k, isinstance(v, str) and v.decode('latin-1') or v) for (k, v) in state.items()])
+    return base64.urlsafe_b64encode(json.dumps(state, sort_keys=True))
+
+def decode_continuation(token, digest=None):
+    """
+        Unpack a token made by encode_continuation. If a digest is given,
+        the token must have been issued for the same query.
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        raise FilemanError("Invalid continuation token")
+    if type(state) != dict:
+        raise FilemanError("Invalid continuation token")
+    if digest is not None and state.get('digest') != digest:
+        raise FilemanError("Continuation token was not issued for this query")
+    return dict([(str(k), isinstance(v, unicode) and v.encode('latin-1') or v) for (k, v) in state.items()])
@@ -0,0 +1,244 @@
+"""
+    Binary codec for the filemand protocol.
+
+    An alternative to JSON for the data in a request or response,
+    negotiated per connection with the set_codec request. Query
+    results are lists of rows, so lists of equal length lists are
+    stored by column, and a column of strings is a block of lengths
+    followed by the strings, which is cheap to pack and unpack.
+
+    Every value is a one byte tag followed by its body. Counts and
+    lengths are 4 byte network order integers.
+
+        N None, T True, F False
+        i 8 byte integer, I a larger integer as decimal digits
+        f 8 byte float
+        s byte string, u unicode as utf-8 - length, then the bytes
+        l list - count, then the items
+        d dict - count, then the key, value pairs
+        D date - 2 byte year, month, day
+        Z datetime - 2 byte year, month, day, hour, minute, second
+        C table - a list of lists of the same length. Row count,
+            column count, then each column as a value.
+        S string column - count, the lengths, then the strings
+        E exception - a dict describing the exception, which is
+            raised when it is decoded.
+"""
+
+import datetime
+import struct
+import time
+
+from shared import FilemanErrorNumber, FilemanError
+
+_COUNT = struct.Struct("!L")
+_TABLE = struct.Struct("!LL")
+_INT = struct.Struct("!q")
+_FLOAT = struct.Struct("!d")
+_DATE = struct.Struct("!HBB")
+_DATETIME = struct.Struct("!HBBBBB")
+
+_INT_MIN, _INT_MAX = -2**63, 2**63 - 1
+
+def raise_exception(dct):
+    """
+        Raise the exception described by a response from the server,
+        {"__exception__": "FilemanError", "message": ...}
+    """
+    if dct["__exception__"] == "FilemanErrorNumber":
+        raise FilemanErrorNumber(codes=dct["codes"], texts=dct["texts"])
+    raise FilemanError(dct.get("message", dct["__exception__"]))
+
+def _is_table(value):
+    """
+        True if value is a list of two or more lists of the same length.
+    """
+    if len(value) < 2 or type(value[0]) not in (list, tuple):
+        return False
+    width = len(value[0])
+    if width == 0:
+        return False
+    for row in value:
+        if type(row) not in (list, tuple) or len(row) != width:
+            return False
+    return True
+
+def _encode(value, out):
+    t = type(value)
+    if t is str:
+        out.append('s' + _COUNT.pack(len(value)))
+        out.append(value)
+    elif value is None:
+        out.append('N')
+    elif t is bool:
+        out.append(value and 'T' or 'F')
+    elif t in (int, long):
+        if _INT_MIN <= value <= _INT_MAX:
+            out.append('i' + _INT.pack(value))
+        else:
+            digits = str(value)
+            out.append('I' + _COUNT.pack(len(digits)) + digits)
+    elif t is float:
+        out.append('f' + _FLOAT.pack(value))
+    elif t is unicode:
+        value = value.encode('utf-8')
+        out.append('u' + _COUNT.pack(len(value)))
+        out.append(value)
+    elif t in (list, tuple):
+        if _is_table(value):
+            out.append('C' + _TABLE.pack(len(value), len(value[0])))
+            for column in zip(*value):
+                _encode_column(column, out)
+        else:
+            out.append('l' + _COUNT.pack(len(value)))
+            for item in value:
+                _encode(item, out)
+    elif t is dict:
+        if "__exception__" in value:
+            out.append('E')
+        out.append('d' + _COUNT.pack(len(value)))
+        for k, v in value.iteritems():
+            _encode(k, out)
+            _encode(v, out)
+    elif t is datetime.datetime:
+        # not interested in the milliseconds
+        out.append('Z' + _DATETIME.pack(value.year, value.month, value.day,
+            value.hour, value.minute, value.second))
+    elif t is datetime.date:
+        out.append('D' + _DATE.pack(value.year, value.month, value.day))
+    else:
+        raise TypeError, 'Object of type %s with value of %s can not be encoded' % (type(value), repr(value))
+
+def _encode_column(column, out):
+    for item in column:
+        if type(item) is not str:
+            _encode(column, out)
+            return
+    out.append('S' + _COUNT.pack(len(column)))
+    out.append(struct.pack("!%dL" % len(column), *[len(item) for item in column]))
+    out.append(''.join(column))
+
+def dumps(value):
+    """
+        Encode a value as a byte string.
+    """
+    out = []
+    _encode(value, out)
+    return ''.join(out)
+
+class _Decoder:
+
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+
+    def unpack(self, fmt):
+        values = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def read(self, length):
+        start = self.offset
+        self.offset += length
+        return str(self.data[start:self.offset])
+
+    def decode(self):
+        tag = self.data[self.offset]
+        self.offset += 1
+        if tag == 's':
+            length, = self.unpack(_COUNT)
+            return self.read(length)
+        if tag == 'S':
+            count, = self.unpack(_COUNT)
+            lengths = struct.unpack_from("!%dL" % count, self.data, self.offset)
+            self.offset += 4 * count
+            rv = []
+            for length in lengths:
+                rv.append(self.read(length))
+            return rv
+        if tag == 'C':
+            rows, columns = self.unpack(_TABLE)
+            columns = [self.decode() for i in range(columns)]
+            return [list(row) for row in zip(*columns)]
+        if tag == 'l':
+            count, = self.unpack(_COUNT)
+            return [self.decode() for i in range(count)]
+        if tag == 'N':
+            return None
+        if tag == 'T':
+            return True
+        if tag == 'F':
+            return False
+        if tag == 'i':
+            return self.unpack(_INT)[0]
+        if tag == 'I':
+            length, = self.unpack(_COUNT)
+            return long(self.read(length))
+        if tag == 'f':
+            return self.unpack(_FLOAT)[0]
+        if tag == 'u':
+            length, = self.unpack(_COUNT)
+            return self.read(length).decode('utf-8')
+        if tag == 'd':
+            count, = self.unpack(_COUNT)
+            rv = {}
+            for i in range(count):
+                k = self.decode()
+                rv[k] = self.decode()
+            return rv
+        if tag == 'D':
+            return datetime.date(*self.unpack(_DATE))
+        if tag == 'Z':
+            return datetime.datetime(*self.unpack(_DATETIME))
+        if tag == 'E':
+            raise_exception(self.decode())
+        raise ValueError("Invalid tag %r at offset %d" % (tag, self.offset - 1))
+
+def loads(data):
+    """
+        Decode a value encoded by dumps. data can be a string, or
+        a buffer over the received bytes.
+    """
+    if not isinstance(data, str):
+        data = buffer(data)
+    return _Decoder(data).decode()
+
+#------------------------------------------------------------------------------------------------
+
+def benchmark(rows=10000, columns=8, repeat=5):
+    """
+        Compare the JSON and binary codecs on a dbsfile_query page of
+        rows, as sent by the server. Returns {codec: (bytes, encode seconds,
+        decode seconds)}, the best of repeat runs.
+    """
+    import json
+    from clientserver import json_encoder, json_decoder
+
+    payload = {'rows': [[str(rowid), ['VALUE %d/%d' % (rowid, column) for column in range(columns - 2)]
+            + [str(3120716 + rowid % 300), datetime.datetime(2012, 7, 16, rowid % 24, rowid % 60)]]
+            for rowid in range(1, rows + 1)], 'more': True, 'continuation': None}
+
+    codecs = [
+        ('json', lambda value: json.dumps(value, default=json_encoder),
+            lambda data: json.loads(data, object_hook=json_decoder)),
+        ('binary', dumps, loads),
+    ]
+    rv = {}
+    for name, encode, decode in codecs:
+        best_encode, best_decode = None, None
+        for i in range(repeat):
+            start = time.time()
+            data = encode(payload)
+            encoded = time.time()
+            decode(data)
+            decoded = time.time()
+            if best_encode is None or encoded - start < best_encode:
+                best_encode = encoded - start
+            if best_decode is None or decoded - encoded < best_decode:
+                best_decode = decoded - encoded
+        rv[name] = (len(data), best_encode, best_decode)
+    return rv
+
+if __name__ == "__main__":
+    for name, (size, encode, decode) in sorted(benchmark().items()):
+        print "%-8s %10d bytes  encode %.4fs  decode %.4fs" % (name, size, encode, decode)
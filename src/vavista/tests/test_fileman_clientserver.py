@@ -0,0 +1,516 @@
+"""
+    Test the filemand client / server protocol.
+
+    The server runs in a thread, connected to the client over a socket
+    pair. The files are stand-ins, so the tests do not touch the
+    M database.
+"""
+
+import datetime
+import socket
+import threading
+import time
+import unittest
+
+from vavista.fileman import wirecodec
+from vavista.fileman.asyncclient import AsyncFilemandClient
+from vavista.fileman.clientserver import CODECS, FilemandClient, FilemandClientPool, FilemandServer
+from vavista.fileman.shared import FilemanError
+
+class QueryRows:
+    """
+        Stand-in for the iterator returned by DBSFile.query
+    """
+    continuation = "TOKEN"
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.rows.next()
+
+class TestFile:
+    """
+        Stand-in for a DBSFile
+    """
+    ext_filename = "TESTFILE"
+    fileid = "999"
+    fields = None
+
+    def __init__(self, count):
+        self.rows = [(str(i), ['ROW%d' % i]) for i in range(1, count + 1)]
+
+    def fieldnames(self, fields=None):
+        return fields or ['.01']
+
+    def get(self, rowid, asdict=False, fields=None):
+        self.fields = fields
+        if rowid == 'LARGE':
+            return ['X' * 200000, rowid]
+        for row in self.rows:
+            if row[0] == rowid:
+                return row[1]
+        raise FilemanError("No such row %s" % rowid)
+
+    def query(self, limit=None, offset=None, filters=None, order_by=None, continuation=None, fields=None):
+        self.fields = fields
+        return QueryRows(self.rows[:limit])
+
+    def count(self, limit=None):
+        return len(self.rows)
+
+    def lock(self, _rowid, timeout=5):
+        return None
+
+    def unlock(self, _rowid):
+        return True
+
+class TestDBS:
+    """
+        Stand-in for the server's DBS
+    """
+    def __init__(self):
+        self.opened = []
+
+    def get_file(self, name, internal=True, fieldnames=None, fieldids=None):
+        if name != "TESTFILE":
+            raise FilemanError("File not found [%s]" % name)
+        self.opened.append(name)
+        return TestFile(250)
+
+class SocketClient(FilemandClient):
+    """
+        A client on an already connected socket
+    """
+    def __init__(self, client_socket):
+        self.socket = client_socket
+        self.connected = True
+        self._responses = {}
+
+class TestClientServer(unittest.TestCase):
+
+    def setUp(self):
+        server_socket, client_socket = socket.socketpair()
+        self.server = FilemandServer(server_socket)
+        self.server.handles = {1: TestFile(250)}
+        self.thread = threading.Thread(target=self.server)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.client = SocketClient(client_socket)
+
+        self.requests = []
+        mk_request = self.client._mk_request
+        def trace(request_id, handle=None, data=None):
+            self.requests.append(request_id)
+            return mk_request(request_id, handle, data)
+        self.client._mk_request = trace
+
+    def tearDown(self):
+        self.client.connected = False
+        self.client.socket.close()
+        self.thread.join(5)
+
+    def test_cursor(self):
+        """
+            Query rows are read from a server side cursor a page at a time.
+        """
+        cursor = self.client.dbsfile_query("1", None, None, True, None, None)
+        self.assertEqual(self.requests, ["dbsfile_query_open"])
+
+        row = cursor.next()
+        self.assertEqual(row['.01'], 'ROW1')
+        self.assertEqual(row['_rowid'], '1')
+        self.assertEqual(self.requests.count("cursor_fetchmany"), 1)
+
+        rows = list(cursor)
+        self.assertEqual(len(rows), 249)
+        self.assertEqual(rows[-1]['.01'], 'ROW250')
+        self.assertEqual(self.requests.count("cursor_fetchmany"), 3)
+
+        # The exhausted cursor is dropped by the server
+        self.assertEqual(self.server.handles.keys(), [1])
+
+    def test_cursor_close(self):
+        """
+            A cursor closed before the end is dropped from the server.
+        """
+        cursor = self.client.dbsfile_query("1", None, None, False, None, None)
+        self.assertEqual(cursor.next(), ['ROW1'])
+        self.assertEqual(len(self.server.handles), 2)
+        cursor.close()
+        self.assertEqual(self.requests[-1], "cursor_close")
+        self.assertEqual(self.server.handles.keys(), [1])
+
+    def test_cursor_limit(self):
+        """
+            A page of limit rows is fetched in one request.
+        """
+        cursor = self.client.dbsfile_query("1", 10, None, False, None, None)
+        self.assertEqual(len(list(cursor)), 10)
+        self.assertEqual(self.requests.count("cursor_fetchmany"), 1)
+        self.assertEqual(cursor.continuation, "TOKEN")
+
+    def test_projection(self):
+        """
+            The fields of a query or get are passed to the server's file,
+            and the rows are named for them.
+        """
+        cursor = self.client.dbsfile_query("1", 5, None, True, None, None, fields=['NAME'])
+        self.assertEqual(cursor.next()['NAME'], 'ROW1')
+        self.assertEqual(self.server.handles[1].fields, ['NAME'])
+
+        self.assertEqual(self.client.dbsfile_get("1", "2", False, fields=['.01']), ['ROW2'])
+        self.assertEqual(self.server.handles[1].fields, ['.01'])
+
+    def test_codec(self):
+        """
+            The connection switches to the binary codec on request.
+        """
+        self.assertEqual(self.client.set_codec('binary'), 'binary')
+
+        cursor = self.client.dbsfile_query("1", None, None, False, None, None)
+        rows = list(cursor)
+        self.assertEqual(len(rows), 250)
+        self.assertEqual(rows[4], ['ROW5'])
+        # The server switches after answering set_codec, so only check
+        # once it has answered a later request.
+        self.assertEqual(self.server.codec, 'binary')
+
+        self.assertEqual(self.client.dbsfile_get("1", '7', False), ['ROW7'])
+
+        # Unknown codecs fall back to json
+        self.assertEqual(self.client.set_codec('xml'), 'json')
+        self.assertEqual(self.client.dbsfile_get("1", '7', False), ['ROW7'])
+
+        # Errors are passed back to the client
+        self.client.set_codec('binary')
+        self.assertRaises(FilemanError, self.client.dbsfile_get, "1", '999', False)
+
+    def test_large_frame(self):
+        """
+            A frame larger than a socket buffer is sent and read whole.
+        """
+        for codec in ('json', 'binary'):
+            self.client.set_codec(codec)
+            row = self.client.dbsfile_get("1", 'LARGE', False)
+            self.assertEqual(len(row[0]), 200000)
+            self.assertEqual(row[1], 'LARGE')
+
+    def test_pipeline(self):
+        """
+            Requests are sent before any response is read. The
+            responses are matched to the requests by sequence id.
+        """
+        seqs = [self.client.send_request("dbsfile_get", "1", dict(rowid=str(i), asdict=False))
+            for i in range(1, 6)]
+        self.assertEqual(self.client.read_response(seqs[3]), ['ROW4'])
+        self.assertEqual([self.client.read_response(seq) for seq in seqs[:3]], [['ROW1'], ['ROW2'], ['ROW3']])
+        self.assertEqual(self.client.read_response(seqs[4]), ['ROW5'])
+
+    def test_batch(self):
+        """
+            A batch of requests is sent in one frame. An error is
+            raised by its own result.
+        """
+        with self.client.batch() as batch:
+            first = self.client.dbsfile_get("1", '1', False)
+            missing = self.client.dbsfile_get("1", '999', False)
+            self.client.dbsfile_get("1", '3', False)
+        self.assertEqual(self.requests.count("batch"), 1)
+        self.assertEqual(first.value, ['ROW1'])
+        self.assertRaises(FilemanError, lambda: missing.value)
+        self.assertEqual(batch.results[2].value, ['ROW3'])
+        self.assertRaises(FilemanError, batch.values)
+
+        # The connection is still usable
+        self.assertEqual(self.client.dbsfile_get("1", '2', False), ['ROW2'])
+
+        def query():
+            with self.client.batch():
+                self.client.dbsfile_query("1", None, None, False, None, None)
+        self.assertRaises(FilemanError, query)
+
+class TestWireCodec(unittest.TestCase):
+
+    def test_roundtrip(self):
+        value = {
+            'rows': [['1', ['ROW1', u'caf\xe9', None, 3, 2.5, datetime.date(2012, 7, 16)]],
+                    [['2', '1'], ['ROW2', '', True, 2**70, -1, datetime.datetime(2012, 7, 16, 10, 5, 1)]]],
+            'more': False,
+            'empty': [],
+            'tuple': (1, 2),
+        }
+        result = wirecodec.loads(wirecodec.dumps(value))
+        value['tuple'] = [1, 2]
+        self.assertEqual(result, value)
+        self.assertEqual(wirecodec.loads(bytearray(wirecodec.dumps(value))), value)
+
+    def test_table(self):
+        """
+            Rows are stored by column
+        """
+        rows = [[str(i), ['ROW%d' % i, 'TEXT']] for i in range(10)]
+        data = wirecodec.dumps(rows)
+        self.assertEqual(data[0], 'C')
+        self.assertEqual(wirecodec.loads(data), rows)
+
+    def test_exception(self):
+        data = wirecodec.dumps({"__exception__": "FilemanError", "message": "failed"})
+        self.assertRaises(FilemanError, wirecodec.loads, data)
+
+class TestServer(FilemandServer):
+    """
+        A server which records the users connected, and keeps its TestDBS
+    """
+    def __init__(self, *args, **kwargs):
+        FilemandServer.__init__(self, *args, **kwargs)
+        self.users = []
+
+    def cmd_connect(self, handle, request):
+        self.users.append(request['DUZ'])
+        self.handles = {}
+        return ""
+
+def serve_client(servers, recycle=None):
+    """
+        A client connected to a new server thread
+    """
+    server_socket, client_socket = socket.socketpair()
+    server = TestServer(server_socket, recycle=recycle)
+    server.dbs = TestDBS()
+    server.handles = {}
+    thread = threading.Thread(target=server)
+    thread.daemon = True
+    thread.start()
+    servers.append(server)
+    return SocketClient(client_socket)
+
+class TestPool(FilemandClientPool):
+    """
+        A pool whose connections are served by threads in this process
+    """
+    recycle = None
+
+    def __init__(self, size, **kwargs):
+        FilemandClientPool.__init__(self, None, None, size=size, **kwargs)
+        self.servers = []
+
+    def _new_client(self):
+        return serve_client(self.servers, self.recycle)
+
+class TestClientPool(unittest.TestCase):
+
+    def test_reuse(self):
+        """
+            A connection and its file handles are reused by the next call.
+        """
+        pool = TestPool(2)
+        handle = pool.get_file("TESTFILE")['handle']
+        self.assertEqual(pool.dbsfile_get(handle, '2', False), ['ROW2'])
+        self.assertEqual(list(pool.dbsfile_query(handle, 3, None, False, None, None)),
+            [['ROW1'], ['ROW2'], ['ROW3']])
+        self.assertEqual(len(pool.servers), 1)
+        self.assertEqual(pool.servers[0].dbs.opened, ["TESTFILE"])
+        self.assertRaises(FilemanError, pool.get_file, "NOFILE")
+
+    def test_bounded(self):
+        """
+            Callers wait for a connection when all are checked out.
+        """
+        pool = TestPool(1, timeout=0.1)
+        handle = pool.get_file("TESTFILE")['handle']
+        cursor = pool.dbsfile_query(handle, None, None, False, None, None)
+        cursor.next()
+        # the open cursor holds the only connection
+        self.assertRaises(FilemanError, pool.dbsfile_get, handle, '1', False)
+        cursor.close()
+        self.assertEqual(pool.dbsfile_get(handle, '1', False), ['ROW1'])
+
+        results = []
+        client = pool.checkout()
+        def waiter():
+            results.append(pool.dbsfile_get(handle, '5', False))
+        pool.timeout = 5
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(results, [])
+        pool.checkin(client)
+        thread.join(5)
+        self.assertEqual(results, [['ROW5']])
+        self.assertEqual(len(pool.servers), 1)
+
+    def test_health_check(self):
+        """
+            A connection which has gone away is replaced.
+        """
+        pool = TestPool(1, ping_interval=0)
+        handle = pool.get_file("TESTFILE")['handle']
+        pool.servers[0].socket.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(pool.dbsfile_get(handle, '3', False), ['ROW3'])
+        self.assertEqual(len(pool.servers), 2)
+        self.assertEqual(pool.servers[1].dbs.opened, ["TESTFILE"])
+
+    def test_recycle(self):
+        """
+            A server due to be recycled closes the connection once it
+            holds no cursor, and the pool reconnects.
+        """
+        pool = TestPool(1)
+        pool.recycle = lambda requests: requests >= 2
+        handle = pool.get_file("TESTFILE")['handle']
+        cursor = pool.dbsfile_query(handle, None, None, False, None, None)
+        cursor.next()
+        cursor.close()
+        time.sleep(0.1)
+        self.assertEqual(pool.servers[0].requests, 4)
+        self.assertEqual(pool.dbsfile_get(handle, '1', False), ['ROW1'])
+        self.assertEqual(len(pool.servers), 2)
+
+    def test_lock(self):
+        """
+            A thread keeps its connection from lock to unlock.
+        """
+        pool = TestPool(2)
+        # a server due to be recycled keeps the connection while it holds a lock
+        pool.recycle = lambda requests: requests >= 2
+        handle = pool.get_file("TESTFILE")['handle']
+        pool.dbsfile_lock(handle, _rowid='1', timeout=5)
+        self.assertEqual(len(pool._idle), 0)
+        time.sleep(0.1)
+        self.assertEqual(pool.dbsfile_get(handle, '1', False), ['ROW1'])
+        self.assertEqual(pool.servers[0].locks, 1)
+        pool.dbsfile_unlock(handle, _rowid='1')
+        self.assertEqual(len(pool._idle), 1)
+        self.assertEqual(len(pool.servers), 1)
+
+    def test_users(self):
+        """
+            One pool is shared by two users. Each call is made on a
+            connection connected as its user.
+        """
+        pool = TestPool(1)
+        user1, user2 = pool.user(DUZ="1"), pool.user(DUZ="2")
+        handle = user1.get_file("TESTFILE")['handle']
+        self.assertEqual(user1.dbsfile_get(handle, '1', False), ['ROW1'])
+        self.assertEqual(user2.dbsfile_get(handle, '2', False), ['ROW2'])
+        self.assertEqual(user1.dbsfile_get(handle, '3', False), ['ROW3'])
+        self.assertEqual(pool.servers[0].users, ["1", "2", "1"])
+        # the file is opened again after each change of user
+        self.assertEqual(pool.servers[0].dbs.opened, ["TESTFILE"] * 3)
+
+        # with a connection for each, neither is reconnected
+        pool = TestPool(2)
+        user1, user2 = pool.user(DUZ="1"), pool.user(DUZ="2")
+        with user1.connection():
+            with user2.connection():
+                pass
+        handle = user1.get_file("TESTFILE")['handle']
+        for i in range(3):
+            user1.dbsfile_get(handle, '1', False)
+            user2.dbsfile_get(handle, '2', False)
+        self.assertEqual(sorted([server.users for server in pool.servers]), [["1"], ["2"]])
+
+    def test_batch(self):
+        pool = TestPool(2)
+        handle = pool.get_file("TESTFILE")['handle']
+        with pool.batch() as batch:
+            pool.dbsfile_get(handle, '1', False)
+            pool.dbsfile_get(handle, '2', False)
+        self.assertEqual(batch.values(), [['ROW1'], ['ROW2']])
+
+class TestAsync(AsyncFilemandClient):
+    """
+        An async client whose connections are served by threads in this process
+    """
+    def __init__(self, connections):
+        AsyncFilemandClient.__init__(self, None, None, connections=connections)
+        self.servers = []
+
+    def _new_client(self):
+        return serve_client(self.servers)
+
+class TestAsyncClient(unittest.TestCase):
+
+    def test_requests(self):
+        """
+            Many requests are in flight at once, over the connections.
+        """
+        client = TestAsync(3)
+        handle = client.get_file("TESTFILE").result(5)
+        rows = [client.get(handle, str(i)) for i in range(1, 21)]
+        self.assertTrue(client.wait(*rows, timeout=5))
+        self.assertEqual([row.result() for row in rows], [['ROW%d' % i] for i in range(1, 21)])
+        self.assertEqual(len(client.servers), 3)
+        self.assertEqual(client.count(handle).result(5), 250)
+
+        missing = client.get(handle, '999')
+        self.assertRaises(FilemanError, missing.result, 5)
+        self.assertRaises(FilemanError, client.get_file("NOFILE").result, 5)
+        client.close()
+
+    def test_cursor(self):
+        """
+            Cursor pages are fetched without blocking.
+        """
+        client = TestAsync(2)
+        handle = client.get_file("TESTFILE").result(5)
+        cursor = client.query(handle, None, fetch_size=100).result(5)
+        page = cursor.fetch()
+        other = client.get(handle, '7')
+        client.wait(page, other, timeout=5)
+        self.assertEqual(len(page.result()), 100)
+        self.assertEqual(other.result(), ['ROW7'])
+        rows = list(cursor)
+        self.assertEqual(len(rows), 150)
+        self.assertEqual(rows[-1], ['ROW250'])
+        self.assertEqual(cursor.fetch().result(), [])
+        client.close()
+
+    def test_errors(self):
+        """
+            A failing callback, or a response which can not be decoded,
+            fails no more than its own request.
+        """
+        client = TestAsync(1)
+        handle = client.get_file("TESTFILE").result(5)
+        called = []
+        def callback(pending):
+            called.append(pending)
+            raise ValueError("callback failed")
+        first = client.get(handle, '1')
+        first.add_done_callback(callback)
+        first.add_done_callback(called.append)
+        second = client.get(handle, '2')
+        self.assertTrue(client.wait(first, second, timeout=5))
+        self.assertEqual(called, [first, first])
+        self.assertEqual((first.result(), second.result()), (['ROW1'], ['ROW2']))
+
+        def decode(data):
+            raise ValueError("corrupt frame")
+        connection = client.connections[0]
+        json_codec = connection.codec
+        CODECS['broken'] = (CODECS[json_codec][0], decode)
+        try:
+            connection.codec = 'broken'
+            bad = client.get(handle, '3')
+            self.assertTrue(client.wait(bad, timeout=5))
+        finally:
+            connection.codec = json_codec
+            del CODECS['broken']
+        self.assertRaises(FilemanError, bad.result)
+        self.assertEqual(client.get(handle, '4').result(5), ['ROW4'])
+        client.close()
+
+test_cases = (TestClientServer, TestClientPool, TestAsyncClient, TestWireCodec)
+
+def load_tests(loader, tests, pattern):
+    suite = unittest.TestSuite()
+    for test_class in test_cases:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    return suite
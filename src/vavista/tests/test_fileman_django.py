@@ -12,7 +12,7 @@
 
 import unittest
 
-from vavista.fileman import connect, transaction
+from vavista.fileman import connect, transaction, FilemanError
 from vavista.M import Globals
 
 class TestDjango(unittest.TestCase):
@@ -272,12 +272,38 @@ class TestDjango(unittest.TestCase):
         self.assertEqual(result[3][1][0], 'ROW3')
 
         # Check the query plan
+        # The index is in the order_by order, there is no sort
         plan = list(pytest.query(filters=[['.01', '>=', 'ROW3'], ['.01', '<=', 'ROW6']], order_by=[[".01", "desc"]], explain=True))
-        self.assertEqual(len(plan), 3)
+        self.assertEqual(len(plan), 2)
         self.assertEqual(plan[0].find("index_order_traversal"), 0)
         self.assertNotEquals(plan[0].find("ascending=False"), -1)
         self.assertNotEquals(plan[0].find("X <= 'ROW6' AND X >= 'ROW3'"), -1)
         self.assertNotEquals(plan[0].find("index=B"), -1)
+        self.assertEquals(plan[1].find("apply_filters"), 0)
+
+        # Filter on an unindexed column, the order_by index gives the order
+        plan = list(pytest.query(filters=[['1', '>=', '3:']], order_by=[[".01", "ASC"]], limit=2, explain=True))
+        self.assertEqual(len(plan), 3)
+        self.assertEqual(plan[0].find("index_order_traversal"), 0)
+        self.assertNotEquals(plan[0].find("index=B"), -1)
+        self.assertEquals(plan[1].find("apply_filters"), 0)
+        self.assertEquals(plan[2].find("offset_limit"), 0)
+
+        cursor = pytest.query(filters=[['1', '>=', '3:']], order_by=[[".01", "ASC"]], limit=2)
+        result = list(cursor)
+        self.assertEqual(result[0][1][0], 'ROW3')
+        self.assertEqual(result[1][1][0], 'ROW4')
+
+        # Rows with no value are missing from the index on an optional
+        # column, so the file is walked and sorted.
+        field = pytest.dd.fields['.01']
+        field.mandatory = False
+        try:
+            plan = list(pytest.query(filters=[['1', '>=', '3:']], order_by=[[".01", "ASC"]], limit=2, explain=True))
+        finally:
+            field.mandatory = True
+        self.assertEqual(plan[0].find("file_order_traversal"), 0)
+        self.assertEquals(plan[2].find("top_n_sorter"), 0)
 
     def test_no_index(self):
         """
@@ -301,6 +327,21 @@ class TestDjango(unittest.TestCase):
         self.assertEquals(plan[1].find("apply_filters filters"), 0)
         self.assertNotEquals(plan[1].find("[['1', '>=', '3:'], ['1', '<=', '6:']]"), -1)
 
+        # A page of a sorted result only keeps the page
+        cursor = pytest.query(filters=[['1', '>=', '3:'], ['1', '<=', '6:']], order_by=[['1', 'DESC']], limit=2)
+        result = list(cursor)
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[0][1][0], 'ROW5')
+        self.assertEqual(result[1][1][0], 'ROW4')
+
+        plan = list(pytest.query(filters=[['1', '>=', '3:'], ['1', '<=', '6:']], order_by=[['1', 'DESC']], limit=2,
+            explain=True))
+        self.assertEqual(len(plan), 4)
+        self.assertEquals(plan[1].find("apply_filters filters"), 0)
+        self.assertEquals(plan[2].find("top_n_sorter"), 0)
+        self.assertNotEquals(plan[2].find("n = 2"), -1)
+        self.assertEquals(plan[3].find("offset_limit"), 0)
+
 
     def test_index_plus_filter(self):
         """
@@ -333,12 +374,11 @@ class TestDjango(unittest.TestCase):
 
     def test_index_in(self):
         """
-            right now this gives a non-indexed traversal. In reality,
-            it should create a third type of cursor, for multi-set retrieval.
+            An "in" list on an indexed column seeks each value in the index.
         """
         pytest = self.dbs.get_file("PYTEST20", fieldids=['.01', '1', '2'])
 
-        cursor = pytest.query(filters=[['.01', 'in', ['ROW3', 'ROW4', 'ROW5']]])
+        cursor = pytest.query(filters=[['.01', 'in', ['ROW5', 'ROW3', 'ROW4', 'ROW3', 'NOROW']]])
         result = list(cursor)
         self.assertEqual(len(result), 3)
         self.assertEqual(result[0][1][0], 'ROW3')
@@ -347,12 +387,82 @@ class TestDjango(unittest.TestCase):
 
         # Check the query plan
         plan = list(pytest.query(filters=[['.01', 'in', ['ROW3', 'ROW4', 'ROW5']]], explain=True))
-        self.assertEqual(plan[0].find("file_order_traversal"), 0)
+        self.assertEqual(plan[0].find("index_order_traversal"), 0)
         self.assertNotEquals(plan[0].find("ascending=True"), -1)
-        self.assertNotEquals(plan[0].find("X None None AND X None None"), -1)
+        self.assertNotEquals(plan[0].find("index=B"), -1)
+        self.assertNotEquals(plan[0].find("X >= 'ROW3' AND X <= 'ROW3' OR X >= 'ROW4' AND X <= 'ROW4' OR "
+            "X >= 'ROW5' AND X <= 'ROW5'"), -1)
         self.assertEquals(plan[1].find("apply_filters"), 0)
         self.assertNotEquals(plan[1].find("filters = [['.01', 'in', ['ROW3', 'ROW4', 'ROW5']]]"), -1)
 
+        # rowids are read directly
+        cursor = pytest.query(filters=[['_rowid', 'in', ['5', '3', '99']]])
+        result = list(cursor)
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[0][1][0], 'ROW3')
+        self.assertEqual(result[1][1][0], 'ROW5')
+
+    def test_or(self):
+        """
+            An "or" group. Equalities on one column become an "in",
+            other indexed branches are a union of the rowids.
+        """
+        pytest = self.dbs.get_file("PYTEST20", fieldids=['.01', '1', '2'])
+
+        filters = [[None, 'or', [['.01', '=', 'ROW4'], ['.01', '=', 'ROW3']]]]
+        result = list(pytest.query(filters=filters))
+        self.assertEqual([row[1][0] for row in result], ['ROW3', 'ROW4'])
+
+        plan = list(pytest.query(filters=filters, explain=True))
+        self.assertEqual(plan[0].find("index_order_traversal"), 0)
+        self.assertNotEquals(plan[0].find("X >= 'ROW3' AND X <= 'ROW3' OR X >= 'ROW4' AND X <= 'ROW4'"), -1)
+
+        filters = [[None, 'or', [['.01', '=', 'ROW4'], ['_rowid', '=', '2'], [['.01', '>=', 'ROW8'], ['1', '<', '9']]]]]
+        result = list(pytest.query(filters=filters))
+        self.assertEqual([row[1][0] for row in result], ['ROW2', 'ROW4', 'ROW8'])
+
+        plan = list(pytest.query(filters=filters, explain=True))
+        self.assertEqual(len(plan), 2)
+        self.assertEqual(plan[0].find("index_set_traversal, combine=or"), 0)
+        self.assertEquals(plan[1].find("apply_filters"), 0)
+
+    def test_continuation(self):
+        """
+            A query or traversal can be resumed from the continuation
+            token of the previous page, rather than an offset.
+        """
+        pytest = self.dbs.get_file("PYTEST20", fieldids=['.01', '1', '2'])
+
+        filters = [['.01', '>=', 'ROW3']]
+        cursor = pytest.query(filters=filters, limit=3)
+        result = [row[1][0] for row in cursor]
+        self.assertEqual(result, ['ROW3', 'ROW4', 'ROW5'])
+        token = cursor.continuation
+        self.assertNotEqual(token, None)
+
+        cursor = pytest.query(filters=filters, limit=3, continuation=token)
+        result = [row[1][0] for row in cursor]
+        self.assertEqual(result, ['ROW6', 'ROW7', 'ROW8'])
+
+        cursor = pytest.query(filters=filters, limit=3, continuation=cursor.continuation)
+        result = [row[1][0] for row in cursor]
+        self.assertEqual(result, ['ROW9', 'ROWa'])
+        self.assertEqual(cursor.continuation, None)
+
+        # The token belongs to the query
+        self.assertRaises(FilemanError, pytest.query, filters=[['.01', '>=', 'ROW4']], continuation=token)
+
+        # A sorted result has no traversal position
+        cursor = pytest.query(filters=filters, order_by=[['1', 'ASC']], limit=3)
+        self.assertEqual(len(list(cursor)), 3)
+        self.assertEqual(cursor.continuation, None)
+
+        cursor = pytest.traverser("B", "ROW3", raw=True)
+        result = [cursor.next() for i in range(3)]
+        self.assertEqual([key for (key, rowid) in result], ['ROW3', 'ROW4', 'ROW5'])
+        cursor = pytest.traverser("B", "ROW3", raw=True, continuation=cursor.continuation)
+        self.assertEqual(cursor.next()[0], 'ROW6')
+
     def test_subfile(self):
         """
             This is pulling county information from a state.
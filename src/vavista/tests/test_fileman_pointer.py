@@ -10,6 +10,7 @@ import unittest
 import sys
 
 from vavista.fileman import connect, transaction, FilemanError
+from vavista.fileman.dbsdd import DD, registry
 from vavista.M import Globals
 
 class TestPointer(unittest.TestCase):
@@ -174,6 +175,24 @@ class TestPointer(unittest.TestCase):
         self.assertEqual(rec[2], "EIGHT")
 
 
+    def test_registry(self):
+        """
+            A pointer field looks up the DD it points to on each use,
+            so it does not keep a DD the registry has dropped.
+        """
+        field = DD("PYTEST9B").fields["1"]
+        dd = field.dd
+        self.assertTrue(dd is DD("PYTEST9A"))
+
+        registry.invalidate(dd.fileid)
+        self.assertFalse(field.dd is dd)
+        self.assertTrue(field.dd is DD("PYTEST9A"))
+
+        pytest = self.dbs.get_file("PYTEST9B", internal=False,
+                fieldnames=["NAME", "P1", "P2"])
+        rec = pytest.traverser("B", " ").next()
+        self.assertEqual(rec[1], "EIGHT")
+
     def test_internal(self):
         pytest = self.dbs.get_file("PYTEST9B", internal=True,
                 fieldnames=["NAME", "P1", "P2"])
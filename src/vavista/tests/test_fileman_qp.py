@@ -22,8 +22,10 @@
 import unittest
 
 from vavista.fileman import connect, transaction
+from vavista import M
 from vavista.M import Globals
 
+from vavista.fileman import query_planner, indexstats, blockfetch
 from vavista.fileman.query_planner import make_plan
 
 class TestPlanner(unittest.TestCase):
@@ -204,6 +206,11 @@ class TestPlanner(unittest.TestCase):
         result = [row[0] for row in result]
         self.assertEqual(result, ['5'])
 
+        # The header, an index or "" are not records
+        for rowid in ['0', 'B', '']:
+            result = list(make_plan(pytest, filters = [["_rowid", "=", rowid]]))
+            self.assertEqual(result, [])
+
         result = list(make_plan(pytest, filters = [["_rowid", ">=", '5'], ["_rowid", "<=", "7"]]))
         result = [row[0] for row in result]
         self.assertEqual(result, ['5', '6', '7'])
@@ -213,6 +220,100 @@ class TestPlanner(unittest.TestCase):
         result = [row[0] for row in result]
         self.assertEqual(result, ['7', '6', '5'])
 
+        # Block scan, the record nodes are loaded into the cache as each row is emitted.
+        gl_cache = {}
+        plan = make_plan(pytest, gl_cache=gl_cache, prefetch=True, block_size=3)
+        rowid, gl_root, rowid_path = plan.next()
+        self.assertEqual(rowid, '1')
+        self.assertEqual(gl_cache[Globals.from_closed_form(gl_root)['0'].closed_form], 'ROW1^1: LINE 1')
+        result = [rowid] + [row[0] for row in plan]
+        self.assertEqual(result, ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10'])
+
+        # Unindexed sort, spilling runs of 3 rows to disk
+        result = list(make_plan(pytest, order_by = [["1", "DESC"]], sort_budget=3))
+        result = [row[0] for row in result]
+        self.assertEqual(result, ['10', '9', '8', '7', '6', '5', '4', '3', '2', '1'])
+
+        plan = list(make_plan(pytest, order_by = [["1", "DESC"]], sort_budget=3, explain=True))
+        self.assertEqual(plan[1].find("sorter"), 0)
+        self.assertNotEquals(plan[1].find("budget = 3 rows, 3 runs spilled for an estimated 10 rows"), -1)
+
+        # Unindexed sort, done in M
+        m_sort_rows = query_planner.M_SORT_ROWS
+        query_planner.M_SORT_ROWS = 0
+        try:
+            plan = list(make_plan(pytest, order_by = [["1", "DESC"]], explain=True))
+            self.assertEqual(plan[1].find("m_sorter"), 0)
+            result = list(make_plan(pytest, order_by = [["1", "DESC"]], block_size=3))
+            result = [row[0] for row in result]
+            self.assertEqual(result, ['10', '9', '8', '7', '6', '5', '4', '3', '2', '1'])
+
+            # Keys too long for the ^TMP subscripts are sorted in Python
+            m_sort_key_length = query_planner.M_SORT_KEY_LENGTH
+            query_planner.M_SORT_KEY_LENGTH = 20
+            try:
+                result = list(make_plan(pytest, order_by = [["1", "DESC"], ["2", "ASC"]], block_size=3))
+            finally:
+                query_planner.M_SORT_KEY_LENGTH = m_sort_key_length
+            result = [row[0] for row in result]
+            self.assertEqual(result, ['10', '9', '8', '7', '6', '5', '4', '3', '2', '1'])
+        finally:
+            query_planner.M_SORT_ROWS = m_sort_rows
+
+    def test_block_bytes(self):
+        """
+            A block of records ends before a record which would take it
+            past BLOCK_BYTES, and the next block starts at that record.
+        """
+        pytest = self.dbs.get_file("PYTEST20")
+        gl = pytest.dd.m_open_form()
+        rowids = ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10']
+        expected = [(row[0], dict(blockfetch.fetch_records(gl, [row[0]]))[row[0]])
+            for row in make_plan(pytest)]
+
+        lengths = []
+        mexec = M.mexec
+        def sized_mexec(*args):
+            rv = mexec(*args)
+            lengths.append(max([len(value) for value in rv] + [0]))
+            return rv
+
+        # Each record packs to more than half of this.
+        block_bytes = blockfetch.BLOCK_BYTES
+        blockfetch.BLOCK_BYTES = 40
+        M.mexec = sized_mexec
+        try:
+            walked = list(blockfetch.file_block_walk(gl, prefetch=True))
+            fetched = list(blockfetch.fetch_records(gl, rowids))
+        finally:
+            M.mexec = mexec
+            blockfetch.BLOCK_BYTES = block_bytes
+
+        self.assertEqual([row[0] for row in walked], rowids)
+        self.assertEqual(walked, expected)
+        self.assertEqual(fetched, expected)
+        self.assertTrue(max(lengths) <= 40)
+
+    def test_sorters(self):
+        """
+            The sorters all use M collation, and break ties on the rowid,
+            so a result is in the same order whichever sort is used.
+        """
+        pytest = self.dbs.get_file("PYTEST20")
+        rows = list(make_plan(pytest))
+        rows.reverse()
+        dd = pytest.dd
+
+        for order_by, expected in [
+                ([["_rowid", "ASC"]], ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10']),
+                ([["_rowid", "DESC"]], ['10', '9', '8', '7', '6', '5', '4', '3', '2', '1'])]:
+            result = [row[0] for row in query_planner.sorter(iter(rows), order_by, dd)]
+            self.assertEqual(result, expected)
+            result = [row[0] for row in query_planner.top_n_sorter(iter(rows), order_by, dd, 10)]
+            self.assertEqual(result, expected)
+            result = [row[0] for row in query_planner.m_sorter(iter(rows), order_by, dd, block_size=3)]
+            self.assertEqual(result, expected)
+
     def test_index_b(self):
         """
             Name order.
@@ -267,6 +368,64 @@ class TestPlanner(unittest.TestCase):
         result = [row[0] for row in result]
         self.assertEqual(result, ['7', '6', '5'])
 
+    def test_index_only(self):
+        """
+            A projection of the indexed column alone is read from the
+            index, without the records.
+        """
+        pytest = self.dbs.get_file("PYTEST20")
+
+        # The B cross reference is keyed on $E(X,1,30)
+        index = [index for index in pytest.dd.indices if index.name == 'B'][0]
+        self.assertEqual((index.value_key, index.key_length), (True, 30))
+
+        filters = [[".01", ">=", 'ROW5'], [".01", "<=", "ROW7"]]
+        plan = list(make_plan(pytest, filters=filters, fieldids=[".01"], explain=True))
+        self.assertTrue(plan[0].find("index only") > 0)
+
+        result = list(make_plan(pytest, filters=filters, fieldids=[".01"]))
+        self.assertEqual([row[3] for row in result], [{'.01': 'ROW5'}, {'.01': 'ROW6'}, {'.01': 'ROW7'}])
+
+        # Another column has to be read from the record
+        plan = list(make_plan(pytest, filters=filters, fieldids=[".01", "1"], explain=True))
+        self.assertEqual(plan[0].find("index only"), -1)
+
+        result = list(pytest.query(filters=filters, fields=["NAME"]))
+        self.assertEqual(result, [('5', ('ROW5',)), ('6', ('ROW6',)), ('7', ('ROW7',))])
+
+        # A second order_by column is sorted from the records
+        order_by = [[".01", "ASC"], ["1", "ASC"]]
+        plan = list(make_plan(pytest, order_by=order_by, fieldids=[".01"], explain=True))
+        self.assertEqual(plan[0].find("index only"), -1)
+        result = list(pytest.query(order_by=order_by, limit=2, fields=["NAME"]))
+        self.assertEqual(result, [('1', ('ROW1',)), ('2', ('ROW2',))])
+
+    def test_index_stats(self):
+        """
+            Index statistics used to choose between indices.
+        """
+        pytest = self.dbs.get_file("PYTEST20")
+
+        indexstats.invalidate(pytest.dd.fileid)
+        stats = indexstats.index_stats(pytest.dd, 'B', pytest.count())
+        self.assertEqual(stats.complete, True)
+        self.assertEqual(stats.entries, 10)
+        self.assertEqual(stats.distinct_keys, 10)
+        self.assertEqual(stats.rows_per_key, 1.0)
+
+        # cached until the file changes
+        self.assertTrue(indexstats.index_stats(pytest.dd, 'B', pytest.count()) is stats)
+
+        ranges = [{'from_value': 'ROW5', 'from_rule': '>=', 'to_value': 'ROW7', 'to_rule': '<='}]
+        self.assertEqual(query_planner.estimate_rows(stats, ranges, 10), 3)
+        self.assertEqual(str(stats).find("estimated"), -1)
+
+        # Numeric keys are compared in M collation - '9' is before '10'
+        stats = indexstats.IndexStats('N', [[str(i), 1] for i in range(1, 11)], 10, False, 100)
+        ranges = [{'from_value': '2', 'from_rule': '>=', 'to_value': '9', 'to_rule': '<='}]
+        self.assertEqual(query_planner.estimate_rows(stats, ranges, 100), 8)
+        self.assertTrue(str(stats).endswith("(estimated)"))
+
 
 test_cases = (TestPlanner, )
 
@@ -134,7 +134,7 @@ class TestTextline(unittest.TestCase):
     def test_readwrite(self):
         transaction.begin()
         pytest1 = self.dbs.get_file("PYTEST1", fieldnames=['NAME', 'TEXTLINE_ONE', 'TEXTLINE2'])
-        pytest1.insert(NAME='Test Insert', TEXTLINE_ONE="LINE 1", TEXTLINE2="LINE 2")
+        rowid = pytest1.insert(NAME='Test Insert', TEXTLINE_ONE="LINE 1", TEXTLINE2="LINE 2")
         transaction.commit()
 
         # The low-level traverser, walks index "B", on NAME field
@@ -147,6 +147,12 @@ class TestTextline(unittest.TestCase):
         self.assertEqual(rec[1], "LINE 1")
         self.assertEqual(rec[2], "LINE 2")
 
+        # Bulk retrieve - missing rows are None
+        recs = pytest1.get_many([rowid, '99999', rowid])
+        self.assertEqual(recs[0], ("Test Insert", "LINE 1", "LINE 2"))
+        self.assertEqual(recs[1], None)
+        self.assertEqual(recs[2], recs[0])
+
         # Once this is working
         # Verify mandatory field insert logic
         # Verify utf-8 characters
@@ -154,6 +154,29 @@ class TestTraversal(unittest.TestCase):
         self.assertEqual(result[0][0], 'ROW4')
         self.assertEqual(result[0][1], '5')
 
+    def test_projection(self):
+        """
+            The fields argument overrides the projection of the file
+            for one call.
+        """
+        pytest1 = self.dbs.get_file("PYTEST1")
+        transaction.begin()
+        for i in range(3):
+            pytest1.insert(NAME='ROW%d' % i, TEXTLINE_ONE="%d: LINE 1" % i, TEXTLINE2="%d: LINE 2" % i)
+        transaction.commit()
+
+        self.assertEqual(pytest1.get("2", fields=["textline2"]), ("1: LINE 2",))
+        self.assertEqual(pytest1.get("2", asdict=True, fields=["name", "textline2"]),
+            {"name": "ROW1", "textline2": "1: LINE 2"})
+        self.assertEqual(len(pytest1.get("2")), 3)
+
+        result = list(pytest1.query(limit=2, fields=["textline2"]))
+        self.assertEqual(result, [('1', ("0: LINE 2",)), ('2', ("1: LINE 2",))])
+
+        cursor = pytest1.traverser("B", "ROW2", "ROW2", fields=[".01"])
+        self.assertEqual(list(cursor), [("ROW2",)])
+
+        self.assertRaises(FilemanError, pytest1.get, "2", fields=["nosuchfield"])
 
     def test_traversal_file(self):
         """
@@ -260,6 +283,11 @@ class TestTraversal(unittest.TestCase):
         self.assertEqual(result[2][0], "ROW6")
         self.assertEqual(result[3][0], "ROW5")
 
+        # Small blocks - the index is read from M two entries at a time.
+        cursor = pytest1.traverser("B", "ROW4", "ROW8", raw=True, block_size=2)
+        result = list(cursor)
+        self.assertEqual([r[0] for r in result], ["ROW4", "ROW5", "ROW6", "ROW7"])
+
         cursor = pytest1.traverser("B", "ROW4", "ROW8", to_rule="<=", from_rule=">=", raw=True)
         result = list(cursor)
         self.assertEqual(len(result), 5)
@@ -1,9 +1,12 @@
 
 # Test the Fileman DBS interface
 
+import shutil
+import tempfile
 import unittest
 
-from vavista.fileman import connect, transaction, FilemanError
+from vavista.fileman import connect, transaction, FilemanError, ddcache
+from vavista.fileman.dbsdd import _DD, DD, registry
 from vavista.M import Globals
 
 class TestWP(unittest.TestCase):
@@ -167,6 +170,55 @@ class TestWP(unittest.TestCase):
         self.assertEqual(rec[1], '\n'.join([u"line 1", u"line 2", u"line 3"]))
         self.assertEqual(rec[2], '\n'.join([u"2 line 1", u"2 line 2", u"2 line 3"]))
 
+    def test_snapshot(self):
+        """
+            The DD is loaded from its snapshot until the ^DD header changes.
+        """
+        snapshot_dir = ddcache.SNAPSHOT_DIR
+        ddcache.SNAPSHOT_DIR = tempfile.mkdtemp()
+        try:
+            dd = _DD("9999907")
+            self.assertEqual(sorted(dd.fields.keys()), [".01", "1", "2"])
+
+            loaded = _DD("9999907")
+            self.assertTrue(loaded._load_snapshot())
+            self.assertEqual(loaded.fields["1"].__class__, dd.fields["1"].__class__)
+            self.assertEqual(loaded.fields["1"].wrapinfo, "Wx")
+            self.assertEqual(loaded.fields["2"].wrapinfo, "WL")
+            self.assertEqual(loaded.attrs["wp2"], "2")
+            self.assertEqual([index.name for index in loaded.indices], ["B"])
+            self.assertEqual(loaded.m_open_form(), "^DIZ(9999907,")
+
+            transaction.begin()
+            Globals.deserialise([('^DD(9999907,0,"DT")', '3120721')])
+            transaction.commit()
+            self.assertFalse(_DD("9999907")._load_snapshot())
+        finally:
+            shutil.rmtree(ddcache.SNAPSHOT_DIR)
+            ddcache.SNAPSHOT_DIR = snapshot_dir
+
+    def test_registry(self):
+        """
+            The registry reloads a DD when ^DD(file,0,"DT") changes.
+        """
+        check_interval, registry.check_interval = registry.check_interval, 0
+        try:
+            dd = DD("PYTEST5")
+            dd.fields, dd.indices
+            hits = registry.hits
+            self.assertTrue(DD("9999907") is dd)
+            self.assertEqual(registry.hits, hits + 1)
+            self.assertTrue(("9999907", "PYTEST5", True, True) in registry.resident())
+
+            transaction.begin()
+            Globals.deserialise([('^DD(9999907,0,"DT")', '3120721')])
+            transaction.commit()
+            invalidations = registry.invalidations
+            self.assertFalse(DD("PYTEST5") is dd)
+            self.assertEqual(registry.invalidations, invalidations + 1)
+        finally:
+            registry.check_interval = check_interval
+
     def test_indexing(self):
         """
             TODO: walk a date index. Can I return the values as ints / floats.